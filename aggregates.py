@@ -0,0 +1,368 @@
+import random
+import re
+from datetime import datetime
+from pymongo import DESCENDING, ReplaceOne, UpdateOne
+from pymongo.errors import BulkWriteError
+import ledger
+
+# every platform counter is split over this many documents and every
+# change goes to a random one, so trades don't all wait on one document
+COUNTER_SHARDS = 16
+# the fields of a trade the leaderboard needs to replay it
+TRADE_FIELDS = {
+    "_id": False, "username": True, "stock_name": True, "side": True,
+    "amount": True, "value": True, "fee": True, "total": True, "seq": True}
+# the filter of the shards of the shares counters of all stocks
+SHARES_FILTER = {"_id": {"$regex": "^shares:[^:]+:[0-9]+$"}}
+
+
+# function to get the filter of the shards of a counter, the shards are
+# saved in the counters collection as "<name>:<shard>"
+def counter_filter(name):
+    return {"_id": {"$regex": "^" + re.escape(name) + ":[0-9]+$"}}
+
+
+# function to add up the shards of counters, per counter name
+def counter_totals(shards):
+    totals = {}
+    for shard in shards:
+        name = shard["_id"].rsplit(":", 1)[0]
+        totals[name] = totals.get(name, 0) + shard.get("value", 0)
+    return totals
+
+
+# function to add amounts to counters, like {"fees": 1.5}, with one
+# write for all of them
+def add_to_counters(db, amounts, session=None):
+    updates = [
+        UpdateOne(
+            {"_id": f"{name}:{random.randrange(COUNTER_SHARDS)}"},
+            {"$inc": {"value": amount}}, upsert=True)
+        for name, amount in amounts.items() if amount]
+    if updates:
+        db.counters.bulk_write(updates, ordered=False, session=session)
+
+
+# function to get the total of one counter
+def read_counter(db, name):
+    return counter_totals(db.counters.find(counter_filter(name))).get(name, 0)
+
+
+# function to set a counter to a total, run it when nobody trades
+def set_counter(db, name, total):
+    db.counters.delete_many(counter_filter(name))
+    db.counters.insert_one({"_id": f"{name}:0", "value": total})
+
+
+# function to get the total income of the business, the income from
+# before the counters is still saved on the admin user
+def business_income(db, admin_user="admin"):
+    user = db.users.find_one(
+        {"username": admin_user}, {"total_income_business": True})
+    return user["total_income_business"] + read_counter(db, "fees")
+
+
+# function to get the last price of stocks from the quotes the worker
+# saved, stocks without a quote are left out
+def quote_prices(db, stock_names):
+    return {
+        quote["stock_name_short"]: quote["price"]
+        for quote in db.quotes.find(
+            {"stock_name_short": {"$in": list(stock_names)}},
+            {"stock_name_short": True, "price": True})
+        if quote.get("price") is not None}
+
+
+# function to get the leaderboard row of a ledger state, the stocks are
+# valued at the prices and a stock without a price at what was paid
+def leaderboard_row(username, state, prices):
+    invested = 0
+    holdings_value = 0
+    for stock_name, position in state["positions"].items():
+        invested += position["cost"]
+        price = prices.get(stock_name)
+        if price is None:
+            holdings_value += position["cost"]
+        else:
+            holdings_value += position["amount"] * price
+    return {
+        "username": username,
+        "seq": state["seq"],
+        "cash": state["cash"],
+        "fees": state["fees"],
+        "positions": state["positions"],
+        "invested": round(invested, 2),
+        "holdings_value": round(holdings_value, 2),
+        "value": round(state["cash"] + holdings_value, 2),
+        # the return of the stocks the user has now
+        "return_percent": round(
+            100 * (holdings_value / invested - 1), 2) if invested else 0,
+        "marked_at": datetime.utcnow(),
+    }
+
+
+# function to bring the leaderboard rows of users up to date with their
+# trades in the ledger. A row is a ledger state, so only the trades after
+# it are replayed. Users from before the ledger get their row from
+# rebuild_aggregates. A row that can't be brought up to date, because of
+# a missing trade or a failed write, gets needs_rebuild so the worker
+# tries it again with rebuild_leaderboard.
+def update_leaderboard(db, usernames, prices=None, session=None, tries=3):
+    rows = {
+        row["username"]: row for row in db.leaderboard.find(
+            {"username": {"$in": list(usernames)}}, session=session)}
+    states = {}
+    for username in usernames:
+        row = rows.get(username)
+        if row is None:
+            state = ledger.latest_snapshot(db, username, session)
+        else:
+            state = {
+                "seq": row["seq"], "cash": row["cash"], "fees": row["fees"],
+                "positions": row["positions"]}
+        if state is not None:
+            states[username] = state
+    if not states:
+        return
+
+    # the new trades of all users with one query
+    user_trades = {}
+    for trade in db.trades.find(
+            {"$or": [
+                {"username": username, "seq": {"$gt": state["seq"]}}
+                for username, state in states.items()]},
+            TRADE_FIELDS, session=session).sort("seq", 1):
+        user_trades.setdefault(trade["username"], []).append(trade)
+    targets = {}
+    gaps = set()
+    for username, state in states.items():
+        seq = state["seq"]
+        trades = user_trades.get(username, [])
+        ledger.replay(state, trades)
+        if trades and trades[-1]["seq"] > state["seq"]:
+            # the replay stopped at a missing trade, that is a trade of
+            # another request that isn't saved yet or one that is lost
+            print(f"trade {state['seq'] + 1} of {username} is missing, "
+                  "its leaderboard row waits for it")
+            gaps.add(username)
+        row = rows.get(username)
+        if (row is None or state["seq"] > seq
+                or bool(row.get("needs_rebuild")) != (username in gaps)):
+            targets[username] = state
+    if not targets:
+        return
+
+    # value the stocks at the prices of the trades, or the saved quotes
+    prices = dict(prices or {})
+    missing = {
+        stock_name for state in targets.values()
+        for stock_name in state["positions"] if stock_name not in prices}
+    if missing:
+        prices.update(quote_prices(db, missing))
+
+    # a row is only changed when it isn't newer than the new state, so a
+    # request that saved a newer state at the same time is never undone
+    updates = []
+    for username, state in targets.items():
+        row = leaderboard_row(username, state, prices)
+        row["needs_rebuild"] = username in gaps
+        updates.append(UpdateOne(
+            {"username": username, "seq": {"$lte": state["seq"]}},
+            {"$set": row}, upsert=username not in rows))
+    try:
+        db.leaderboard.bulk_write(updates, ordered=False, session=session)
+    except BulkWriteError as error:
+        # another request added the row of a new user at the same time,
+        # try again from that row
+        if tries > 1:
+            update_leaderboard(
+                db, list(targets), prices, session, tries - 1)
+            return
+        print(f"could not update the leaderboard rows of {list(targets)}: "
+              f"{error.details.get('writeErrors')}")
+        db.leaderboard.update_many(
+            {"username": {"$in": list(targets)}},
+            {"$set": {"needs_rebuild": True}}, session=session)
+
+
+# function to try the leaderboard rows with needs_rebuild again, the
+# worker runs it now and then. It returns how many rows were tried.
+def rebuild_leaderboard(db):
+    usernames = db.leaderboard.distinct("username", {"needs_rebuild": True})
+    if usernames:
+        update_leaderboard(db, usernames)
+    return len(usernames)
+
+
+# function to update the platform counters and the leaderboard with the
+# trades that were just saved in the ledger
+def record_fills(db, entries, session=None):
+    if not entries:
+        return
+    amounts = {}
+    prices = {}
+    for entry in entries:
+        shares = f"shares:{entry['stock_name']}"
+        if entry["side"] == "buy":
+            amounts["fees"] = amounts.get("fees", 0) + entry["fee"]
+            amounts["cash"] = amounts.get("cash", 0) - entry["total"]
+            amounts[shares] = amounts.get(shares, 0) + entry["amount"]
+        else:
+            amounts["cash"] = amounts.get("cash", 0) + entry["value"]
+            amounts[shares] = amounts.get(shares, 0) - entry["amount"]
+        prices[entry["stock_name"]] = entry["price"]
+    add_to_counters(db, amounts, session)
+    update_leaderboard(
+        db, list({entry["username"] for entry in entries}), prices, session)
+
+
+# function to save the fills of trades that are done in the ledger, the
+# counters and the leaderboard. In a transaction an error undoes the
+# trade too, so it is raised. Without one the trade stays done, so an
+# error is only logged and the fills are queued in ledger_repairs.
+def record_executed_fills(db, fills, session=None):
+    if session is not None:
+        entries = ledger.record_trades(db, fills, session=session)
+        record_fills(db, entries, session=session)
+        return entries
+    entries = None
+    try:
+        entries = ledger.number_trades(db, fills)
+        ledger.save_trades(db, entries)
+    except Exception as error:
+        print(f"could not save {len(fills)} trades in the ledger: {error}")
+        # fills that got their numbers keep them, so there is no gap
+        ledger.queue_repair(db, entries or fills, "ledger")
+        return entries
+    try:
+        record_fills(db, entries)
+    except Exception as error:
+        print(f"could not add {len(entries)} trades to the aggregates: "
+              f"{error}")
+        ledger.queue_repair(db, entries, "aggregates")
+    return entries
+
+
+# function to save the fills in ledger_repairs, oldest first. It stops
+# at the first repair that fails again and returns how many were saved.
+def repair_ledger(db):
+    repaired = 0
+    for repair in db.ledger_repairs.find().sort("created_at", 1):
+        entries = repair["fills"]
+        if repair["step"] == "ledger":
+            if all("seq" in entry for entry in entries):
+                ledger.restore_trades(db, entries)
+            else:
+                entries = ledger.record_trades(db, entries)
+        record_fills(db, entries)
+        db.ledger_repairs.delete_one({"_id": repair["_id"]})
+        repaired += 1
+    return repaired
+
+
+# function to move the ledger and the leaderboard row of a user to a
+# new username, after the username in users was changed
+def rename_user(db, old_username, new_username):
+    ledger.rename_user(db, old_username, new_username)
+    db.leaderboard.update_one(
+        {"username": old_username}, {"$set": {"username": new_username}})
+
+
+# function to add a new user to the counters and the leaderboard
+def add_user(db, username, cash):
+    add_to_counters(db, {"cash": cash})
+    update_leaderboard(db, [username])
+
+
+# function to get the assets the platform manages: the cash of all users
+# and the value of all stocks they hold, from the counters. The stocks
+# without a saved quote get their price from live_prices when it is given.
+def assets_under_management(db, live_prices=None):
+    shares = counter_totals(db.counters.find(SHARES_FILTER))
+    shares = {
+        name.split(":", 1)[1]: amount for name, amount in shares.items()
+        if amount}
+    prices = quote_prices(db, shares)
+    missing = [stock_name for stock_name in shares if stock_name not in prices]
+    if missing and live_prices is not None:
+        prices.update(live_prices(missing))
+    stocks = [
+        {"stock_name": stock_name, "shares": amount,
+         "price": prices.get(stock_name),
+         "value": round(amount * prices.get(stock_name, 0), 2)}
+        for stock_name, amount in sorted(shares.items())]
+    cash = round(read_counter(db, "cash"), 2)
+    holdings = round(sum(stock["value"] for stock in stocks), 2)
+    return {
+        "cash": cash, "holdings": holdings,
+        "total": round(cash + holdings, 2), "stocks": stocks}
+
+
+# function to get the users that hold the most of a stock, the index on
+# the stock name and amount makes this read only the top rows
+def top_holders(db, stock_name, limit=10):
+    return list(db.stocks_bought.find(
+        {"stock_name_short": stock_name},
+        {"_id": False, "bought_by": True, "stock_amount": True,
+         "stock_price": True}).sort("stock_amount", DESCENDING).limit(limit))
+
+
+# function to get the top users by "value" or "return_percent"
+def top_users(db, field="value", limit=10):
+    return list(db.leaderboard.find(
+        {}, {"_id": False, "username": True, "value": True,
+             "return_percent": True, "invested": True, "cash": True}
+    ).sort(field, DESCENDING).limit(limit))
+
+
+# function to value all leaderboard rows again at the saved quotes, the
+# worker runs it now and then so the rows follow the prices between
+# trades. A row that a trade changed in between is left alone.
+def mark_leaderboard(db, batch_size=1000):
+    prices = quote_prices(db, db.quotes.distinct("stock_name_short"))
+    updates = []
+    marked = 0
+    for row in db.leaderboard.find(
+            {}, {"username": True, "seq": True, "cash": True, "fees": True,
+                 "positions": True}):
+        updates.append(UpdateOne(
+            {"_id": row["_id"], "seq": row["seq"]},
+            {"$set": leaderboard_row(row["username"], row, prices)}))
+        if len(updates) >= batch_size:
+            marked += db.leaderboard.bulk_write(
+                updates, ordered=False).modified_count
+            updates = []
+    if updates:
+        marked += db.leaderboard.bulk_write(
+            updates, ordered=False).modified_count
+    return marked
+
+
+# function to make all counters (except the fees) and the leaderboard
+# again from the users, their stocks and the ledger. It reads every
+# user, so run it once to start and when nobody trades. A gap in the
+# ledger of a user raises a LedgerGapError.
+def rebuild_aggregates(db):
+    prices = quote_prices(db, db.quotes.distinct("stock_name_short"))
+    rows = []
+    for username in db.users.distinct("username"):
+        if db.position_snapshots.find_one({"username": username}) is None:
+            state = ledger.state_from_db(db, username)
+        else:
+            state = ledger.complete_state(db, username)
+        rows.append(leaderboard_row(username, state, prices))
+    if rows:
+        db.leaderboard.bulk_write([
+            ReplaceOne({"username": row["username"]}, row, upsert=True)
+            for row in rows], ordered=False)
+    db.leaderboard.delete_many(
+        {"username": {"$nin": [row["username"] for row in rows]}})
+
+    set_counter(db, "cash", sum(row["cash"] for row in rows))
+    db.counters.delete_many(SHARES_FILTER)
+    for total in db.stocks_bought.aggregate([
+            {"$group": {
+                "_id": "$stock_name_short",
+                "shares": {"$sum": "$stock_amount"}}}]):
+        set_counter(db, f"shares:{total['_id']}", total["shares"])
+    return len(rows)
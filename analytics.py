@@ -0,0 +1,107 @@
+from datetime import timezone
+import numpy as np
+
+# the number of bars in one year, to make the volatility yearly
+PERIODS_PER_YEAR = {"1d": 252, "1wk": 52, "1mo": 12, "1m": 252 * 390}
+
+
+# function to get the seconds since 1970 of a utc time from MongoDB
+def utc_seconds(moment):
+    return int(moment.replace(tzinfo=timezone.utc).timestamp())
+
+
+# function to turn the trades of a user into numpy arrays. A trade is a
+# dict like the ones in the trades collection.
+def trade_arrays(trades, symbols):
+    column_of = {symbol: column for column, symbol in enumerate(symbols)}
+    trades = [trade for trade in trades if trade["stock_name"] in column_of]
+    times = np.array(
+        [utc_seconds(trade["created_at"]) for trade in trades], dtype=np.int64)
+    columns = np.array(
+        [column_of[trade["stock_name"]] for trade in trades], dtype=np.int64)
+    sides = np.array([trade["side"] == "buy" for trade in trades], dtype=bool)
+    amounts = np.array([trade["amount"] for trade in trades], dtype=np.float64)
+    totals = np.array([trade["total"] for trade in trades], dtype=np.float64)
+    # a buy adds stocks and costs cash, a sell does the opposite
+    signs = np.where(sides, 1.0, -1.0)
+    return times, columns, amounts * signs, -totals * signs
+
+
+# function to work out the value of a portfolio on every bar, with the
+# return, drawdown and volatility. closes is a matrix with a row for
+# every time and a column for every stock, the trades are the arrays of
+# trade_arrays. Everything is done on whole arrays at once.
+def portfolio_history(times, closes, trade_times, trade_columns,
+                      trade_amounts, trade_cash, start_cash=10000,
+                      interval="1d"):
+    count = len(times)
+    if count == 0:
+        return None
+    # a trade counts from the first bar at or after its time
+    rows = np.searchsorted(times, trade_times, side="left")
+    inside = rows < count
+    rows, columns = rows[inside], trade_columns[inside]
+
+    # the number of stocks owned on every bar
+    changes = np.zeros(closes.shape)
+    np.add.at(changes, (rows, columns), trade_amounts[inside])
+    holdings = np.cumsum(changes, axis=0)
+
+    # the cash on every bar
+    cash = start_cash + np.cumsum(
+        np.bincount(rows, weights=trade_cash[inside], minlength=count))
+
+    stock_values = np.nan_to_num(holdings * closes)
+    value = stock_values.sum(axis=1) + cash
+
+    returns = np.zeros(count)
+    returns[1:] = np.divide(
+        value[1:] - value[:-1], value[:-1],
+        out=np.zeros(count - 1), where=value[:-1] != 0)
+    peak = np.maximum.accumulate(value)
+    drawdown = np.divide(
+        value - peak, peak, out=np.zeros(count), where=peak != 0)
+    if count > 2:
+        volatility = float(np.std(returns[1:], ddof=1) * np.sqrt(
+            PERIODS_PER_YEAR.get(interval, 252)))
+    else:
+        volatility = 0.0
+
+    return {
+        "time": times,
+        "value": value,
+        "cash": cash,
+        "returns": returns,
+        "drawdown": drawdown,
+        "summary": {
+            "start_value": float(value[0]),
+            "end_value": float(value[-1]),
+            "total_return": (
+                float(value[-1] / value[0] - 1) if value[0] else 0.0),
+            "max_drawdown": float(drawdown.min()),
+            "volatility": volatility,
+        },
+    }
+
+
+# function to get the analytics of all stocks of a user in one pass
+def user_analytics(db, store, username, interval="1d", start_cash=10000):
+    trades = list(db.trades.find(
+        {"username": username},
+        {"stock_name": True, "side": True, "amount": True, "total": True,
+         "created_at": True}).sort("created_at", 1))
+    if not trades:
+        return None
+    symbols = sorted({trade["stock_name"] for trade in trades})
+    start = utc_seconds(trades[0]["created_at"])
+    times, closes = store.close_matrix(symbols, interval)
+    # only the bars since the first trade, with the bar before it so the
+    # first trade has a price
+    first = max(0, np.searchsorted(times, start, side="right") - 1)
+    result = portfolio_history(
+        times[first:], closes[first:],
+        *trade_arrays(trades, symbols), start_cash=start_cash,
+        interval=interval)
+    if result is not None:
+        result["symbols"] = symbols
+    return result
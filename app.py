@@ -1,58 +1,288 @@
+import click
+import hashlib
+import hmac
 import os
 import re
 import math
+from datetime import datetime, timedelta
 from flask import (
-    Flask, flash, render_template,
-    redirect, request, session, url_for)
+    Flask, Markup, Response, flash, g, jsonify, make_response,
+    render_template, redirect, request, session, stream_with_context,
+    url_for)
 from flask_pymongo import PyMongo
 from bson.objectid import ObjectId
-from werkzeug.security import generate_password_hash, check_password_hash
-from yahoo_fin import stock_info as si
-from yahoofinancials import YahooFinancials as yf
+from pymongo.errors import DuplicateKeyError
+from analytics import PERIODS_PER_YEAR, user_analytics
+from cache import TTLCache
+from catalogue import CatalogueCache, touch_catalogue
+from db_setup import duplicate_key_field, ensure_indexes, print_report
+from hashing import hasher_from_env
+from history import BarStore, sync_history
+from market_data import quote_document, source_from_env
+from metrics import Metrics
+from positions import add_position_values, portfolio_pipeline
+from price_stream import PriceBroadcaster
+from validation import (
+    BUY_FORM, LOGIN_FORM, PROFILE_FORM, REGISTER_FORM, SELL_FORM)
+import aggregates
+import ledger
+import trades
+from order_queue import OrderQueue
 if os.path.exists("env.py"):
     import env
 
 
-# function to check if the email is valide
-# Regex solution sourced from here:
-# https://www.geeksforgeeks.org/check-if-email-address-valid-or-not-in-python/
-def check_email(email):
-    # Check if the email iput matches the email regex.
-    regex = "^[a-z0-9]+[\._]?[a-z0-9]+[@]\w+[.]\w{2,3}$"
-    return re.search(regex, email)
+# function to show all errors of a form to the user, it returns True
+# when there were errors
+def flash_errors(errors):
+    for error in errors:
+        flash(error)
+    return bool(errors)
 
 
-# function to check if the username is valide
-def check_username(name):
-    # check if the username is valide
-    # allow letters and hyphens. No spaces and
-    # a max length of 20 character.
-    regex = "^[a-zA-Z0-9]{5,20}$"
-    return re.match(regex, name)
+app = Flask(__name__)
 
+app.config["MONGO_DBNAME"] = os.environ.get("MONGO_DBNAME")
+app.config["MONGO_URI"] = os.environ.get("MONGO_URI")
+app.secret_key = os.environ.get("SECRET_KEY")
 
-# function to check if the password is valide
-def check_pw(password):
-    # check if the password is valide
-    # allow all characters with a max length of 5-20
-    regex = "^.{5,20}$"
-    return re.match(regex, password)
+# the timings of the requests, MongoDB commands, quote calls and
+# templates, shown on /metrics. Requests slower than SLOW_REQUEST_MS are
+# logged with where their time went. METRICS=0 turns it off.
+metrics = Metrics(slow_request_ms=(
+    float(os.environ["SLOW_REQUEST_MS"])
+    if os.environ.get("SLOW_REQUEST_MS") else None))
+if os.environ.get("METRICS", "1") == "1":
+    metrics.init_app(app)
+    mongo = PyMongo(app, event_listeners=[metrics.mongo_listener])
+else:
+    mongo = PyMongo(app)
+
+
+# function to read the per stock ttl from the env, like "TSLA=5,GOOG=30"
+def read_ttl_per_ticker(setting):
+    ttl_per_ticker = {}
+    for item in (setting or "").split(","):
+        if "=" in item:
+            ticker, seconds = item.split("=", 1)
+            ttl_per_ticker[ticker.strip().upper()] = float(seconds)
+    return ttl_per_ticker
+
+
+# where to get the quotes from when the worker hasn't saved them
+market_source = source_from_env()
+# how many seconds a quote saved by the worker may be used
+QUOTE_MAX_AGE = float(os.environ.get("QUOTE_MAX_AGE", 300))
+
+
+# function to find a quote in the db that is not too old
+def find_saved_quote(stock_name, projection=None):
+    oldest = datetime.utcnow() - timedelta(seconds=QUOTE_MAX_AGE)
+    return mongo.db.quotes.find_one(
+        {"stock_name_short": stock_name, "updated_at": {"$gte": oldest}},
+        projection)
+
+
+# function to get all quote data of a stock. It is read from the quotes
+# collection that worker.py fills, only when that has nothing (the
+# worker isn't running) the data is fetched from Yahoo right away.
+def get_quote(stock_name):
+    quote = find_saved_quote(stock_name)
+    if quote is None:
+        with metrics.quote_call("snapshot"):
+            snapshot = market_source.snapshot(stock_name)
+        quote = quote_document(stock_name, snapshot)
+    return quote
+
+
+# function to get the live price of a stock from the db or from Yahoo
+def fetch_live_price(stock_name):
+    quote = find_saved_quote(stock_name, {"price": True})
+    if quote is not None and quote.get("price") is not None:
+        return quote["price"]
+    with metrics.quote_call("live_price"):
+        return market_source.live_price(stock_name)
+
+
+# one cache for the live stock prices that all routes share, so the
+# same stock isn't fetched from Yahoo over and over again
+price_cache = TTLCache(
+    fetch_live_price,
+    ttl=float(os.environ.get("QUOTE_TTL", 15)),
+    stale_ttl=float(os.environ.get("QUOTE_STALE_TTL", 60)),
+    ttl_per_key=read_ttl_per_ticker(os.environ.get("QUOTE_TTL_PER_TICKER")),
+    max_workers=int(os.environ.get("QUOTE_WORKERS", 8)),
+    wait_timeout=float(os.environ.get("QUOTE_TIMEOUT", 5)))
+
+
+# function to get the live price of a stock by using the cache
+def get_live_price(stock_name):
+    return price_cache.get(stock_name)
+
+
+# function to get the live prices of many stocks at the same time
+def get_live_prices(stock_names):
+    # the prices are fetched in the threads of the cache, this times how
+    # long the request waits on all of them
+    with metrics.quote_call("live_prices"):
+        return price_cache.get_many(
+            stock_names, timeout=float(os.environ.get("QUOTE_TIMEOUT", 5)))
+
+
+# the fields of a user that the pages need, the password hash isn't
+# loaded when it isn't used
+USER_FIELDS = {
+    "username": True, "email": True, "cash": True, "total_spend_fees": True}
+
+
+# function to get the logged in user. The user is loaded from the db
+# one time per request and kept on flask.g, so every part of a route
+# that needs the user shares that one query.
+def get_user():
+    if "user_doc" not in g:
+        g.user_doc = mongo.db.users.find_one(
+            {"username": session["user"]}, USER_FIELDS)
+    return g.user_doc
+
+
+# the token a scraper sends as "Authorization: Bearer <token>" to read
+# the stats of the app, without it only the admin can read them
+STATS_TOKEN = os.environ.get("STATS_TOKEN")
+
+
+# function to check if the request may see the stats of the app, like
+# the cache counters and the timings of production
+def can_see_stats():
+    if session.get("user") == trades.ADMIN_USER:
+        return True
+    return bool(STATS_TOKEN) and hmac.compare_digest(
+        request.headers.get("Authorization", ""), f"Bearer {STATS_TOKEN}")
+
+
+# function to get the total income of the business, from the admin user
+# and the sharded fee counter
+def fetch_business_income(username):
+    return aggregates.business_income(mongo.db, username)
+
+
+# the income of the business only changes by a few cents per trade, so
+# a short cache is fine and saves a query on every admin page load
+income_cache = TTLCache(
+    fetch_business_income,
+    ttl=float(os.environ.get("INCOME_CACHE_TTL", 10)), stale_ttl=0,
+    max_workers=1)
+
+
+# function to get the total amount the business made by fees
+def get_business_income():
+    return income_cache.get("admin")
+
+
+# function to get the values the profile and portfolio pages show of the
+# account of a user, the sync and the async app both use it
+def account_values(user, made_money=None):
+    return {
+        # get the amount of free cash of the user
+        "cash_of_user": round(user["cash"], 2),
+        # get the email adres of the user
+        "user_email": user["email"],
+        # get the total spend amount of cash on fees
+        "send_on_fees": round(user["total_spend_fees"], 2),
+        # the total amount the business made by fees, only for the admin
+        "made_money": None if made_money is None else round(made_money, 2),
+    }
 
 
-# function to check if the number of stocks buy/sell is valide
-def check_stock(number_stocks):
-    # numbers between 1 en 10000 are allowed (not 0)
-    regex = "^([1-9][0-9][0-9]{0,2}|[1-9]|10000)$"
-    return re.match(regex, number_stocks)
+# function to get the values the stock page shows
+def stock_page_values(stock_dic, quote, live_price, cash_of_user):
+    # get the stock price
+    stock_price = round(live_price, 2)
+    # get the stock data for in the table
+    stock_info_first_part = {}
+    stock_info_second_part = {}
+    # make 2 dict of the data
+    for index, (k, v) in enumerate(quote["quote_table"]):
+        if index <= 8:
+            stock_info_first_part[k] = v
+        else:
+            stock_info_second_part[k] = v
+    return {
+        "stock_info_first_part": stock_info_first_part,
+        "stock_info_second_part": stock_info_second_part,
+        "stock_price": stock_price,
+        # the relate percent change since market opening
+        "change_percent_price": quote["change_percent"],
+        "stock_title": stock_dic["stock_name"],
+        # get max amount of stocks you can buy
+        "max_amount": math.floor(int(cash_of_user) / stock_price),
+        "stock_dic": stock_dic,
+        "stock_name": stock_dic["stock_name_short"],
+        "market_status": quote["market_status"],
+        "stock_description": stock_dic["description"],
+    }
 
 
-app = Flask(__name__)
+# function to give the positions without a saved quote their value from
+# the live prices, it returns the positions that have a price
+def price_positions(positions, live_prices):
+    for row in positions:
+        live_price = live_prices.get(row["stock_name_short"])
+        if row["live_price"] is None and live_price is not None:
+            add_position_values(row, live_price)
+    return [row for row in positions if row["live_price"] is not None]
+
+
+# hashes the passwords in other processes, the method and cost are set
+# with PASSWORD_METHOD (like "pbkdf2:sha256:260000") and the number of
+# processes with PASSWORD_PROCESSES
+password_hasher = hasher_from_env()
+
+
+# one poller per worker that sends live prices to all open pages
+price_broadcaster = PriceBroadcaster(
+    get_live_prices, interval=float(os.environ.get("STREAM_INTERVAL", 5)),
+    max_per_user=int(os.environ.get("STREAM_MAX_PER_USER", 5)))
+# the stock names a page may listen to
+STREAM_SYMBOL = re.compile(r"^[A-Z0-9.\-]{1,10}$")
+# the max number of stocks one page may listen to
+STREAM_MAX_SYMBOLS = 20
 
-app.config["MONGO_DBNAME"] = os.environ.get("MONGO_DBNAME")
-app.config["MONGO_URI"] = os.environ.get("MONGO_URI")
-app.secret_key = os.environ.get("SECRET_KEY")
 
-mongo = PyMongo(app)
+# the price bars of all stocks, saved on disk by "flask sync-history"
+bar_store = BarStore(os.environ.get("HISTORY_DIR", "data/history"))
+
+
+# the rendered stock cards of the home page
+catalogue_cache = CatalogueCache(
+    mongo.db, check_ttl=float(os.environ.get("CATALOGUE_CHECK_TTL", 10)))
+# the time the app started, a new version of the app gets new etags
+APP_STARTED = datetime.utcnow().replace(microsecond=0)
+
+
+# when ORDER_QUEUE is turned on the buy and sell routes only queue the
+# order, a background thread executes the orders in batches per stock
+order_queue = None
+if os.environ.get("ORDER_QUEUE", "") == "1":
+    order_queue = OrderQueue(
+        mongo.db, get_live_price,
+        batch_size=int(os.environ.get("ORDER_BATCH_SIZE", 100)),
+        max_wait=float(os.environ.get("ORDER_BATCH_WAIT", 0.05)),
+        recover_after=float(os.environ.get("ORDER_RECOVER_AFTER", 30)))
+    # start right away, so orders that a stopped process left in the db
+    # are done without waiting for a new order
+    order_queue.start()
+
+
+# function to answer a request that queued an order, with json for
+# scripts and a message for the users of the site
+def order_queued(order_id):
+    if request.accept_mimetypes.best == "application/json":
+        return jsonify({
+            "order_id": str(order_id), "status": "queued",
+            "status_url": url_for("order_status", order_id=order_id)}), 202
+    flash(f"Your order {order_id} is queued, check your portfolio " +
+          "in a moment.")
+    return redirect(url_for("portfolio"))
 
 
 # these 2 functions are made with help of:
@@ -71,66 +301,76 @@ def internal_error(error):
 
 @app.route("/")
 def home():
-    stock_dic_info = mongo.db.stock_info.find()
-    stocks = list(stock_dic_info)
-    return render_template(
-        "index.html", stocks=stocks, stock_dic_info=stock_dic_info)
+    logged_in = "user" in session
+    catalogue = None
+    last_modified = APP_STARTED
+    version = "anonymous"
+    # the stocks are only shown to users that are logged in
+    if logged_in:
+        rendered = catalogue_cache.get(lambda categories: Markup(
+            render_template("catalogue.html", categories=categories)))
+        catalogue = rendered["html"]
+        last_modified = max(last_modified, rendered["last_modified"])
+        version = rendered["version"]
+
+    # the page only changes with the catalogue and the login, so the
+    # browser can check it with an etag. A page with a flash message
+    # is always sent in full.
+    etag = hashlib.md5(
+        f"{APP_STARTED}:{version}".encode()).hexdigest()
+    has_messages = bool(session.get("_flashes"))
+    if not has_messages and request.if_none_match.contains(etag):
+        response = make_response("", 304)
+    else:
+        response = make_response(
+            render_template("index.html", catalogue=catalogue))
+    if not has_messages:
+        response.set_etag(etag)
+        response.last_modified = last_modified
+    response.cache_control.no_cache = True
+    if logged_in:
+        response.cache_control.private = True
+    else:
+        response.cache_control.public = True
+    response.vary.add("Cookie")
+    return response.make_conditional(request)
 
 
 @app.route("/register", methods=["GET", "POST"])
 def register():
     if request.method == "POST":
-        # check if the username is valide
-        request_user = request.form.get("username")
-        if request_user == "" or not check_username(request_user.lower()):
-            flash(
-                "Username is not valide. Use between 5-15 character" +
-                " and only letters and numbers.")
-            return redirect(url_for("register"))
-        # check if the email is valide
-        request_mail = request.form.get("email")
-        if request_mail == "" or not check_email(request_mail.lower()):
-            flash("Please fill in a valid email address.")
-            return redirect(url_for("register"))
-        # check if the password is valide
-        request_pw = request.form.get("password")
-        if request_pw == "" or not check_pw(request_pw):
-            flash(
-                "Password is not valid. Use between the 5-15 " +
-                "characters.")
-            return redirect(url_for("register"))
-
-        # make variable to check if email address exists in db
-        existing_email = mongo.db.users.find_one(
-            {"email": request.form.get("email").lower()})
-
-        # make variable to check if username address exists in db
-        existing_user = mongo.db.users.find_one(
-            {"username": request.form.get("username").lower()})
-
-        # check if username already exists in db
-        if existing_user:
-            flash("Username already exists")
-            return redirect(url_for("register"))
-
-        # check if email already exists in db
-        if existing_email:
-            flash("Email already exists")
+        # check the username, email and password
+        form, errors = REGISTER_FORM.validate(request.form)
+        if flash_errors(errors):
             return redirect(url_for("register"))
 
         # put the data from the form in a variable
         register = {
-            "username": request.form.get("username").lower(),
-            "email": request.form.get("email").lower(),
-            "password": generate_password_hash(request.form.get("password")),
+            "username": form["username"],
+            "email": form["email"],
+            "password": password_hasher.hash(form["password"]),
             "cash": 10000,
             "total_spend_fees": 0
         }
-        # push the data from the form to the db
-        mongo.db.users.insert_one(register)
+        # push the data from the form to the db, the unique indexes
+        # make sure the username and email are not used yet
+        try:
+            mongo.db.users.insert_one(register)
+        except DuplicateKeyError as error:
+            if duplicate_key_field(error) == "email":
+                flash("Email already exists")
+            else:
+                flash("Username already exists")
+            return redirect(url_for("register"))
+        # start the trade ledger of the new user
+        ledger.save_snapshot(
+            mongo.db, register["username"], ledger.empty_state())
+        # add the cash of the new user to the platform totals and the
+        # user to the leaderboard
+        aggregates.add_user(mongo.db, register["username"], register["cash"])
 
         # put the new user into 'session' cookie
-        session["user"] = request.form.get("username").lower()
+        session["user"] = form["username"]
         flash("Registration Successful!")
         return redirect(url_for("home", username=session["user"]))
     return render_template("register.html")
@@ -139,27 +379,27 @@ def register():
 @app.route("/login", methods=["GET", "POST"])
 def login():
     if request.method == "POST":
-        # check if the email is valide
-        request_mail = request.form.get("email")
-        if request_mail == "" or not check_email(request_mail.lower()):
-            flash("Please fill in a valid email address.")
-            return redirect(url_for("login"))
-        # check if the password is valide
-        request_pw = request.form.get("password")
-        if request_pw == "" or not check_pw(request_pw):
-            flash(
-                "Password is not valid. use between the 5-15 " +
-                "characters")
+        # check the email and password
+        form, errors = LOGIN_FORM.validate(request.form)
+        if flash_errors(errors):
             return redirect(url_for("login"))
 
         # make variable to check if user exists in db
         # by using the email address
-        existing_user = mongo.db.users.find_one(
-            {"email": request.form.get("email").lower()})
+        existing_user = mongo.db.users.find_one({"email": form["email"]})
 
         if existing_user:
             # ensure hashed password matches user input
-            if check_password_hash(existing_user["password"], request_pw):
+            password_ok, new_hash = password_hasher.check(
+                existing_user["password"], form["password"])
+            if password_ok:
+                # save a new hash when the old one has an older method,
+                # unless the password was changed in the meantime
+                if new_hash is not None:
+                    mongo.db.users.update_one(
+                        {"_id": existing_user["_id"],
+                         "password": existing_user["password"]},
+                        {"$set": {"password": new_hash}})
                 # if the password and email do match then
                 # put the usersname into session cookie
                 session["user"] = existing_user["username"].lower()
@@ -187,306 +427,368 @@ def logout():
 
 @app.route("/profile", methods=["GET", "POST"])
 def profile():
-    # get the amount of free cash of the user
-    cash_of_user_unrounded = mongo.db.users.find_one(
-        {"username": session["user"]})["cash"]
-    cash_of_user = round(cash_of_user_unrounded, 2)
-    # get the email adres of the user
-    user_email = mongo.db.users.find_one(
-        {"username": session["user"]})["email"]
-    # get the total spend amount of cash on fees
-    send_on_fees = round(mongo.db.users.find_one(
-        {"username": session["user"]})["total_spend_fees"], 2)
-    # get the total amount the business made by fees
-    made_money = round(mongo.db.users.find_one(
-        {"username": "admin"})["total_income_business"], 2)
+    # get the data of the user with one query for the whole request
+    user = get_user()
 
     if request.method == "POST":
-        # check if the username is valide
-        request_user = request.form.get("username")
-        if request_user == "" or not check_username(request_user.lower()):
-            flash(
-                "Username is not valide. Use between 5-15 character" +
-                " and only letters and numbers.")
-            return redirect(url_for("profile"))
-        # check if the email is valide
-        request_mail = request.form.get("email")
-        if request_mail == "" or not check_email(request_mail.lower()):
-            flash("Please fill in a valid email address.")
+        # check the username and email
+        edit_profile, errors = PROFILE_FORM.validate(request.form)
+        if flash_errors(errors):
             return redirect(url_for("profile"))
 
-        # make variable to check if email address exists in db
-        existing_email = mongo.db.users.find_one(
-            {"email": request.form.get("email").lower()})
-
-        # make variable to check if username address exists in db
-        existing_user = mongo.db.users.find_one(
-            {"username": request.form.get("username").lower()})
-
         # check if username/email has been changed
-        if request_user == session['user'] and request_mail == user_email:
+        if (edit_profile["username"] == session["user"]
+                and edit_profile["email"] == user["email"]):
             flash("You did not change anything.")
             return redirect(url_for("profile"))
-        # check if user exists in db
-        elif request_user == existing_user and request_user != session['user']:
-            flash("Username already exists.")
-            return redirect(url_for("profile"))
-        # check if email exists in db
-        elif request_mail == existing_email and request_mail != user_email:
-            flash("Email in allready in use.")
-            return redirect(url_for("profile"))
 
-        # put the data from the form in a variable
-        edit_profile = {
-            "username": request.form.get("username").lower(),
-            "email": request.form.get("email").lower(),
-        }
         # push the data from the form to the db
-        mongo.db.users.update_one(
-            {"username": session["user"]}, {'$set': edit_profile})
+        try:
+            mongo.db.users.update_one(
+                {"username": session["user"]}, {'$set': edit_profile})
+        except DuplicateKeyError as error:
+            if duplicate_key_field(error) == "email":
+                flash("Email in allready in use.")
+            else:
+                flash("Username already exists.")
+            return redirect(url_for("profile"))
+
+        # move the stocks, orders, ledger and leaderboard row of the user
+        # to the new username
+        if edit_profile["username"] != session["user"]:
+            mongo.db.stocks_bought.update_many(
+                {"bought_by": session["user"]},
+                {"$set": {"bought_by": edit_profile["username"]}})
+            mongo.db.orders.update_many(
+                {"username": session["user"]},
+                {"$set": {"username": edit_profile["username"]}})
+            aggregates.rename_user(
+                mongo.db, session["user"], edit_profile["username"])
 
         # put the new user into 'session' cookie
-        session["user"] = request.form.get("username").lower()
+        session["user"] = edit_profile["username"]
         flash("Profile successfully edited!")
         return redirect(url_for("profile", username=session["user"]))
 
+    # get the total amount the business made by fees, only the
+    # admin can see this
+    made_money = None
+    if session["user"] == "admin":
+        made_money = get_business_income()
+
     return render_template(
-        "profile.html", cash_of_user=cash_of_user, made_money=made_money,
-        user_email=user_email, send_on_fees=send_on_fees)
+        "profile.html", **account_values(user, made_money))
 
 
 @app.route("/stock/<stock_info_id>", methods=["GET", "POST"])
 def stock_page(stock_info_id):
     stock_dic = mongo.db.stock_info.find_one({"_id": ObjectId(stock_info_id)})
-    for key, value in stock_dic.items():
-        # get the sort stock name from db
-        if key == "stock_name_short":
-            stock_name = value
-        # get the whole stock name from db
-        if key == "stock_name":
-            stock_title = value
-        # get the company description from db
-        if key == "description":
-            stock_description = value
-
-    # get the amount of free cash of the user
-    cash_of_user = mongo.db.users.find_one(
-        {"username": session["user"]})["cash"]
+    # get the sort and the whole stock name from db
+    stock_name = stock_dic["stock_name_short"]
+    stock_title = stock_dic["stock_name"]
     # variable to get the id of the stock
-    get_stock_id = mongo.db.stock_info.find_one(
-        {"stock_name_short": stock_name})["_id"]
-
-    yf2 = yf(stock_name)
-    # get the stock price
-    stock_price = round(si.get_live_price(stock_name), 2)
-    # get max amount of stocks you can buy
-    max_amount = math.floor(int(cash_of_user) / stock_price)
-    # the market close price of a stock
-    close_price = yf2.get_prev_close_price()
-    # the absoluut price change since market opening
-    change_price = yf2.get_current_change()
-    # the relate percent change since market opening
-    change_percent_price = round(change_price*100/close_price, 2)
-    # market status
-    market_status = si.get_market_status()
+    get_stock_id = stock_dic["_id"]
 
-    # get the stock data for in the table
-    stock_table = si.get_quote_table(stock_name)
-    stock_info_first_part = {}
-    stock_info_second_part = {}
-    # make 2 dict of the data
-    for index, (k, v) in enumerate(stock_table.items()):
-        if index <= 8:
-            add_info = {k: v}
-            stock_info_first_part.update(add_info)
-        else:
-            add_info = {k: v}
-            stock_info_second_part.update(add_info)
+    # get the values of the page from the quote that the worker saved in
+    # the db, the live price and the cash of the user
+    values = stock_page_values(
+        stock_dic, get_quote(stock_name), get_live_price(stock_name),
+        get_user()["cash"])
+    stock_price = values["stock_price"]
 
     # code to buy the stocks
     if request.method == "POST":
-        # define variables
-        # the criteria for when the stock is allready bought by the user
-        data_find = {"bought_by": session["user"],
-                     "stock_name_short": stock_name}
-        # the criteria to extract the price of the stock
-        # of the users free cashflow
-        user_of_db = {"username": session["user"]}
-        # the criteria to find the user 'admin'
-        user_is_admin = {"username": "admin"}
+        # check if the number of stock the user wants to buy is valide
+        form, errors = BUY_FORM.validate(request.form)
+        if flash_errors(errors):
+            return redirect(url_for("stock_page", stock_info_id=get_stock_id))
 
         # get the number of stocks bought
-        get_stock_amount = int(request.form.get("stock_total"))
-        # get the number of stocks bought in a string to valide it
-        get_stock_amount_str = request.form.get("stock_total")
-        # get to purchase value of the stocks excl fee
-        price_change = round(stock_price * get_stock_amount, 2)
-        # get amount spend on fee by purchasing a stock
-        spend_on_fee = round(0.5 + (0.003 * price_change), 2)
-        total_spend_stock = round(price_change + spend_on_fee, 2)
-
-        # check if the number of stock the user wants to buy is valide
-        if get_stock_amount_str == "" or not check_stock(get_stock_amount_str):
-            flash("Enter a valide number.")
+        get_stock_amount = form["stock_total"]
+
+        # in queue mode the order is executed later in a batch
+        if order_queue is not None:
+            return order_queued(order_queue.submit_buy(
+                session["user"], stock_name, stock_title, get_stock_amount))
+
+        # buy the stocks, the cash of the user and the stocks are
+        # updated in one go so nothing is lost when users trade at
+        # the same time
+        try:
+            fill = trades.buy(
+                mongo.db, session["user"], stock_name, stock_title,
+                get_stock_amount, stock_price)
+        except trades.TradeError as error:
+            flash(str(error))
             return redirect(url_for("stock_page", stock_info_id=get_stock_id))
 
-        # if user already has the stock, execute this if statement
-        if mongo.db.stocks_bought.count_documents(data_find) == 1:
-            # get the amount of stocks the user allready has
-            stocks_user_has = mongo.db.stocks_bought.find_one(data_find)
-            stocks_owned = stocks_user_has["stock_amount"]
-            # get the price of the amount of stocks the user allready has
-            price_user_paid = mongo.db.stocks_bought.find_one(data_find)
-            stocks_price_own = price_user_paid["stock_price"]
-            # get the changed price per stock
-            changed_price_per_stock = (stocks_price_own + price_change)/(
-                stocks_owned + get_stock_amount)
-
-            # update the new purchase to the db
-            mongo.db.stocks_bought.update_one(data_find, {'$inc': {
-                "stock_price": price_change,
-                "stock_amount": get_stock_amount}, '$set': {
-                "price_per_stock": changed_price_per_stock}})
-
-            # extract the stock buy price of the free cash of user and
-            # add the cash spend on fee to the total spend on fees
-            mongo.db.users.update_one(user_of_db, {'$inc': {
-                "cash": -total_spend_stock,
-                "total_spend_fees": spend_on_fee}})
-
-            # add the fee value to the admin profile to see
-            # how much the website has made so far
-            mongo.db.users.update_one(user_is_admin, {'$inc': {
-                "total_income_business": spend_on_fee}})
-
-            flash(f"You successfully bought {get_stock_amount}" +
-                  f" {stock_name} stocks for ${price_change}")
-            return redirect(url_for("portfolio"))
-        else:
-            # get the price per stock
-            price_per_stock = price_change / get_stock_amount
-
-            # buy the new stock and upload the data to the db
-            stock_bought = {
-                "stock_name_short": stock_name,
-                "stock_name": stock_title,
-                "bought_by": session["user"],
-                "stock_price": price_change,
-                "stock_amount": get_stock_amount,
-                "price_per_stock": price_per_stock
-            }
-            # add new stock to database
-            mongo.db.stocks_bought.insert_one(stock_bought)
-
-            # extract the stock buy price of the free cash of user and
-            # add the cash spend on fee to the total spend on fees
-            mongo.db.users.update_one(user_of_db, {'$inc': {
-                "cash": -total_spend_stock,
-                "total_spend_fees": spend_on_fee}})
-
-            # add the fee value to the admin profile to see
-            # how much the website has made so far
-            mongo.db.users.update_one(user_is_admin, {'$inc': {
-                "total_income_business": spend_on_fee}})
-
-            flash(f"You successfully bought {get_stock_amount} " +
-                  f"{stock_name} stocks for ${price_change}")
-            return redirect(url_for("portfolio"))
-        
-    return render_template(
-        "stock.html", stock_info_first_part=stock_info_first_part,
-        stock_info_second_part=stock_info_second_part, stock_price=stock_price,
-        change_percent_price=change_percent_price, stock_title=stock_title,
-        max_amount=max_amount, stock_dic=stock_dic, stock_name=stock_name,
-        market_status=market_status, stock_description=stock_description)
+        flash(f"You successfully bought {fill['amount']} " +
+              f"{stock_name} stocks for ${fill['value']}")
+        return redirect(url_for("portfolio"))
+
+    return render_template("stock.html", **values)
 
 
 @app.route("/portfolio")
 def portfolio():
-    stocks_bought = list(mongo.db.stocks_bought.find())
-
-    live_prices = {
-        "GOOG": round(si.get_live_price("GOOG"), 2),
-        "TSLA": round(si.get_live_price("TSLA"), 2),
-        "NIO": round(si.get_live_price("NIO"), 2),
-        "FSR": round(si.get_live_price("FSR"), 2),
-        "AMZN": round(si.get_live_price("AMZN"), 2),
-        "AAPL": round(si.get_live_price("AAPL"), 2),
-        "DM": round(si.get_live_price("DM"), 2),
-        "SSYS": round(si.get_live_price("SSYS"), 2),
-        "DDD": round(si.get_live_price("DDD"), 2)
-    }
-
-    # get the amount of free cash of the user
-    cash_of_user_unrounded = mongo.db.users.find_one(
-        {"username": session["user"]})["cash"]
-    cash_of_user = round(cash_of_user_unrounded, 2)
-    # get the email adres of the user
-    user_email = mongo.db.users.find_one(
-        {"username": session["user"]})["email"]
-    # get the total spend amount of cash on fees
-    send_on_fees = round(mongo.db.users.find_one(
-        {"username": session["user"]})["total_spend_fees"], 2)
-    # get the total amount the business made by fees
-    made_money = round(mongo.db.users.find_one(
-        {"username": "admin"})["total_income_business"], 2)
+    # get the stocks of the user with their value and profit/loss
+    positions = list(mongo.db.stocks_bought.aggregate(
+        portfolio_pipeline(session["user"], QUOTE_MAX_AGE)))
+
+    # the stocks without a saved quote get a live price, all at once
+    missing = [
+        row["stock_name_short"] for row in positions
+        if row["live_price"] is None]
+    stocks_bought = price_positions(
+        positions, get_live_prices(missing) if missing else {})
+    if len(stocks_bought) < len(positions):
+        flash("Not all stock prices could be loaded, try again later.")
+
+    # get the total amount the business made by fees, only the
+    # admin can see this
+    made_money = None
+    if session["user"] == "admin":
+        made_money = get_business_income()
 
     return render_template(
-        "portfolio.html", stocks_bought=stocks_bought, made_money=made_money,
-        live_prices=live_prices, cash_of_user=cash_of_user,
-        user_email=user_email, send_on_fees=send_on_fees)
+        "portfolio.html", stocks_bought=stocks_bought,
+        **account_values(get_user(), made_money))
+
+
+@app.route("/portfolio/analytics")
+def portfolio_analytics():
+    # get the value of the portfolio over time with the return, drawdown
+    # and volatility, worked out from the trades and the price bars
+    interval = request.args.get("interval", "1d")
+    if interval not in PERIODS_PER_YEAR:
+        return jsonify({"error": "unknown interval"}), 400
+    result = user_analytics(mongo.db, bar_store, session["user"], interval)
+    if result is None:
+        return jsonify({"summary": None, "series": []})
+    return jsonify({
+        "symbols": result["symbols"],
+        "summary": result["summary"],
+        "series": [
+            {"time": int(moment), "value": round(float(value), 2),
+             "drawdown": round(float(drawdown), 4)}
+            for moment, value, drawdown in zip(
+                result["time"], result["value"], result["drawdown"])],
+    })
+
+
+@app.route("/leaderboard")
+def leaderboard():
+    # the platform totals, the best users and the biggest holders of every
+    # stock, all read from the counters and the leaderboard collection
+    # the page shows the usernames and values of other users, so only
+    # users that are logged in may see it
+    if "user" not in session:
+        return redirect(url_for("login"))
+    size = int(os.environ.get("LEADERBOARD_SIZE", 10))
+    assets = aggregates.assets_under_management(mongo.db, get_live_prices)
+    holders = {
+        stock["stock_name"]: aggregates.top_holders(
+            mongo.db, stock["stock_name"], limit=3)
+        for stock in assets["stocks"]}
+    return render_template(
+        "leaderboard.html", assets=assets,
+        by_value=aggregates.top_users(mongo.db, "value", size),
+        by_return=aggregates.top_users(mongo.db, "return_percent", size),
+        holders=holders)
 
 
 @app.route("/sell/<stocks_bought_id>", methods=["POST"])
 def sell_stocks(stocks_bought_id):
     # find the stock the user wants to sell
     stock_dic = mongo.db.stocks_bought.find_one(
-        {"_id": ObjectId(stocks_bought_id)})
-    for key, value in stock_dic.items():
-        # get the short stock name from db
-        if key == "stock_name_short":
-            stock_name = value
+        {"_id": ObjectId(stocks_bought_id), "bought_by": session["user"]},
+        {"stock_name_short": True})
+    if stock_dic is None:
+        flash("You don't own this stock.")
+        return redirect(url_for("portfolio"))
+    # get the short stock name from db
+    stock_name = stock_dic["stock_name_short"]
+
+    # check if the number of stock the user wants to sell is valide
+    form, errors = SELL_FORM.validate(request.form)
+    if flash_errors(errors):
+        return redirect(url_for("portfolio"))
 
     # get the amount of stocks user wants to sell
-    stocks_sell_amount = int(request.form.get("stocks_sell"))
-    # get the number of stocks bought in a string to valide it
-    stock_buy_check = request.form.get("stocks_sell")
-    # get the live stock price
-    stock_price_live = si.get_live_price(stock_name)
-    # get the sell price of all stocks
-    stock_sell_price = round(stocks_sell_amount * stock_price_live, 2)
+    stocks_sell_amount = form["stocks_sell"]
+    # in queue mode the order is executed later in a batch
+    if order_queue is not None:
+        return order_queued(order_queue.submit_sell(
+            session["user"], stock_name, stock_dic["_id"],
+            stocks_sell_amount))
 
-    # check if the number of stock the user wants to buy is valide
-    if stock_buy_check == "" or not check_stock(stock_buy_check):
-        flash("Enter a valide number.")
+    # get the live stock price
+    stock_price_live = get_live_price(stock_name)
+
+    # sell the stocks, the position and the cash of the user are
+    # updated in one go and an empty position is removed
+    try:
+        fill = trades.sell(
+            mongo.db, session["user"], stock_dic["_id"], stocks_sell_amount,
+            stock_price_live)
+    except trades.TradeError as error:
+        flash(str(error))
         return redirect(url_for("portfolio"))
 
-    # sell the stocks
-    mongo.db.stocks_bought.update_one(stock_dic, {'$inc': {
-        "stock_price": -stock_sell_price,
-        "stock_amount": -stocks_sell_amount}})
-
-    # the criteria to extract the price of the stock
-    # of the users free cashflow
-    user_of_db = {"username": session["user"]}
-    # extract the stock buy price of the free cash of user
-    mongo.db.users.update_one(user_of_db, {'$inc': {
-        "cash": stock_sell_price}})
-
-    # check if the stock file has no more stocks
-    no_stocks = {"_id": ObjectId(stocks_bought_id), "stock_amount": 0}
-    if mongo.db.stocks_bought.count_documents(no_stocks) == 1:
-        mongo.db.stocks_bought.remove({"_id": ObjectId(stocks_bought_id)})
-        flash(f"You successfully sold {stocks_sell_amount} {stock_name} " +
-              f"stocks for ${stock_sell_price}")
-        return redirect(url_for("portfolio"))
-    else:
-        flash(f"You successfully sold {stocks_sell_amount} {stock_name} " +
-              f"stocks for ${stock_sell_price}")
-        return redirect(url_for("portfolio"))
+    flash(f"You successfully sold {stocks_sell_amount} {stock_name} " +
+          f"stocks for ${fill['value']}")
+    return redirect(url_for("portfolio"))
+
+
+@app.route("/order/<order_id>")
+def order_status(order_id):
+    # show the status of a queued order of the user
+    if order_queue is None or not ObjectId.is_valid(order_id):
+        return jsonify({"error": "order not found"}), 404
+    order = order_queue.status(order_id, session["user"])
+    if order is None:
+        return jsonify({"error": "order not found"}), 404
+    order["_id"] = str(order["_id"])
+    return jsonify(order)
+
+
+@app.route("/stream/prices")
+def price_stream():
+    # send the live prices of the stocks to the page as they change
+    if "user" not in session:
+        return jsonify({"error": "log in to get live prices"}), 401
+    symbols = {
+        symbol for symbol in request.args.get("symbols", "").upper().split(",")
+        if STREAM_SYMBOL.match(symbol)}
+    if not symbols or len(symbols) > STREAM_MAX_SYMBOLS:
+        return jsonify({"error": "give between 1 and 20 symbols"}), 400
+    # only the stocks of the site, so nobody makes us poll any symbol
+    symbols = set(mongo.db.stock_info.distinct(
+        "stock_name_short", {"stock_name_short": {"$in": list(symbols)}}))
+    if not symbols:
+        return jsonify({"error": "none of the symbols is a stock here"}), 400
+    subscription = price_broadcaster.subscribe(symbols, session["user"])
+    if subscription is None:
+        return jsonify({"error": "too many open price streams"}), 429
+    response = Response(
+        stream_with_context(price_broadcaster.events(subscription)),
+        mimetype="text/event-stream")
+    response.headers["Cache-Control"] = "no-cache"
+    response.headers["X-Accel-Buffering"] = "no"
+    return response
+
+
+@app.route("/stream/stats")
+def price_stream_stats():
+    # show the open and idle price stream connections of this worker
+    if not can_see_stats():
+        return jsonify({"error": "only the admin can see this"}), 403
+    return jsonify(price_broadcaster.stats())
+
+
+@app.route("/metrics")
+def metrics_page():
+    # show the timing histograms in the prometheus text format, a
+    # scraper sends the STATS_TOKEN
+    if not can_see_stats():
+        return jsonify({"error": "only the admin can see this"}), 403
+    return Response(
+        metrics.render(), mimetype="text/plain; version=0.0.4")
+
+
+@app.route("/quote-stats")
+def quote_stats():
+    # show the hit/miss/latency counters of the price cache
+    if not can_see_stats():
+        return jsonify({"error": "only the admin can see this"}), 403
+    return jsonify(price_cache.stats())
+
+
+@app.cli.command("init-db")
+def init_db():
+    # create the indexes and show how the hot queries are run
+    ensure_indexes(mongo.db)
+    print_report(mongo.db)
+
+
+@app.cli.command("touch-catalogue")
+def touch_catalogue_command():
+    # render the stock cards of the home page again, run it after
+    # stock_info was changed by hand
+    touch_catalogue(mongo.db)
+    catalogue_cache.invalidate()
+
+
+@app.cli.command("sync-history")
+@click.option("--interval", default="1d", help="1m, 1d, 1wk or 1mo")
+@click.option("--start", default=None, help="first date, like 2020-01-31")
+def sync_history_command(interval, start):
+    # fetch the price bars of all stocks and save them in the bar store
+    symbols = mongo.db.stock_info.distinct("stock_name_short")
+    saved = sync_history(bar_store, market_source, symbols, interval, start)
+    for symbol, count in saved.items():
+        print(f"{symbol}: {count} bars")
+
+
+@app.cli.command("open-ledger")
+def open_ledger_command():
+    # start the ledger of the users that were made before the ledger,
+    # run it while nobody trades
+    for username in mongo.db.users.distinct("username"):
+        if ledger.open_ledger(mongo.db, username) is not None:
+            print(f"opened the ledger of {username}")
+
+
+@app.cli.command("repair-ledger")
+def repair_ledger_command():
+    # save the trades that failed to save in the ledger after they were
+    # done, the worker does this too
+    repaired = aggregates.repair_ledger(mongo.db)
+    print(f"repaired {repaired} failed trade saves")
+
+
+@app.cli.command("rebuild-positions")
+@click.option("--user", default=None, help="only rebuild this user")
+def rebuild_positions_command(user):
+    # write the cash and positions of the users again from the ledger,
+    # nothing is written when a trade is missing in the ledger
+    try:
+        if user is not None:
+            states = {user: ledger.rebuild_user(mongo.db, user)}
+        else:
+            states = ledger.rebuild_all(mongo.db, trades.ADMIN_USER)
+            # the income of the admin now has all fees
+            aggregates.set_counter(mongo.db, "fees", 0)
+    except ledger.LedgerGapError as error:
+        raise click.ClickException(
+            f"{error}, run 'flask repair-ledger' first")
+    for username, state in states.items():
+        if state is None:
+            print(f"{username}: no ledger, run 'flask open-ledger' first")
+        else:
+            print(f"{username}: ${state['cash']:.2f} cash, "
+                  f"{len(state['positions'])} positions, "
+                  f"{state['seq']} trades")
+    # the cash and stocks changed, so the platform totals too
+    aggregates.rebuild_aggregates(mongo.db)
+
+
+@app.cli.command("rebuild-aggregates")
+def rebuild_aggregates_command():
+    # make the leaderboard and the platform counters again from the users
+    # and their stocks, run it once to start and while nobody trades
+    try:
+        users = aggregates.rebuild_aggregates(mongo.db)
+    except ledger.LedgerGapError as error:
+        raise click.ClickException(
+            f"{error}, run 'flask repair-ledger' first")
+    assets = aggregates.assets_under_management(mongo.db)
+    print(f"{users} users on the leaderboard, ${assets['total']:.2f} "
+          f"under management")
 
 
 if __name__ == "__main__":
+    ensure_indexes(mongo.db)
     app.run(host=os.environ.get("IP"),
             port=int(os.environ.get("PORT")),
             debug=False)
@@ -0,0 +1,222 @@
+# The async serving mode of the site. The pages that mostly wait on
+# MongoDB and on quotes (stock page, portfolio and profile) are served by
+# async Quart routes with Motor, so one worker can wait on many requests
+# at the same time. Every other route is served by the flask app of
+# app.py, that runs in a thread, so both modes share one code base.
+# Start it with its own entry point:
+#   pip install -r requirements-async.txt
+#   python asgi.py          (or: hypercorn asgi:application)
+import asyncio
+import os
+from datetime import datetime, timedelta
+from asgiref.wsgi import WsgiToAsgi
+from bson.objectid import ObjectId
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo.errors import ConfigurationError
+from quart import Quart, abort, flash, g, render_template, session
+from werkzeug.exceptions import HTTPException
+import app as sync_app
+from aggregates import counter_filter, counter_totals
+from cache import AsyncTTLCache
+from market_data import quote_document
+from positions import portfolio_pipeline
+
+quart_app = Quart(__name__)
+quart_app.secret_key = sync_app.app.secret_key
+# the flask app as an asgi app, for the routes that aren't async
+flask_app = WsgiToAsgi(sync_app.app)
+# the endpoints and methods the async app serves
+ASYNC_ROUTES = {
+    ("stock_page", "GET"),
+    ("portfolio", "GET"),
+    ("profile", "GET"),
+}
+# the async db, it is made when the server starts so it uses its loop
+db = None
+
+
+# function to connect to the same database as the flask app
+@quart_app.before_serving
+async def connect_db():
+    global db
+    client = AsyncIOMotorClient(os.environ.get("MONGO_URI"))
+    try:
+        db = client.get_default_database()
+    except ConfigurationError:
+        # the uri has no database name in it
+        db = client[os.environ.get("MONGO_DBNAME")]
+
+
+# function to find a quote in the db that is not too old
+async def find_saved_quote(stock_name, projection=None):
+    oldest = datetime.utcnow() - timedelta(seconds=sync_app.QUOTE_MAX_AGE)
+    return await db.quotes.find_one(
+        {"stock_name_short": stock_name, "updated_at": {"$gte": oldest}},
+        projection)
+
+
+# function to get all quote data of a stock, from the db or the source
+async def get_quote(stock_name):
+    quote = await find_saved_quote(stock_name)
+    if quote is None:
+        quote = quote_document(
+            stock_name,
+            await sync_app.market_source.snapshot_async(stock_name))
+    return quote
+
+
+# function to get the live price of a stock from the db or the source
+async def fetch_live_price(stock_name):
+    quote = await find_saved_quote(stock_name, {"price": True})
+    if quote is not None and quote.get("price") is not None:
+        return quote["price"]
+    return await sync_app.market_source.live_price_async(stock_name)
+
+
+# the async version of the price cache, with the same settings
+price_cache = AsyncTTLCache(
+    fetch_live_price, ttl=sync_app.price_cache.ttl,
+    stale_ttl=sync_app.price_cache.stale_ttl,
+    ttl_per_key=sync_app.price_cache.ttl_per_key)
+
+
+# function to get the total income of the business, from the admin user
+# and the sharded fee counter
+async def fetch_business_income(username):
+    user, shards = await asyncio.gather(
+        db.users.find_one(
+            {"username": username}, {"total_income_business": True}),
+        db.counters.find(counter_filter("fees")).to_list(None))
+    return user["total_income_business"] + counter_totals(shards).get(
+        "fees", 0)
+
+
+income_cache = AsyncTTLCache(
+    fetch_business_income, ttl=sync_app.income_cache.ttl, stale_ttl=0)
+
+
+# function to get the logged in user, one query per request
+async def get_user():
+    if "user_doc" not in g:
+        g.user_doc = await db.users.find_one(
+            {"username": session["user"]}, sync_app.USER_FIELDS)
+    return g.user_doc
+
+
+# function to get the total amount the business made by fees, only the
+# admin can see this
+async def get_made_money():
+    if session["user"] != "admin":
+        return None
+    return await income_cache.get("admin")
+
+
+# the same error pages as the flask app
+@quart_app.errorhandler(404)
+async def not_found_error(error):
+    return await render_template("404.html"), 404
+
+
+@quart_app.errorhandler(500)
+async def internal_error(error):
+    return await render_template("500.html"), 500
+
+
+async def stock_page(stock_info_id):
+    # function to get the stock and then its quote and live price
+    async def load_stock():
+        stock_dic = await db.stock_info.find_one(
+            {"_id": ObjectId(stock_info_id)})
+        if stock_dic is None:
+            abort(404)
+        quote, live_price = await asyncio.gather(
+            get_quote(stock_dic["stock_name_short"]),
+            price_cache.get(stock_dic["stock_name_short"]))
+        return stock_dic, quote, live_price
+
+    # the user and the stock don't depend on each other, wait on both
+    user, (stock_dic, quote, live_price) = await asyncio.gather(
+        get_user(), load_stock())
+    return await render_template(
+        "stock.html", **sync_app.stock_page_values(
+            stock_dic, quote, live_price, user["cash"]))
+
+
+async def portfolio():
+    positions, user, made_money = await asyncio.gather(
+        db.stocks_bought.aggregate(portfolio_pipeline(
+            session["user"], sync_app.QUOTE_MAX_AGE)).to_list(None),
+        get_user(), get_made_money())
+
+    # the stocks without a saved quote get a live price, all at once
+    missing = [
+        row["stock_name_short"] for row in positions
+        if row["live_price"] is None]
+    live_prices = {}
+    if missing:
+        live_prices = await price_cache.get_many(
+            missing, timeout=float(os.environ.get("QUOTE_TIMEOUT", 5)))
+    stocks_bought = sync_app.price_positions(positions, live_prices)
+    if len(stocks_bought) < len(positions):
+        await flash("Not all stock prices could be loaded, try again later.")
+
+    return await render_template(
+        "portfolio.html", stocks_bought=stocks_bought,
+        **sync_app.account_values(user, made_money))
+
+
+async def profile():
+    user, made_money = await asyncio.gather(get_user(), get_made_money())
+    return await render_template(
+        "profile.html", **sync_app.account_values(user, made_money))
+
+
+# the view of a route that the flask app serves, it is never called but
+# the route has to be known for url_for in the templates
+async def served_by_flask(**kwargs):
+    abort(404)
+
+
+ASYNC_VIEWS = {
+    "stock_page": stock_page,
+    "portfolio": portfolio,
+    "profile": profile,
+}
+# add every route of the flask app, with the same url and endpoint
+for rule in sync_app.app.url_map.iter_rules():
+    if rule.endpoint != "static":
+        quart_app.add_url_rule(
+            rule.rule, rule.endpoint,
+            ASYNC_VIEWS.get(rule.endpoint, served_by_flask),
+            methods=rule.methods - {"HEAD", "OPTIONS"})
+routes = quart_app.url_map.bind("")
+
+
+# function to see if a request is for the async app
+def is_async_route(scope):
+    method = "GET" if scope["method"] == "HEAD" else scope["method"]
+    try:
+        endpoint, arguments = routes.match(scope["path"], method)
+    except HTTPException:
+        return False
+    return (endpoint, method) in ASYNC_ROUTES
+
+
+# the asgi app of the site, it sends every request to the async app or
+# to the flask app
+async def application(scope, receive, send):
+    if scope["type"] == "http" and not is_async_route(scope):
+        await flask_app(scope, receive, send)
+    else:
+        await quart_app(scope, receive, send)
+
+
+if __name__ == "__main__":
+    from hypercorn.asyncio import serve
+    from hypercorn.config import Config
+
+    sync_app.ensure_indexes(sync_app.mongo.db)
+    config = Config()
+    config.bind = [
+        f"{os.environ.get('IP', '0.0.0.0')}:{os.environ.get('PORT', 5000)}"]
+    asyncio.run(serve(application, config))
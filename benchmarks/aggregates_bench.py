@@ -0,0 +1,77 @@
+# Compares the platform stats read from the counters and the leaderboard
+# collection with working them out by scanning all users and stocks. For
+# every number of users it seeds the benchmark db and times the assets
+# under management, the top users by value and the top holders of a
+# stock both ways. The reads of the materialized views should stay flat
+# when the number of users grows.
+#   python benchmarks/aggregates_bench.py --users 100,1000,10000
+import argparse
+import time
+from pymongo import MongoClient
+from common import BENCH_MONGO_URI, seed
+from db_setup import ensure_indexes
+import aggregates
+
+
+# function to work out the stats by reading every user and every stock
+def scan_stats(db, prices, stock_name, limit):
+    cash = 0
+    values = {}
+    for user in db.users.find({}, {"username": True, "cash": True}):
+        cash += user["cash"]
+        values[user["username"]] = user["cash"]
+    holdings = 0
+    holders = []
+    for position in db.stocks_bought.find():
+        value = position["stock_amount"] * prices.get(
+            position["stock_name_short"], 0)
+        holdings += value
+        values[position["bought_by"]] = (
+            values.get(position["bought_by"], 0) + value)
+        if position["stock_name_short"] == stock_name:
+            holders.append(position)
+    top = sorted(values.items(), key=lambda item: item[1], reverse=True)
+    holders.sort(key=lambda position: position["stock_amount"], reverse=True)
+    return cash + holdings, top[:limit], holders[:limit]
+
+
+# function to read the stats from the counters and the leaderboard
+def view_stats(db, stock_name, limit):
+    return (
+        aggregates.assets_under_management(db)["total"],
+        aggregates.top_users(db, "value", limit),
+        aggregates.top_holders(db, stock_name, limit))
+
+
+# function to get the average seconds of a function over some runs
+def timed(function, runs):
+    started = time.perf_counter()
+    for _ in range(runs):
+        function()
+    return (time.perf_counter() - started) / runs
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--users", default="100,1000,10000")
+    parser.add_argument("--holdings", type=int, default=3)
+    parser.add_argument("--runs", type=int, default=20)
+    parser.add_argument("--top", type=int, default=10)
+    args = parser.parse_args()
+
+    db = MongoClient(BENCH_MONGO_URI).get_default_database()
+    print(f"{'users':>7} {'scan':>10} {'views':>10}")
+    for users in map(int, args.users.split(",")):
+        seed(db, users=users, holdings_per_user=args.holdings)
+        ensure_indexes(db)
+        stock_name = db.stocks_bought.find_one()["stock_name_short"]
+        prices = aggregates.quote_prices(
+            db, db.stock_info.distinct("stock_name_short"))
+        scan = timed(
+            lambda: scan_stats(db, prices, stock_name, args.top), args.runs)
+        views = timed(lambda: view_stats(db, stock_name, args.top), args.runs)
+        print(f"{users:7} {scan * 1000:8.1f}ms {views * 1000:8.1f}ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,136 @@
+# Compares the sync flask app (python app.py) with the async serving
+# mode (python asgi.py) when the quote source is slow. Both servers use
+# the fake quote source with a delay on every call and no price cache, so
+# every stock page waits on the "upstream". For every number of parallel
+# clients it reports the requests per second and the p99 latency, and at
+# the end the most requests per second each mode did within the latency
+# limit:
+#   pip install -r requirements-async.txt
+#   python benchmarks/async_compare.py --delay 0.2 --latency 1.0
+import argparse
+import os
+import subprocess
+import sys
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from pymongo import MongoClient
+from common import BENCH_MONGO_URI, ROOT, seed
+
+MODES = {
+    "sync": [sys.executable, "app.py"],
+    "async": [sys.executable, "asgi.py"],
+}
+
+
+# a redirect handler that doesn't follow redirects, to keep the cookie
+# of the login
+class NoRedirect(urllib.request.HTTPRedirectHandler):
+
+    def redirect_request(self, *args, **kwargs):
+        return None
+
+
+# function to start a server and wait until it answers
+def start_server(mode, port, delay):
+    env = dict(
+        os.environ, MONGO_URI=BENCH_MONGO_URI, SECRET_KEY="benchmark",
+        QUOTE_SOURCE="fake", QUOTE_DELAY=str(delay), QUOTE_TTL="0",
+        QUOTE_STALE_TTL="0", IP="127.0.0.1", PORT=str(port))
+    server = subprocess.Popen(
+        MODES[mode], cwd=ROOT, env=env, stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL)
+    for _ in range(100):
+        try:
+            urllib.request.urlopen(f"http://127.0.0.1:{port}/login")
+            return server
+        except (urllib.error.URLError, ConnectionError):
+            time.sleep(0.2)
+    server.kill()
+    raise SystemExit(f"the {mode} server didn't start")
+
+
+# function to log in and get the session cookie
+def log_in(port):
+    opener = urllib.request.build_opener(NoRedirect)
+    form = urllib.parse.urlencode(
+        {"email": "user0@example.com", "password": "benchmark"}).encode()
+    try:
+        opener.open(f"http://127.0.0.1:{port}/login", data=form)
+    except urllib.error.HTTPError as response:
+        return response.headers["Set-Cookie"].split(";")[0]
+    raise SystemExit("the login didn't redirect")
+
+
+# function to get pages with a number of parallel clients for some
+# seconds, it returns the requests per second and the latencies
+def run_clients(urls, cookie, clients, seconds):
+    stop = time.monotonic() + seconds
+    latencies = []
+    errors = []
+
+    def client(number):
+        while time.monotonic() < stop:
+            url = urls[(number + len(latencies)) % len(urls)]
+            request = urllib.request.Request(url, headers={"Cookie": cookie})
+            started = time.perf_counter()
+            try:
+                urllib.request.urlopen(request).read()
+                latencies.append(time.perf_counter() - started)
+            except Exception:
+                errors.append(1)
+
+    threads = [
+        threading.Thread(target=client, args=(number,))
+        for number in range(clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    latencies.sort()
+    return len(latencies) / seconds, latencies, len(errors)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--delay", type=float, default=0.2,
+                        help="seconds every quote call waits")
+    parser.add_argument("--latency", type=float, default=1.0,
+                        help="the p99 latency limit in seconds")
+    parser.add_argument("--seconds", type=float, default=10)
+    parser.add_argument("--clients", default="1,4,16,64")
+    parser.add_argument("--port", type=int, default=5099)
+    args = parser.parse_args()
+
+    db = MongoClient(BENCH_MONGO_URI).get_default_database()
+    seed(db, users=1)
+    urls = [
+        f"http://127.0.0.1:{args.port}/stock/{stock['_id']}"
+        for stock in db.stock_info.find({}, {"_id": True})]
+
+    best = {}
+    for mode in MODES:
+        server = start_server(mode, args.port, args.delay)
+        try:
+            cookie = log_in(args.port)
+            for clients in map(int, args.clients.split(",")):
+                rate, latencies, errors = run_clients(
+                    urls, cookie, clients, args.seconds)
+                p99 = latencies[int(len(latencies) * 0.99)] if latencies else 0
+                print(f"{mode:5} {clients:3} clients: {rate:7.1f} req/s, "
+                      f"p99 {p99 * 1000:7.1f}ms, {errors} errors")
+                if latencies and p99 <= args.latency:
+                    best[mode] = max(best.get(mode, 0), rate)
+        finally:
+            server.terminate()
+            server.wait()
+
+    for mode in MODES:
+        print(f"{mode}: {best.get(mode, 0):.1f} req/s with p99 under "
+              f"{args.latency * 1000:.0f}ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,68 @@
+# Load test of logins next to normal page requests. Some threads log in
+# all the time while one thread opens the profile page, it reports the
+# logins per second and the latency of the profile page. Run it with
+# and without the process pool to see the difference:
+#   PASSWORD_PROCESSES=0 python benchmarks/auth_load.py
+#   PASSWORD_PROCESSES=4 python benchmarks/auth_load.py
+import argparse
+import threading
+import time
+from common import load_app, logged_in_client, seed
+
+
+# function to get a percentile of a sorted list
+def percentile(values, percent):
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(len(values) * percent / 100))]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--seconds", type=float, default=10)
+    parser.add_argument("--login-threads", type=int, default=8)
+    args = parser.parse_args()
+
+    app = load_app()
+    seed(app.mongo.db, users=args.login_threads)
+    stop = threading.Event()
+    logins = []
+    page_times = []
+
+    def log_in(number):
+        client = app.app.test_client()
+        form = {"email": f"user{number}@example.com", "password": "benchmark"}
+        while not stop.is_set():
+            response = client.post("/login", data=form)
+            if response.status_code == 302:
+                logins.append(1)
+
+    def open_pages():
+        client = logged_in_client(app.app, "user0")
+        while not stop.is_set():
+            started = time.perf_counter()
+            client.get("/profile")
+            page_times.append(time.perf_counter() - started)
+
+    threads = [
+        threading.Thread(target=log_in, args=(number,))
+        for number in range(args.login_threads)]
+    threads.append(threading.Thread(target=open_pages))
+    for thread in threads:
+        thread.start()
+    time.sleep(args.seconds)
+    stop.set()
+    for thread in threads:
+        thread.join()
+
+    page_times.sort()
+    print(f"hasher: {app.password_hasher.method}, "
+          f"{app.password_hasher.processes} processes")
+    print(f"logins: {len(logins) / args.seconds:.1f}/s")
+    print(f"profile page: {len(page_times)} requests, "
+          f"p50 {percentile(page_times, 50) * 1000:.1f}ms, "
+          f"p99 {percentile(page_times, 99) * 1000:.1f}ms")
+
+
+if __name__ == "__main__":
+    main()
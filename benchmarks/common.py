@@ -0,0 +1,121 @@
+import os
+import sys
+import threading
+from pymongo import monitoring
+
+# the benchmarks import the app from the folder above this one
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+# the benchmarks use their own database, so real data is never touched
+BENCH_MONGO_URI = os.environ.get(
+    "BENCH_MONGO_URI", "mongodb://localhost:27017/ri_benchmark")
+
+# the stocks the app has on the home page
+STOCKS = [
+    ("GOOG", "Alphabet Inc.", "big tech"),
+    ("TSLA", "Tesla, Inc.", "electric/hybrid cars"),
+    ("NIO", "NIO Inc.", "electric/hybrid cars"),
+    ("FSR", "Fisker Inc.", "electric/hybrid cars"),
+    ("AMZN", "Amazon.com, Inc.", "big tech"),
+    ("AAPL", "Apple Inc.", "big tech"),
+    ("DM", "Desktop Metal, Inc.", "3d-printing"),
+    ("SSYS", "Stratasys Ltd.", "3d-printing"),
+    ("DDD", "3D Systems Corporation", "3d-printing"),
+]
+
+
+# function to get a number of stocks, the stocks of the app first and
+# made up ones in the same categories after them
+def make_stocks(count):
+    stocks = STOCKS[:count]
+    for number in range(len(stocks), count):
+        category = STOCKS[number % len(STOCKS)][2]
+        stocks.append(
+            (f"SYM{number:04d}", f"Symbol {number} Inc.", category))
+    return stocks
+
+
+# a pymongo listener that counts the commands sent to the db
+class CommandCounter(monitoring.CommandListener):
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counts = {}
+
+    def started(self, event):
+        with self.lock:
+            self.counts[event.command_name] = (
+                self.counts.get(event.command_name, 0) + 1)
+
+    def succeeded(self, event):
+        pass
+
+    def failed(self, event):
+        pass
+
+    # function to get the total number of commands and start again
+    def reset(self):
+        with self.lock:
+            counts, self.counts = self.counts, {}
+        return counts
+
+
+# function to load the app against the benchmark db with fake quotes.
+# The counter has to be registered before the app makes its client.
+def load_app(counter=None):
+    os.environ["MONGO_URI"] = BENCH_MONGO_URI
+    os.environ.setdefault("QUOTE_SOURCE", "fake")
+    os.environ.setdefault("SECRET_KEY", "benchmark")
+    if counter is not None:
+        monitoring.register(counter)
+    import app
+    return app
+
+
+# function to fill the benchmark db with stocks and users
+def seed(db, users=10, holdings_per_user=3, cash=10000, stocks=STOCKS):
+    from werkzeug.security import generate_password_hash
+    from aggregates import rebuild_aggregates
+    from catalogue import touch_catalogue
+
+    for collection in ("users", "stock_info", "stocks_bought", "quotes",
+                       "trades", "counters", "position_snapshots", "orders",
+                       "leaderboard"):
+        db[collection].delete_many({})
+    db.stock_info.insert_many([
+        {"stock_name_short": short, "stock_name": name, "category": category,
+         "description": f"{name} description",
+         "description_short": f"{name} short description",
+         "photo_link": ""}
+        for short, name, category in stocks])
+    touch_catalogue(db)
+    password = generate_password_hash("benchmark")
+    db.users.insert_one({
+        "username": "admin", "email": "admin@example.com",
+        "password": password, "cash": cash, "total_spend_fees": 0,
+        "total_income_business": 0})
+    db.users.insert_many([
+        {"username": f"user{number}", "email": f"user{number}@example.com",
+         "password": password, "cash": cash, "total_spend_fees": 0}
+        for number in range(users)])
+    holdings = []
+    for number in range(users):
+        for short, name, category in stocks[:holdings_per_user]:
+            holdings.append({
+                "stock_name_short": short, "stock_name": name,
+                "bought_by": f"user{number}", "stock_price": 100.0,
+                "stock_amount": 1, "price_per_stock": 100.0})
+    if holdings:
+        db.stocks_bought.insert_many(holdings)
+    # the leaderboard and platform counters of the seeded users
+    rebuild_aggregates(db)
+
+
+# function to make a test client that is logged in as a user
+def logged_in_client(flask_app, username):
+    client = flask_app.test_client()
+    with client.session_transaction() as session:
+        session["user"] = username
+    return client
@@ -0,0 +1,44 @@
+# Counts the MongoDB commands every page sends for one request:
+#   python benchmarks/db_roundtrips.py
+# To compare two commits that both have this script, run it on each of
+# them. The script came with the change that loads the user once per
+# request, so there is no script to run on the commit before it. The
+# "before" numbers of that change were counted from the code of the
+# routes at that commit (one command per find_one/aggregate, the quotes
+# and live price come from the caches on the second request):
+#   profile     4 (four find_one on users)
+#   portfolio   5 (the aggregate and four find_one on users)
+#   stock page  4 (two find_one on stock_info, one on users and one on
+#                  quotes)
+from common import CommandCounter, load_app, logged_in_client, seed
+
+
+def main():
+    counter = CommandCounter()
+    app = load_app(counter)
+    db = app.mongo.db
+    seed(db, users=3)
+    stock_id = db.stock_info.find_one({"stock_name_short": "TSLA"})["_id"]
+
+    pages = [
+        ("profile", "/profile"),
+        ("portfolio", "/portfolio"),
+        ("stock page", f"/stock/{stock_id}"),
+    ]
+    for username in ("user0", "admin"):
+        client = logged_in_client(app.app, username)
+        for name, url in pages:
+            # the first request fills the caches, count the second one
+            client.get(url)
+            counter.reset()
+            response = client.get(url)
+            counts = counter.reset()
+            detail = ", ".join(
+                f"{command}={count}" for command, count in sorted(
+                    counts.items()))
+            print(f"{username:6} {name:11} status={response.status_code} "
+                  f"round-trips={sum(counts.values())} ({detail})")
+
+
+if __name__ == "__main__":
+    main()
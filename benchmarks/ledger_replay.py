@@ -0,0 +1,76 @@
+# Benchmark of rebuilding positions from the trade ledger. It makes a
+# ledger of random trades in memory and times a full replay against a
+# replay of only the tail after the newest snapshot:
+#   python benchmarks/ledger_replay.py --trades 2000000
+import argparse
+import copy
+import random
+import time
+from common import STOCKS
+import ledger
+
+
+# function to make a ledger of random trades of one user that are all
+# possible, so the replay never has to skip a trade
+def make_trades(count, seed_number=1):
+    rng = random.Random(seed_number)
+    stock_names = [short for short, name, category in STOCKS]
+    owned = dict.fromkeys(stock_names, 0)
+    trades = []
+    for seq in range(1, count + 1):
+        stock_name = rng.choice(stock_names)
+        price = rng.uniform(10, 500)
+        if owned[stock_name] and rng.random() < 0.4:
+            amount = rng.randint(1, owned[stock_name])
+            value = round(price * amount, 2)
+            trades.append({
+                "seq": seq, "side": "sell", "stock_name": stock_name,
+                "amount": amount, "value": value, "fee": 0, "total": value})
+            owned[stock_name] -= amount
+        else:
+            amount = rng.randint(1, 20)
+            value = round(price * amount, 2)
+            fee = round(0.5 + 0.003 * value, 2)
+            trades.append({
+                "seq": seq, "side": "buy", "stock_name": stock_name,
+                "amount": amount, "value": value, "fee": fee,
+                "total": round(value + fee, 2)})
+            owned[stock_name] += amount
+    return trades
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--trades", type=int, default=2000000)
+    parser.add_argument("--snapshot-every", type=int,
+                        default=ledger.SNAPSHOT_EVERY)
+    args = parser.parse_args()
+
+    print(f"making {args.trades} trades...")
+    trades = make_trades(args.trades)
+
+    started = time.monotonic()
+    full = ledger.replay(ledger.empty_state(), trades)
+    took = time.monotonic() - started
+    print(f"full replay:  {took:.2f}s ({len(trades) / took:,.0f} trades/s)")
+
+    # the worst case, the newest snapshot is just short of the next one
+    snapshot_at = max(0, len(trades) - args.snapshot_every + 1)
+    snapshot = ledger.replay(ledger.empty_state(), trades[:snapshot_at])
+    snapshot = copy.deepcopy(snapshot)
+    tail = trades[snapshot_at:]
+    started = time.monotonic()
+    from_snapshot = ledger.replay(snapshot, tail)
+    took = time.monotonic() - started
+    print(f"tail replay:  {took * 1000:.2f}ms ({len(tail)} trades after "
+          f"the snapshot)")
+
+    if (round(full["cash"], 2) != round(from_snapshot["cash"], 2)
+            or full["seq"] != from_snapshot["seq"]):
+        raise SystemExit("the snapshot replay doesn't match the full replay")
+    print(f"both give ${full['cash']:.2f} cash and "
+          f"{len(full['positions'])} positions")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,326 @@
+# End-to-end load test of the site. It seeds the benchmark db with users,
+# stocks and holdings, uses the fake quote source (or QUOTE_SOURCE=replay)
+# and lets a number of clients, each logged in as its own user, click
+# through the site with a traffic mix. For every route it reports the
+# requests per second, the latency percentiles and the MongoDB commands
+# per request (only the ones sent on the thread of the request, the ones
+# of the cache and queue threads and of the position lookups of the
+# clients are counted apart), and it saves the results as json so two
+# commits can be compared:
+#   python benchmarks/loadtest.py --mix mixed --clients 8 --seconds 30
+#   git checkout <other commit>
+#   python benchmarks/loadtest.py --mix mixed --clients 8 --seconds 30 \
+#       --compare benchmarks/results/<first run>.json
+# It needs a local mongod (BENCH_MONGO_URI), the requests go through the
+# flask test client so no web server is needed.
+import argparse
+import json
+import os
+import random
+import subprocess
+import threading
+import time
+from datetime import datetime
+from pymongo import monitoring
+from common import ROOT, load_app, logged_in_client, make_stocks, seed
+from db_setup import ensure_indexes
+
+# how often every action is picked in a traffic mix
+MIXES = {
+    "browse": {"home": 40, "stock": 40, "portfolio": 20},
+    "trade": {"stock": 20, "portfolio": 10, "buy": 40, "sell": 30},
+    "mixed": {"home": 25, "stock": 35, "portfolio": 20, "buy": 10,
+              "sell": 10},
+    # mostly browsing, with now and then a burst of trades by one client
+    "burst": {"home": 30, "stock": 40, "portfolio": 25, "burst": 5},
+}
+# the number of trades in one burst
+BURST_SIZE = 10
+
+
+# A pymongo listener that counts the commands of the thread that sends
+# them. The test client runs a request on the thread of the client, so
+# the count of a thread before and after a request is what it sent.
+# Commands that a request hands to another thread (the fetch pool of the
+# price cache, a background refresh, the order queue) are not in the
+# count of its route, so db/req is too low for those routes. They are
+# still in the total of all threads, and the run shows them as the
+# background commands.
+class ThreadCommandCounter(monitoring.CommandListener):
+
+    def __init__(self):
+        self.local = threading.local()
+        self.total = 0
+        self._lock = threading.Lock()
+
+    def started(self, event):
+        self.local.count = getattr(self.local, "count", 0) + 1
+        with self._lock:
+            self.total += 1
+
+    def succeeded(self, event):
+        pass
+
+    def failed(self, event):
+        pass
+
+    # function to get the number of commands this thread sent so far
+    def count(self):
+        return getattr(self.local, "count", 0)
+
+    # function to get the number of commands all threads sent so far
+    def count_all(self):
+        with self._lock:
+            return self.total
+
+
+# the requests and timings of one route
+class RouteStats:
+
+    def __init__(self):
+        self.latencies = []
+        self.commands = 0
+        self.errors = 0
+
+
+# function to get a percentile of a sorted list
+def percentile(values, percent):
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(len(values) * percent / 100))]
+
+
+# function to get the commit the app is on, with "-dirty" when there are
+# changes that aren't committed
+def git_commit():
+    try:
+        commit = subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, text=True)
+        changes = subprocess.check_output(
+            ["git", "status", "--porcelain", "--untracked-files=no"],
+            cwd=ROOT, text=True)
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+    return commit.strip() + ("-dirty" if changes.strip() else "")
+
+
+# One client of the load test, logged in as one user. It picks actions
+# from the traffic mix until the test is over.
+class Client:
+
+    def __init__(self, app, username, stock_ids, mix, counter, rng):
+        self.db = app.mongo.db
+        self.username = username
+        self.client = logged_in_client(app.app, username)
+        self.stock_ids = stock_ids
+        self.actions = list(mix)
+        self.weights = [mix[action] for action in self.actions]
+        self.counter = counter
+        self.rng = rng
+        self.stats = {}
+        # the commands of the position lookups of sell, they are sent by
+        # the client and not by a route
+        self.lookup_commands = 0
+
+    # function to send one request and save its timing under a route
+    def request(self, route, method, url, data=None):
+        stats = self.stats.setdefault(route, RouteStats())
+        commands = self.counter.count()
+        started = time.perf_counter()
+        try:
+            response = self.client.open(url, method=method, data=data)
+            failed = response.status_code >= 400
+        except Exception:
+            failed = True
+        stats.latencies.append(time.perf_counter() - started)
+        stats.commands += self.counter.count() - commands
+        if failed:
+            stats.errors += 1
+
+    # function to buy a few stocks of a random stock
+    def buy(self):
+        stock_id = self.rng.choice(self.stock_ids)
+        self.request("buy", "POST", f"/stock/{stock_id}",
+                     {"stock_total": str(self.rng.randint(1, 3))})
+
+    # function to sell one stock of a random position of the user, the
+    # position is looked up outside of the timing
+    def sell(self):
+        commands = self.counter.count()
+        positions = list(self.db.stocks_bought.find(
+            {"bought_by": self.username}, {"_id": True}))
+        self.lookup_commands += self.counter.count() - commands
+        if not positions:
+            return self.buy()
+        position = self.rng.choice(positions)
+        self.request("sell", "POST", f"/sell/{position['_id']}",
+                     {"stocks_sell": "1"})
+
+    # function to do one action of the mix
+    def act(self):
+        action = self.rng.choices(self.actions, self.weights)[0]
+        if action == "home":
+            self.request("home", "GET", "/")
+        elif action == "stock":
+            self.request(
+                "stock", "GET", f"/stock/{self.rng.choice(self.stock_ids)}")
+        elif action == "portfolio":
+            self.request("portfolio", "GET", "/portfolio")
+        elif action == "buy":
+            self.buy()
+        elif action == "sell":
+            self.sell()
+        elif action == "burst":
+            for number in range(BURST_SIZE):
+                if number % 2 == 0:
+                    self.buy()
+                else:
+                    self.sell()
+
+    # function to keep doing actions until the stop time
+    def run(self, stop):
+        while time.monotonic() < stop:
+            self.act()
+
+
+# function to add up the stats of all clients per route
+def summarize(clients, seconds):
+    routes = {}
+    for client in clients:
+        for route, stats in client.stats.items():
+            total = routes.setdefault(route, RouteStats())
+            total.latencies.extend(stats.latencies)
+            total.commands += stats.commands
+            total.errors += stats.errors
+    summary = {}
+    for route, stats in sorted(routes.items()):
+        latencies = sorted(stats.latencies)
+        count = len(latencies)
+        summary[route] = {
+            "requests": count,
+            "errors": stats.errors,
+            "requests_per_second": count / seconds,
+            "p50_ms": percentile(latencies, 50) * 1000,
+            "p90_ms": percentile(latencies, 90) * 1000,
+            "p99_ms": percentile(latencies, 99) * 1000,
+            "max_ms": latencies[-1] * 1000 if latencies else 0.0,
+            "db_commands_per_request": stats.commands / count if count else 0,
+        }
+    return summary
+
+
+# function to print the results per route
+def print_summary(summary):
+    print(f"{'route':10} {'req':>7} {'err':>5} {'req/s':>8} {'p50':>9} "
+          f"{'p90':>9} {'p99':>9} {'max':>9} {'db/req':>7}")
+    for route, row in summary.items():
+        print(f"{route:10} {row['requests']:7} {row['errors']:5} "
+              f"{row['requests_per_second']:8.1f} {row['p50_ms']:7.1f}ms "
+              f"{row['p90_ms']:7.1f}ms {row['p99_ms']:7.1f}ms "
+              f"{row['max_ms']:7.1f}ms {row['db_commands_per_request']:7.1f}")
+
+
+# function to print the change of every route against older results
+def print_compare(summary, old):
+    print(f"compared with {old['commit']} ({old['started']}):")
+    for route, row in summary.items():
+        before = old["routes"].get(route)
+        if before is None:
+            continue
+        changes = []
+        for key, label in (("requests_per_second", "req/s"),
+                           ("p99_ms", "p99"),
+                           ("db_commands_per_request", "db/req")):
+            if before[key]:
+                change = (row[key] - before[key]) / before[key] * 100
+                changes.append(f"{label} {change:+.1f}%")
+        print(f"  {route:10} " + ", ".join(changes))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--mix", choices=sorted(MIXES), default="mixed")
+    parser.add_argument("--clients", type=int, default=8)
+    parser.add_argument("--seconds", type=float, default=30)
+    parser.add_argument("--users", type=int, default=50)
+    parser.add_argument("--stocks", type=int, default=9,
+                        help="stock_info entries, more than 9 are made up")
+    parser.add_argument("--holdings", type=int, default=3,
+                        help="stocks_bought holdings per user")
+    parser.add_argument("--cash", type=float, default=1000000)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", default=os.path.join(
+        ROOT, "benchmarks", "results"))
+    parser.add_argument("--compare", help="a json file of an older run")
+    args = parser.parse_args()
+    if args.clients > args.users:
+        parser.error("every client needs its own user")
+
+    counter = ThreadCommandCounter()
+    app = load_app(counter)
+    db = app.mongo.db
+    seed(db, users=args.users, holdings_per_user=args.holdings,
+         cash=args.cash, stocks=make_stocks(args.stocks))
+    ensure_indexes(db)
+    stock_ids = [stock["_id"] for stock in db.stock_info.find({}, {"_id": 1})]
+
+    clients = [
+        Client(app, f"user{number}", stock_ids, MIXES[args.mix], counter,
+               random.Random(args.seed + number))
+        for number in range(args.clients)]
+    # one round of every page first, so the caches are filled
+    warm_up = clients[0]
+    for route, url in (("home", "/"), ("stock", f"/stock/{stock_ids[0]}"),
+                       ("portfolio", "/portfolio")):
+        warm_up.request(route, "GET", url)
+    warm_up.stats = {}
+
+    started = datetime.utcnow()
+    commands = counter.count_all()
+    stop = time.monotonic() + args.seconds
+    threads = [
+        threading.Thread(target=client.run, args=(stop,))
+        for client in clients]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    summary = summarize(clients, args.seconds)
+    print_summary(summary)
+    # the commands of other threads, that no route or lookup of the
+    # clients is counted for
+    lookups = sum(client.lookup_commands for client in clients)
+    background = counter.count_all() - commands - lookups - sum(
+        stats.commands for client in clients
+        for stats in client.stats.values())
+    requests = sum(row["requests"] for row in summary.values())
+    print(f"{background} db commands of background threads, "
+          f"{background / requests if requests else 0:.2f} per request")
+    print(f"{lookups} db commands of the position lookups of the clients")
+    results = {
+        "commit": git_commit(),
+        "started": started.isoformat(timespec="seconds"),
+        "settings": {
+            key: value for key, value in vars(args).items()
+            if key not in ("output", "compare")},
+        "quote_source": os.environ.get("QUOTE_SOURCE"),
+        "routes": summary,
+        "background_db_commands": background,
+        "lookup_db_commands": lookups,
+    }
+    os.makedirs(args.output, exist_ok=True)
+    path = os.path.join(
+        args.output, f"{started:%Y%m%d-%H%M%S}-{results['commit']}-"
+        f"{args.mix}.json")
+    with open(path, "w") as file:
+        json.dump(results, file, indent=2)
+    print(f"saved the results in {path}")
+
+    if args.compare:
+        with open(args.compare) as file:
+            print_compare(summary, json.load(file))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,82 @@
+# Measures what the timings of metrics.py cost. It times the single
+# steps (a histogram value, a MongoDB command event, a quote call) and a
+# whole request to a small flask app with and without the metrics, so
+# no database is needed:
+#   python benchmarks/metrics_overhead.py
+import argparse
+import time
+from flask import Flask, render_template_string
+from common import ROOT  # noqa: F401, puts the app folder on the path
+from metrics import Metrics
+
+
+# a MongoDB command event like the ones pymongo gives the listener
+class CommandEvent:
+    command_name = "find"
+    duration_micros = 1500
+
+
+# function to get the microseconds one call of a function takes
+def per_call(function, count):
+    started = time.perf_counter()
+    for _ in range(count):
+        function()
+    return (time.perf_counter() - started) / count * 1e6
+
+
+# function to make a small app that renders a template on every request
+def make_app(metrics=None):
+    app = Flask(__name__)
+    if metrics is not None:
+        metrics.init_app(app)
+
+    @app.route("/")
+    def page():
+        return render_template_string("{{ value }}", value=1)
+
+    return app
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--count", type=int, default=200000)
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--rounds", type=int, default=5)
+    args = parser.parse_args()
+
+    metrics = Metrics()
+    event = CommandEvent()
+
+    def histogram_value():
+        metrics.requests.observe(("page", "GET", "200"), 0.01)
+
+    def mongo_command():
+        metrics.mongo_listener.succeeded(event)
+
+    def quote_call():
+        with metrics.quote_call("live_price"):
+            pass
+
+    for name, function in (("histogram value", histogram_value),
+                           ("mongo command", mongo_command),
+                           ("quote call", quote_call)):
+        print(f"{name:16} {per_call(function, args.count):.2f}us")
+
+    # the apps take turns and the best round counts, so a noisy moment
+    # doesn't end up in only one of them
+    clients = {
+        "without": make_app().test_client(),
+        "with": make_app(Metrics()).test_client()}
+    timings = {}
+    for _ in range(args.rounds):
+        for name, client in clients.items():
+            took = per_call(lambda: client.get("/"), args.requests)
+            timings[name] = min(timings.get(name, took), took)
+    for name, took in timings.items():
+        print(f"request {name:7} metrics: {took:.1f}us")
+    print(f"overhead per request: "
+          f"{timings['with'] - timings['without']:.1f}us")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,99 @@
+# Load generator for bursts of trades, like many users buying the same
+# stock at market open. It compares executing every order right away
+# with the trade engine against the order queue with batched writes:
+#   python benchmarks/order_burst.py --orders 5000 --clients 32
+import argparse
+import random
+import statistics
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pymongo import MongoClient
+from common import BENCH_MONGO_URI, seed
+from db_setup import ensure_indexes
+from order_queue import OrderQueue
+import trades
+
+PRICES = {"TSLA": 700.0, "GOOG": 2400.0, "NIO": 40.0}
+
+
+# function to make the same random burst of buy orders for every mode
+def make_orders(count, users, seed_number=1):
+    rng = random.Random(seed_number)
+    return [
+        (f"user{rng.randrange(users)}", rng.choice(list(PRICES)),
+         rng.randint(1, 3))
+        for _ in range(count)]
+
+
+# function to print the result of one mode
+def report(mode, orders, took, latencies, filled):
+    latencies.sort()
+    p99 = latencies[int(len(latencies) * 0.99) - 1] if latencies else 0
+    print(f"{mode:7} {len(orders) / took:8.0f} orders/s  filled={filled} "
+          f"handler p50={statistics.median(latencies) * 1000:.2f}ms "
+          f"p99={p99 * 1000:.2f}ms")
+
+
+def run_direct(db, orders, clients):
+    latencies = []
+
+    def place(order):
+        username, stock_name, amount = order
+        started = time.monotonic()
+        try:
+            trades.buy(db, username, stock_name, stock_name, amount,
+                       PRICES[stock_name])
+            filled = 1
+        except trades.TradeError:
+            filled = 0
+        latencies.append(time.monotonic() - started)
+        return filled
+
+    started = time.monotonic()
+    with ThreadPoolExecutor(max_workers=clients) as pool:
+        filled = sum(pool.map(place, orders))
+    report("direct", orders, time.monotonic() - started, latencies, filled)
+
+
+def run_queue(db, orders, clients, batch_size):
+    order_queue = OrderQueue(
+        db, PRICES.__getitem__, batch_size=batch_size, max_wait=0.01)
+    latencies = []
+
+    def place(order):
+        username, stock_name, amount = order
+        started = time.monotonic()
+        order_queue.submit_buy(username, stock_name, stock_name, amount)
+        latencies.append(time.monotonic() - started)
+
+    started = time.monotonic()
+    with ThreadPoolExecutor(max_workers=clients) as pool:
+        list(pool.map(place, orders))
+    order_queue.join()
+    report("queue", orders, time.monotonic() - started, latencies,
+           order_queue.stats()["filled"])
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--orders", type=int, default=5000)
+    parser.add_argument("--users", type=int, default=500)
+    parser.add_argument("--clients", type=int, default=32,
+                        help="number of requests at the same time")
+    parser.add_argument("--batch-size", type=int, default=200)
+    args = parser.parse_args()
+
+    db = MongoClient(BENCH_MONGO_URI).get_default_database()
+    orders = make_orders(args.orders, args.users)
+    for mode in ("direct", "queue"):
+        seed(db, users=args.users, holdings_per_user=0, cash=1000000)
+        db.orders.delete_many({})
+        ensure_indexes(db)
+        if mode == "direct":
+            run_direct(db, orders, args.clients)
+        else:
+            run_queue(db, orders, args.clients, args.batch_size)
+
+
+if __name__ == "__main__":
+    main()
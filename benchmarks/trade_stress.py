@@ -0,0 +1,150 @@
+# Stress test of the trade engine. Many threads buy and sell the same
+# stocks for a few users at the same time, after that the script checks
+# that nothing was lost:
+#   - no user has negative cash
+#   - no position has zero or negative stocks
+#   - the cash of every user matches the fills they got
+#   - the stocks of every position match the fills
+#   - the income of the admin matches all fees
+#   - the leaderboard and the platform counters match the fills
+# It needs a local mongod, for example:
+#   python benchmarks/trade_stress.py --threads 16 --trades 200
+# With --transactions the trades run in transactions (needs a replica set).
+import argparse
+import random
+import threading
+import time
+from collections import defaultdict
+from pymongo import MongoClient
+from common import BENCH_MONGO_URI, seed
+from aggregates import business_income, read_counter
+from db_setup import ensure_indexes
+import trades
+
+PRICES = {"TSLA": 700.0, "GOOG": 2400.0, "NIO": 40.0}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--threads", type=int, default=16)
+    parser.add_argument("--trades", type=int, default=200,
+                        help="trades per thread")
+    parser.add_argument("--users", type=int, default=3)
+    parser.add_argument("--cash", type=float, default=10000)
+    parser.add_argument("--transactions", action="store_true")
+    args = parser.parse_args()
+
+    db = MongoClient(BENCH_MONGO_URI).get_default_database()
+    seed(db, users=args.users, holdings_per_user=0, cash=args.cash)
+    ensure_indexes(db)
+    usernames = [f"user{number}" for number in range(args.users)]
+
+    fills = []
+    rejected = [0]
+    lock = threading.Lock()
+
+    def trader(seed_number):
+        rng = random.Random(seed_number)
+        for _ in range(args.trades):
+            username = rng.choice(usernames)
+            stock_name = rng.choice(list(PRICES))
+            amount = rng.randint(1, 5)
+            try:
+                if rng.random() < 0.6:
+                    fill = trades.buy(
+                        db, username, stock_name, stock_name, amount,
+                        PRICES[stock_name], args.transactions)
+                else:
+                    position = db.stocks_bought.find_one(
+                        {"bought_by": username,
+                         "stock_name_short": stock_name})
+                    if position is None:
+                        continue
+                    fill = trades.sell(
+                        db, username, position["_id"], amount,
+                        PRICES[stock_name], args.transactions)
+            except trades.TradeError:
+                with lock:
+                    rejected[0] += 1
+                continue
+            with lock:
+                fills.append(fill)
+
+    started = time.monotonic()
+    threads = [
+        threading.Thread(target=trader, args=(number,))
+        for number in range(args.threads)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    took = time.monotonic() - started
+
+    # work out what the db should look like from the fills
+    cash = defaultdict(lambda: args.cash)
+    shares = defaultdict(int)
+    fees = 0
+    for fill in fills:
+        key = (fill["username"], fill["stock_name"])
+        if fill["side"] == "buy":
+            cash[fill["username"]] -= fill["total"]
+            shares[key] += fill["amount"]
+            fees += fill["fee"]
+        else:
+            cash[fill["username"]] += fill["value"]
+            shares[key] -= fill["amount"]
+
+    problems = []
+    for user in db.users.find({"username": {"$in": usernames}}):
+        if user["cash"] < 0:
+            problems.append(f"{user['username']} has negative cash")
+        if abs(user["cash"] - cash[user["username"]]) > 0.01:
+            problems.append(
+                f"{user['username']} has ${user['cash']:.2f} cash, "
+                f"the fills say ${cash[user['username']]:.2f}")
+    positions = {}
+    for position in db.stocks_bought.find():
+        key = (position["bought_by"], position["stock_name_short"])
+        positions[key] = position["stock_amount"]
+        if position["stock_amount"] <= 0:
+            problems.append(f"{key} has {position['stock_amount']} stocks")
+    for key, amount in shares.items():
+        if positions.get(key, 0) != amount:
+            problems.append(
+                f"{key} has {positions.get(key, 0)} stocks, "
+                f"the fills say {amount}")
+    income = business_income(db)
+    if abs(income - fees) > 0.01:
+        problems.append(f"admin income is {income:.2f}, fees are {fees:.2f}")
+    for row in db.leaderboard.find({"username": {"$in": usernames}}):
+        if abs(row["cash"] - cash[row["username"]]) > 0.01:
+            problems.append(
+                f"the leaderboard has ${row['cash']:.2f} cash for "
+                f"{row['username']}, the fills say "
+                f"${cash[row['username']]:.2f}")
+    for stock_name in PRICES:
+        amount = sum(
+            total for (username, name), total in shares.items()
+            if name == stock_name)
+        counted = read_counter(db, f"shares:{stock_name}")
+        if counted != amount:
+            problems.append(
+                f"the counter has {counted} {stock_name} stocks, the fills "
+                f"say {amount}")
+    total_cash = args.cash * (args.users + 1) + sum(
+        value - args.cash for value in cash.values())
+    if abs(read_counter(db, "cash") - total_cash) > 0.01:
+        problems.append(
+            f"the cash counter is {read_counter(db, 'cash'):.2f}, the fills "
+            f"say {total_cash:.2f}")
+
+    print(f"{len(fills)} fills and {rejected[0]} rejected trades in "
+          f"{took:.2f}s ({len(fills) / took:.0f} fills/s)")
+    if problems:
+        print("\n".join(problems))
+        raise SystemExit(1)
+    print("all invariants hold")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,121 @@
+# Micro-benchmark of the form validation. It checks large corpora of
+# random form values with the form schemas and with the old checks that
+# compiled their regex on every call, and it guards the patterns against
+# catastrophic backtracking: every pattern has to fail fast on long
+# hostile values, also without the length limit of the fields.
+#   python benchmarks/validation_bench.py --size 200000
+import argparse
+import random
+import re
+import string
+import time
+from common import ROOT  # noqa: F401, puts the app folder on the path
+import validation
+
+# the checks of the app before the form schemas
+OLD_CHECKS = {
+    "email": lambda value: re.search(
+        r"^[a-z0-9]+[\._]?[a-z0-9]+[@]\w+[.]\w{2,3}$", value.lower()),
+    "username": lambda value: re.match(r"^[a-zA-Z0-9]{5,20}$", value.lower()),
+    "password": lambda value: re.match(r"^.{5,20}$", value),
+    "stock_total": lambda value: re.match(
+        r"^([1-9][0-9][0-9]{0,2}|[1-9]|10000)$", value),
+}
+# a single check may never take longer than this
+MAX_SECONDS = 0.05
+
+
+# function to make a random value for a field, a mix of valid values,
+# near misses and noise
+def fuzz_value(rng, name):
+    kind = rng.random()
+    alphabet = string.ascii_letters + string.digits
+    if name == "stock_total":
+        if kind < 0.6:
+            return str(rng.randint(1, 10000))
+        return rng.choice(["0", "-1", "10001", "1e3", " 5", "", "abc"])
+    if name == "email":
+        user = "".join(rng.choices(alphabet, k=rng.randint(1, 20)))
+        if kind < 0.5:
+            return f"{user}@example.com"
+        if kind < 0.7:
+            return f"{user}.{user}@mail.org"
+        return "".join(rng.choices(
+            alphabet + "@._-!", k=rng.randint(0, 60)))
+    if name == "username":
+        return "".join(rng.choices(
+            alphabet if kind < 0.7 else alphabet + " _-!",
+            k=rng.randint(0, 30)))
+    return "".join(rng.choices(string.printable, k=rng.randint(0, 30)))
+
+
+# function to make the hostile values that make a pattern with nested or
+# overlapping repeats try every split before it fails
+def hostile_values(length):
+    return [
+        "a" * length + "!",
+        "a" * length + "@",
+        "a" * length + "." + "a" * length + "!",
+        "a@" + "a" * length + "!",
+        "a" * length + "@" + "a" * length + "." + "a" * length,
+        "1" * length,
+        "x" * length + "\n",
+    ]
+
+
+# function to time a function over a corpus, it returns values per second
+def throughput(check, corpus):
+    started = time.perf_counter()
+    for value in corpus:
+        check(value)
+    return len(corpus) / (time.perf_counter() - started)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--size", type=int, default=200000)
+    parser.add_argument("--hostile-length", type=int, default=50000)
+    args = parser.parse_args()
+    rng = random.Random(1)
+
+    fields = {
+        "email": validation.email_field(),
+        "username": validation.username_field(),
+        "password": validation.password_field(),
+        "stock_total": validation.stock_amount_field("stock_total"),
+    }
+    print(f"{'field':12} {'old checks/s':>14} {'schema/s':>14}")
+    for name, field in fields.items():
+        corpus = [fuzz_value(rng, name) for _ in range(args.size)]
+        old = throughput(OLD_CHECKS[name], corpus)
+        new = throughput(field.check, corpus)
+        print(f"{name:12} {old:14,.0f} {new:14,.0f}")
+
+    forms = [
+        {"username": fuzz_value(rng, "username"),
+         "email": fuzz_value(rng, "email"),
+         "password": fuzz_value(rng, "password")}
+        for _ in range(args.size)]
+    print(f"register form: "
+          f"{throughput(validation.REGISTER_FORM.validate, forms):,.0f}/s")
+
+    # the patterns on their own, without the length limit of the field
+    failed = False
+    for name, field in fields.items():
+        for length in (args.hostile_length // 10, args.hostile_length):
+            for value in hostile_values(length):
+                started = time.perf_counter()
+                field.pattern.fullmatch(value.lower())
+                took = time.perf_counter() - started
+                if took > MAX_SECONDS:
+                    failed = True
+                    print(f"BACKTRACKING: {name} took {took:.3f}s on "
+                          f"{value[:20]!r}... ({len(value)} characters)")
+    if failed:
+        raise SystemExit(1)
+    print(f"no pattern needed more than {MAX_SECONDS * 1000:.0f}ms on "
+          f"hostile values of up to {args.hostile_length * 3} characters")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,264 @@
+import asyncio
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+
+
+# a fetch of a key that is running right now, the requests that wait on
+# it get its value from the cache or its error
+class _Fetch:
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.value = None
+        self.error = None
+
+
+# a small process-wide cache that sits in front of slow lookups like
+# the Yahoo live price. Every key has its own time-to-live, a value that
+# is a bit too old is still served while a background thread fetches a
+# new one, and many requests for the same key share one upstream fetch.
+class TTLCache:
+
+    def __init__(self, fetch, ttl=15, stale_ttl=60, ttl_per_key=None,
+                 max_workers=8, wait_timeout=None):
+        # the function that gets the real value for a key
+        self.fetch = fetch
+        # how many seconds a request waits on the fetch of another
+        # request, None waits as long as the fetch takes
+        self.wait_timeout = wait_timeout
+        # how many seconds a value counts as fresh
+        self.ttl = ttl
+        # how many extra seconds an old value may still be served
+        self.stale_ttl = stale_ttl
+        # optional dict with a different ttl for some keys
+        self.ttl_per_key = ttl_per_key or {}
+        # key -> (value, time it was fetched)
+        self._values = {}
+        # key -> _Fetch of a fetch that is running right now
+        self._in_flight = {}
+        self._lock = threading.Lock()
+        # a small pool of threads to fetch many keys at the same time
+        self._pool = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="cache-fetch")
+        # counters to see how well the cache works
+        self._stats = {
+            "hits": 0,
+            "stale_hits": 0,
+            "misses": 0,
+            "coalesced": 0,
+            "errors": 0,
+            "timeouts": 0,
+            "fetches": 0,
+            "fetch_seconds": 0.0,
+            "max_fetch_seconds": 0.0,
+        }
+
+    # function to get the ttl of a key
+    def ttl_for(self, key):
+        return self.ttl_per_key.get(key, self.ttl)
+
+    # function to get a value, from the cache if possible. The timeout is
+    # how long to wait on a fetch of another request, when the fetch of
+    # this key fails every waiting request gets the same error.
+    def get(self, key, timeout=None):
+        if timeout is None:
+            timeout = self.wait_timeout
+        now = time.monotonic()
+        with self._lock:
+            cached = self._values.get(key)
+            if cached is not None:
+                value, fetched_at = cached
+                age = now - fetched_at
+                # the value is fresh, return it right away
+                if age < self.ttl_for(key):
+                    self._stats["hits"] += 1
+                    return value
+                # the value is old but still usable, return it and
+                # refresh it in the background
+                if age < self.ttl_for(key) + self.stale_ttl:
+                    self._stats["stale_hits"] += 1
+                    if key not in self._in_flight:
+                        self._in_flight[key] = _Fetch()
+                        threading.Thread(
+                            target=self._refresh, args=(key,),
+                            daemon=True).start()
+                    return value
+            # somebody else is already fetching this key, wait for it
+            fetch = self._in_flight.get(key)
+            if fetch is None:
+                fetch = self._in_flight[key] = _Fetch()
+                owner = True
+                self._stats["misses"] += 1
+            else:
+                owner = False
+                self._stats["coalesced"] += 1
+
+        if owner:
+            return self._refresh(key, raise_errors=True)
+
+        if not fetch.event.wait(timeout):
+            with self._lock:
+                self._stats["timeouts"] += 1
+            raise TimeoutError(f"the fetch of {key} took over {timeout}s")
+        # the fetch we waited on failed, don't try it again ourselves or
+        # every waiting request would call upstream one after the other
+        if fetch.error is not None:
+            raise fetch.error
+        return fetch.value
+
+    # function to fetch a key from upstream and store the result
+    def _refresh(self, key, raise_errors=False):
+        started = time.monotonic()
+        try:
+            value = self.fetch(key)
+        except Exception as error:
+            with self._lock:
+                self._stats["errors"] += 1
+                fetch = self._in_flight.pop(key)
+            fetch.error = error
+            fetch.event.set()
+            if raise_errors:
+                raise
+            return None
+        finished = time.monotonic()
+        took = finished - started
+        with self._lock:
+            self._values[key] = (value, finished)
+            self._stats["fetches"] += 1
+            self._stats["fetch_seconds"] += took
+            self._stats["max_fetch_seconds"] = max(
+                self._stats["max_fetch_seconds"], took)
+            fetch = self._in_flight.pop(key)
+        fetch.value = value
+        fetch.event.set()
+        return value
+
+    # function to get the values of many keys at the same time. Keys
+    # that fail or take longer than the timeout are left out of the
+    # returned dict, so one slow stock doesn't block the whole page. A
+    # thread that waits on the fetch of another request also gives up
+    # after the timeout, so threads don't pile up behind a stuck fetch.
+    def get_many(self, keys, timeout=5):
+        futures = {}
+        for key in set(keys):
+            futures[key] = self._pool.submit(self.get, key, timeout)
+        done, not_done = wait(futures.values(), timeout=timeout)
+        values = {}
+        for key, future in futures.items():
+            if future in done and future.exception() is None:
+                values[key] = future.result()
+        if not_done:
+            with self._lock:
+                self._stats["timeouts"] += len(not_done)
+        return values
+
+    # function to remove one key (or everything) from the cache
+    def invalidate(self, key=None):
+        with self._lock:
+            if key is None:
+                self._values.clear()
+            else:
+                self._values.pop(key, None)
+
+    # function to get the hit/miss/latency counters
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats["size"] = len(self._values)
+        if stats["fetches"]:
+            stats["avg_fetch_seconds"] = (
+                stats["fetch_seconds"] / stats["fetches"])
+        else:
+            stats["avg_fetch_seconds"] = 0.0
+        return stats
+
+
+# the same cache for the async app. It runs on one event loop, so it
+# needs no lock: many requests for the same key await one fetch.
+class AsyncTTLCache:
+
+    def __init__(self, fetch, ttl=15, stale_ttl=60, ttl_per_key=None):
+        # the coroutine function that gets the real value for a key
+        self.fetch = fetch
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.ttl_per_key = ttl_per_key or {}
+        # key -> (value, time it was fetched)
+        self._values = {}
+        # key -> task of a fetch that is running right now
+        self._in_flight = {}
+        self._stats = {
+            "hits": 0, "stale_hits": 0, "misses": 0, "coalesced": 0,
+            "errors": 0, "timeouts": 0, "fetches": 0}
+
+    # function to get the ttl of a key
+    def ttl_for(self, key):
+        return self.ttl_per_key.get(key, self.ttl)
+
+    # function to start a fetch of a key, or get the one that runs
+    def _fetch_task(self, key):
+        task = self._in_flight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self._refresh(key))
+            # a failed background refresh is counted, not raised
+            task.add_done_callback(
+                lambda task: task.cancelled() or task.exception())
+            self._in_flight[key] = task
+        return task
+
+    # function to get a value, from the cache if possible
+    async def get(self, key):
+        cached = self._values.get(key)
+        if cached is not None:
+            value, fetched_at = cached
+            age = time.monotonic() - fetched_at
+            if age < self.ttl_for(key):
+                self._stats["hits"] += 1
+                return value
+            if age < self.ttl_for(key) + self.stale_ttl:
+                # serve the old value and refresh it in the background
+                self._stats["stale_hits"] += 1
+                self._fetch_task(key)
+                return value
+        if key in self._in_flight:
+            self._stats["coalesced"] += 1
+        else:
+            self._stats["misses"] += 1
+        # shield the fetch, so a request that is cancelled doesn't
+        # cancel it for the other requests that wait on it
+        return await asyncio.shield(self._fetch_task(key))
+
+    # function to fetch a key from upstream and store the result
+    async def _refresh(self, key):
+        try:
+            value = await self.fetch(key)
+        except Exception:
+            self._stats["errors"] += 1
+            raise
+        finally:
+            self._in_flight.pop(key, None)
+        self._values[key] = (value, time.monotonic())
+        self._stats["fetches"] += 1
+        return value
+
+    # function to get the values of many keys at the same time, keys that
+    # fail or take longer than the timeout are left out
+    async def get_many(self, keys, timeout=5):
+        if not keys:
+            return {}
+        tasks = {
+            key: asyncio.ensure_future(self.get(key)) for key in set(keys)}
+        done, not_done = await asyncio.wait(tasks.values(), timeout=timeout)
+        for task in not_done:
+            task.cancel()
+        self._stats["timeouts"] += len(not_done)
+        return {
+            key: task.result() for key, task in tasks.items()
+            if task in done and task.exception() is None}
+
+    # function to get the hit/miss counters
+    def stats(self):
+        stats = dict(self._stats)
+        stats["size"] = len(self._values)
+        return stats
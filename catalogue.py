@@ -0,0 +1,81 @@
+import threading
+from datetime import datetime
+from cache import TTLCache
+
+# the categories of the home page in the order they are shown:
+# (category in the db, title on the page)
+CATEGORIES = [
+    ("electric/hybrid cars", "Electric/hybrid cars stocks:"),
+    ("big tech", "Big tech stocks:"),
+    ("3d-printing", "3-D printing companies stocks:"),
+]
+
+
+# function to put the stocks in their category with one pass
+def group_catalogue(stocks):
+    grouped = {category: [] for category, title in CATEGORIES}
+    for stock in stocks:
+        if stock.get("category") in grouped:
+            grouped[stock["category"]].append(stock)
+    return [
+        {"category": category, "title": title, "stocks": grouped[category]}
+        for category, title in CATEGORIES]
+
+
+# the counter document with the version of stock_info
+VERSION_ID = "catalogue:stock_info"
+
+
+# function to get the version of stock_info, one read of one document
+def catalogue_version(db):
+    counter = db.counters.find_one({"_id": VERSION_ID}, {"seq": True})
+    return counter["seq"] if counter else 0
+
+
+# function to give stock_info a new version, everything that changes
+# stock_info has to call it (or run "flask touch-catalogue" after a
+# change by hand) so the home page is rendered again
+def touch_catalogue(db):
+    db.counters.update_one({"_id": VERSION_ID}, {"$inc": {"seq": 1}},
+                           upsert=True)
+
+
+# the rendered card grid of the home page. It is only rendered again
+# when the version of stock_info changed, which is checked at most once
+# every check_ttl seconds.
+class CatalogueCache:
+
+    def __init__(self, db, check_ttl=10):
+        self.db = db
+        self._versions = TTLCache(
+            self._fetch_version, ttl=check_ttl, stale_ttl=0, max_workers=1)
+        self._rendered = None
+        self._lock = threading.Lock()
+
+    def _fetch_version(self, key):
+        return catalogue_version(self.db)
+
+    # function to get the rendered catalogue, render is a function that
+    # gets the grouped stocks and returns the html
+    def get(self, render):
+        version = self._versions.get("stock_info")
+        rendered = self._rendered
+        if rendered is not None and rendered["version"] == version:
+            return rendered
+        with self._lock:
+            rendered = self._rendered
+            if rendered is None or rendered["version"] != version:
+                stocks = list(self.db.stock_info.find())
+                rendered = {
+                    "version": version,
+                    "html": render(group_catalogue(stocks)),
+                    "last_modified": datetime.utcnow().replace(microsecond=0),
+                }
+                self._rendered = rendered
+        return rendered
+
+    # function to render the catalogue again on the next request
+    def invalidate(self):
+        with self._lock:
+            self._versions.invalidate()
+            self._rendered = None
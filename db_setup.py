@@ -0,0 +1,132 @@
+import os
+from pymongo import ASCENDING, DESCENDING
+from pymongo.errors import OperationFailure
+
+
+# all indexes the app needs: collection -> list of (keys, options)
+INDEXES = {
+    "users": [
+        ([("username", ASCENDING)], {"unique": True}),
+        ([("email", ASCENDING)], {"unique": True}),
+    ],
+    "stocks_bought": [
+        ([("bought_by", ASCENDING), ("stock_name_short", ASCENDING)],
+         {"unique": True}),
+        # the top holders of a stock
+        ([("stock_name_short", ASCENDING), ("stock_amount", DESCENDING)], {}),
+    ],
+    "stock_info": [
+        ([("stock_name_short", ASCENDING)], {"unique": True}),
+    ],
+    "quotes": [
+        ([("stock_name_short", ASCENDING)], {"unique": True}),
+    ],
+    "trades": [
+        ([("username", ASCENDING), ("created_at", ASCENDING)], {}),
+        ([("username", ASCENDING), ("seq", ASCENDING)],
+         {"unique": True, "partialFilterExpression": {
+             "seq": {"$exists": True}}}),
+        # the trades of queued orders, for recover
+        ([("order_id", ASCENDING)], {"sparse": True}),
+    ],
+    "position_snapshots": [
+        ([("username", ASCENDING), ("seq", ASCENDING)], {"unique": True}),
+    ],
+    "orders": [
+        # the orders a batch took, and the queued orders to recover
+        ([("batch_id", ASCENDING)], {"sparse": True}),
+        ([("status", ASCENDING), ("created_at", ASCENDING)], {}),
+    ],
+    "leaderboard": [
+        ([("username", ASCENDING)], {"unique": True}),
+        ([("value", DESCENDING)], {}),
+        ([("return_percent", DESCENDING)], {}),
+    ],
+}
+
+# the queries the routes run the most: (name, collection, filter)
+HOT_QUERIES = [
+    ("user by username", "users", {"username": "admin"}),
+    ("user by email", "users", {"email": "admin@example.com"}),
+    ("stocks of a user", "stocks_bought", {"bought_by": "admin"}),
+    ("stock of a user", "stocks_bought",
+     {"bought_by": "admin", "stock_name_short": "TSLA"}),
+    ("stock info by name", "stock_info", {"stock_name_short": "TSLA"}),
+    ("quote by name", "quotes", {"stock_name_short": "TSLA"}),
+]
+
+
+# function to create all indexes, it can be run as often as you like
+# because MongoDB skips the indexes that already exist
+def ensure_indexes(db):
+    created = []
+    for collection, indexes in INDEXES.items():
+        for keys, options in indexes:
+            try:
+                created.append(
+                    db[collection].create_index(keys, **options))
+            except OperationFailure as error:
+                # for example a unique index on data with duplicates
+                print(f"could not create index on {collection}: {error}")
+    return created
+
+
+# function to get the names of the indexes of every collection
+def report_indexes(db):
+    return {
+        collection: sorted(db[collection].index_information())
+        for collection in INDEXES}
+
+
+# function to get the stages of a query plan, like IXSCAN or COLLSCAN
+def plan_stages(plan):
+    stages = []
+    while plan:
+        stages.append(plan.get("stage"))
+        plan = plan.get("inputStage")
+    return stages
+
+
+# function to explain the hot queries and show if they use an index
+def explain_queries(db):
+    plans = {}
+    for name, collection, query in HOT_QUERIES:
+        explain = db[collection].find(query).explain()
+        winning_plan = explain.get("queryPlanner", {}).get("winningPlan", {})
+        plans[name] = plan_stages(winning_plan)
+    return plans
+
+
+# function to find out which field caused a duplicate key error
+def duplicate_key_field(error):
+    details = error.details or {}
+    # newer MongoDB versions tell the keys of the index
+    key_pattern = details.get("keyPattern")
+    if key_pattern:
+        return next(iter(key_pattern))
+    # older versions only have the index name in the message
+    message = details.get("errmsg", str(error))
+    for collection_indexes in INDEXES.values():
+        for keys, options in collection_indexes:
+            name = "_".join(f"{field}_{order}" for field, order in keys)
+            if f"index: {name} " in message:
+                return keys[0][0]
+    return None
+
+
+# function to print the indexes and query plans
+def print_report(db):
+    for collection, names in report_indexes(db).items():
+        print(f"{collection}: {', '.join(names)}")
+    for name, stages in explain_queries(db).items():
+        print(f"{name}: {' <- '.join(stage or '?' for stage in stages)}")
+
+
+if __name__ == "__main__":
+    from worker import get_db
+    if os.path.exists("env.py"):
+        import env
+
+    db = get_db()
+    ensure_indexes(db)
+    print_report(db)
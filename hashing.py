@@ -0,0 +1,98 @@
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from werkzeug.security import (
+    DEFAULT_PBKDF2_ITERATIONS, check_password_hash, generate_password_hash)
+
+
+# function to get the full werkzeug method of a method, a pbkdf2 method
+# without iterations gets the iterations werkzeug uses for it
+def full_method(method):
+    if method.startswith("pbkdf2:") and method.count(":") == 1:
+        return f"{method}:{DEFAULT_PBKDF2_ITERATIONS}"
+    return method
+
+
+# function to get the method a password hash was made with
+def hash_method(password_hash):
+    return password_hash.split("$", 1)[0]
+
+
+# these functions run in the worker processes, so they have to be at
+# the top of the module
+def make_hash(password, method, salt_length):
+    return generate_password_hash(
+        password, method=method, salt_length=salt_length)
+
+
+# function to check a password, and make a new hash when the old one is
+# made with another method. It returns (password ok, new hash or None).
+def check_and_upgrade(password_hash, password, method, salt_length):
+    if not check_password_hash(password_hash, password):
+        return False, None
+    if hash_method(password_hash) == method:
+        return True, None
+    return True, make_hash(password, method, salt_length)
+
+
+# Hashes and checks passwords in a pool of processes, so the slow hashing
+# of a login doesn't hold up the other requests of the worker. With 0
+# processes the hashing is done on the request thread like before.
+class PasswordHasher:
+
+    def __init__(self, method="pbkdf2:sha256", salt_length=8, processes=2):
+        self.method = full_method(method)
+        self.salt_length = salt_length
+        self.processes = processes
+        self._pool = None
+        self._lock = threading.Lock()
+        # the processes are started right away, while the web worker has
+        # few threads, so they don't fork in the middle of a request
+        if self.processes > 0:
+            self._new_pool()
+
+    # function to start a new pool and wait until its processes run
+    def _new_pool(self):
+        self._pool = ProcessPoolExecutor(max_workers=self.processes)
+        self._pool.submit(os.getpid).result()
+
+    # function to run a function in the pool. When a process of the pool
+    # died (killed for memory, say) the pool is made again and the
+    # function is tried once more.
+    def _run(self, function, *args):
+        if self.processes <= 0:
+            return function(*args)
+        pool = self._pool
+        try:
+            return pool.submit(function, *args).result()
+        except BrokenProcessPool:
+            with self._lock:
+                # another request may have made the new pool already
+                if self._pool is pool:
+                    print("the password hashing pool broke, starting a "
+                          "new one")
+                    pool.shutdown(wait=False)
+                    self._new_pool()
+                pool = self._pool
+            return pool.submit(function, *args).result()
+
+    # function to make the hash of a new password
+    def hash(self, password):
+        return self._run(make_hash, password, self.method, self.salt_length)
+
+    # function to check a password against a saved hash, it returns if the
+    # password is right and a new hash when the saved one is outdated
+    def check(self, password_hash, password):
+        return self._run(
+            check_and_upgrade, password_hash, password, self.method,
+            self.salt_length)
+
+
+# function to make the hasher of the app from the environment
+def hasher_from_env():
+    return PasswordHasher(
+        method=os.environ.get("PASSWORD_METHOD", "pbkdf2:sha256"),
+        salt_length=int(os.environ.get("PASSWORD_SALT_LENGTH", 8)),
+        processes=int(os.environ.get(
+            "PASSWORD_PROCESSES", min(4, os.cpu_count() or 1))))
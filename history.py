@@ -0,0 +1,97 @@
+import os
+import numpy as np
+
+# the columns of a bar, every column is kept in its own .npy file
+COLUMNS = ("time", "open", "high", "low", "close", "volume")
+# the type of every column, time is in seconds since 1970 (utc)
+DTYPES = {
+    "time": np.int64, "open": np.float64, "high": np.float64,
+    "low": np.float64, "close": np.float64, "volume": np.float64}
+
+
+# A small store of price bars on disk. Every stock and interval gets a
+# folder with one file per column, the files are memory-mapped when they
+# are read, so years of bars can be used without loading them first.
+class BarStore:
+
+    def __init__(self, root):
+        self.root = root
+
+    # function to get the folder of a stock and interval
+    def path(self, symbol, interval):
+        return os.path.join(self.root, interval, symbol.upper())
+
+    # function to get the stocks that have bars of an interval
+    def symbols(self, interval="1d"):
+        folder = os.path.join(self.root, interval)
+        if not os.path.isdir(folder):
+            return []
+        return sorted(os.listdir(folder))
+
+    # function to read the bars of a stock between two times (in
+    # seconds), it returns a dict of column -> array
+    def read(self, symbol, interval="1d", start=None, end=None):
+        folder = self.path(symbol, interval)
+        if not os.path.exists(os.path.join(folder, "time.npy")):
+            return {column: np.empty(0, DTYPES[column]) for column in COLUMNS}
+        bars = {
+            column: np.load(
+                os.path.join(folder, f"{column}.npy"), mmap_mode="r")
+            for column in COLUMNS}
+        first = 0 if start is None else np.searchsorted(bars["time"], start)
+        last = (len(bars["time"]) if end is None
+                else np.searchsorted(bars["time"], end, side="right"))
+        return {column: values[first:last] for column, values in bars.items()}
+
+    # function to add bars to a stock. Bars with a time that is already
+    # in the store replace the old ones.
+    def write(self, symbol, interval, bars):
+        old = self.read(symbol, interval)
+        new = {
+            column: np.asarray(bars[column], dtype=DTYPES[column])
+            for column in COLUMNS}
+        merged = {
+            column: np.concatenate([new[column], old[column]])
+            for column in COLUMNS}
+        # np.unique keeps the first of every time, that is the new bar
+        times, keep = np.unique(merged["time"], return_index=True)
+        folder = self.path(symbol, interval)
+        os.makedirs(folder, exist_ok=True)
+        for column in COLUMNS:
+            values = merged[column][keep]
+            # write to a new file first, so a reader never sees half a file
+            temporary = os.path.join(folder, f"{column}.tmp.npy")
+            np.save(temporary, values)
+            os.replace(temporary, os.path.join(folder, f"{column}.npy"))
+        return len(times)
+
+    # function to get the close prices of many stocks on the same times.
+    # It returns the times and a matrix with a row for every time and a
+    # column for every stock. A stock without a bar on a time gets its
+    # last close before that time, or nan when there is none.
+    def close_matrix(self, symbols, interval="1d", start=None, end=None):
+        closes = [
+            self.read(symbol, interval, start, end) for symbol in symbols]
+        times = np.unique(np.concatenate(
+            [np.empty(0, np.int64)] + [bars["time"] for bars in closes]))
+        matrix = np.full((len(times), len(symbols)), np.nan)
+        for column, bars in enumerate(closes):
+            if not len(bars["time"]):
+                continue
+            rows = np.searchsorted(bars["time"], times, side="right") - 1
+            found = rows >= 0
+            matrix[found, column] = bars["close"][rows[found]]
+        return times, matrix
+
+
+# function to fetch the bars of stocks from a data source and save them
+def sync_history(store, source, symbols, interval="1d", start=None):
+    saved = {}
+    for symbol in symbols:
+        try:
+            bars = source.history(symbol, interval=interval, start=start)
+        except Exception as error:
+            print(f"could not get the history of {symbol}: {error}")
+            continue
+        saved[symbol] = store.write(symbol, interval, bars)
+    return saved
@@ -0,0 +1,304 @@
+from datetime import datetime
+from pymongo import ReturnDocument, UpdateOne
+
+# the cash a new user starts with
+START_CASH = 10000
+# a snapshot of the positions of a user is saved every this many trades
+SNAPSHOT_EVERY = 500
+
+
+# the error when the trades of a user miss a number, a state made from
+# them would be wrong. A trade that failed to save after it was done is
+# kept in ledger_repairs, "flask repair-ledger" saves it.
+class LedgerGapError(Exception):
+    pass
+
+
+# function to reserve the next numbers of the trades of a user, every
+# user has their own numbers that only go up
+def next_sequence(db, username, count=1, session=None):
+    counter = db.counters.find_one_and_update(
+        {"_id": f"trades:{username}"}, {"$inc": {"seq": count}},
+        upsert=True, return_document=ReturnDocument.AFTER, session=session)
+    return counter["seq"] - count + 1
+
+
+# function to save fills in the trades collection, the ledger of all
+# trades. Trades are only ever added, never changed or removed.
+def record_trades(db, fills, session=None):
+    return save_trades(db, number_trades(db, fills, session), session)
+
+
+# function to give fills the next numbers of the trades of their users
+def number_trades(db, fills, session=None):
+    per_user = {}
+    for fill in fills:
+        per_user.setdefault(fill["username"], []).append(fill)
+    now = datetime.utcnow()
+    entries = []
+    for username, user_fills in per_user.items():
+        first = next_sequence(db, username, len(user_fills), session)
+        for number, fill in enumerate(user_fills):
+            entries.append(dict(fill, seq=first + number, created_at=now))
+    return entries
+
+
+# function to save numbered fills in the trades collection
+def save_trades(db, entries, session=None):
+    if not entries:
+        return entries
+    db.trades.insert_many(entries, session=session)
+    save_due_snapshots(db, entries, session)
+    return entries
+
+
+# function to save numbered fills that may already be saved, the numbers
+# they got before are kept so the ledger has no gap
+def restore_trades(db, entries):
+    updates = [
+        UpdateOne(
+            {"username": entry["username"], "seq": entry["seq"]},
+            {"$setOnInsert": {
+                key: value for key, value in entry.items() if key != "_id"}},
+            upsert=True)
+        for entry in entries]
+    if updates:
+        db.trades.bulk_write(updates, ordered=False)
+    save_due_snapshots(db, entries)
+    return entries
+
+
+# function to save a snapshot of the users whose numbers passed
+# SNAPSHOT_EVERY with the trades that were just saved
+def save_due_snapshots(db, entries, session=None):
+    numbers = {}
+    for entry in entries:
+        first, last = numbers.get(
+            entry["username"], (entry["seq"], entry["seq"]))
+        numbers[entry["username"]] = (
+            min(first, entry["seq"]), max(last, entry["seq"]))
+    for username, (first, last) in numbers.items():
+        if (first - 1) // SNAPSHOT_EVERY == last // SNAPSHOT_EVERY:
+            continue
+        # users from before the ledger get their first snapshot from
+        # open_ledger, not from an empty state
+        state = latest_snapshot(db, username, session)
+        if state is not None:
+            state = replay(
+                state, trades_after(db, username, state["seq"], session))
+            save_snapshot(db, username, state, session)
+
+
+# function to keep fills that could not be saved after their trade was
+# done, "flask repair-ledger" and the worker save them later. The step
+# is "ledger" when the trades aren't saved and "aggregates" when only
+# the counters and leaderboard miss them.
+def queue_repair(db, fills, step="ledger"):
+    try:
+        db.ledger_repairs.insert_one(
+            {"fills": fills, "step": step, "created_at": datetime.utcnow()})
+    except Exception as error:
+        # the fills are printed so they can be entered again by hand
+        print(f"could not queue the repair of {fills}: {error}")
+
+
+# function to get a state with no trades
+def empty_state(cash=START_CASH):
+    return {"seq": 0, "cash": cash, "fees": 0, "positions": {}}
+
+
+# function to change a state with one trade
+def apply_trade(state, trade):
+    positions = state["positions"]
+    stock_name = trade["stock_name"]
+    position = positions.get(stock_name)
+    if trade["side"] == "buy":
+        if position is None:
+            position = positions[stock_name] = {"amount": 0, "cost": 0}
+        position["amount"] += trade["amount"]
+        position["cost"] += trade["value"]
+        state["cash"] -= trade["total"]
+        state["fees"] += trade["fee"]
+    else:
+        # the price paid for the sold stocks is taken of the total
+        if position is not None:
+            position["cost"] -= position["cost"] / position["amount"] * (
+                trade["amount"])
+            position["amount"] -= trade["amount"]
+            if position["amount"] <= 0:
+                del positions[stock_name]
+        state["cash"] += trade["value"]
+    state["seq"] = trade["seq"]
+    return state
+
+
+# function to change a state with many trades. It stops at a missing
+# number, that is a trade of another request that isn't saved yet. With
+# strict it raises a LedgerGapError instead, for when nobody trades and
+# a missing number means a trade is lost.
+def replay(state, trades, strict=False):
+    for trade in trades:
+        if trade["seq"] != state["seq"] + 1:
+            if strict:
+                raise LedgerGapError(
+                    f"trade {state['seq'] + 1} of {trade['username']} is "
+                    "missing in the ledger")
+            break
+        apply_trade(state, trade)
+    return state
+
+
+# function to get the newest snapshot of a user as a state
+def latest_snapshot(db, username, session=None):
+    snapshot = db.position_snapshots.find_one(
+        {"username": username}, sort=[("seq", -1)], session=session)
+    if snapshot is None:
+        return None
+    return {
+        "seq": snapshot["seq"], "cash": snapshot["cash"],
+        "fees": snapshot["fees"], "positions": snapshot["positions"]}
+
+
+# function to get the trades of a user after a number, in order
+def trades_after(db, username, seq, session=None):
+    return db.trades.find(
+        {"username": username, "seq": {"$gt": seq}},
+        {"_id": False, "username": True, "stock_name": True, "side": True,
+         "amount": True, "value": True, "fee": True, "total": True,
+         "seq": True},
+        session=session).sort("seq", 1)
+
+
+# function to get the state of a user from the ledger, it starts at the
+# newest snapshot and only replays the trades after it. A user without a
+# snapshot starts with the cash of a new user.
+def current_state(db, username, session=None, strict=False):
+    state = latest_snapshot(db, username, session)
+    if state is None:
+        state = empty_state()
+    return replay(
+        state, trades_after(db, username, state["seq"], session), strict)
+
+
+# function to get the state of a user with all trades that got a number,
+# it raises a LedgerGapError when one of them isn't in the ledger. Run
+# it when nobody trades.
+def complete_state(db, username):
+    state = current_state(db, username, strict=True)
+    counter = db.counters.find_one({"_id": f"trades:{username}"})
+    if counter is not None and counter["seq"] > state["seq"]:
+        raise LedgerGapError(
+            f"trades {state['seq'] + 1} to {counter['seq']} of {username} "
+            "are missing in the ledger")
+    return state
+
+
+# function to save the state of a user as a new snapshot
+def save_snapshot(db, username, state=None, session=None):
+    if state is None:
+        state = current_state(db, username, session)
+    db.position_snapshots.update_one(
+        {"username": username, "seq": state["seq"]},
+        {"$set": {
+            "cash": state["cash"], "fees": state["fees"],
+            "positions": state["positions"],
+            "created_at": datetime.utcnow()}},
+        upsert=True, session=session)
+    return state
+
+
+# function to move the trades, snapshots and trade numbers of a user to
+# a new username
+def rename_user(db, old_username, new_username):
+    db.trades.update_many(
+        {"username": old_username}, {"$set": {"username": new_username}})
+    db.position_snapshots.update_many(
+        {"username": old_username}, {"$set": {"username": new_username}})
+    counter = db.counters.find_one_and_delete(
+        {"_id": f"trades:{old_username}"})
+    if counter is not None:
+        db.counters.replace_one(
+            {"_id": f"trades:{new_username}"}, {"seq": counter["seq"]},
+            upsert=True)
+
+
+# function to get the state of a user from the users and stocks_bought
+# collections, with the number of the last trade of the user
+def state_from_db(db, username):
+    user = db.users.find_one({"username": username})
+    counter = db.counters.find_one({"_id": f"trades:{username}"})
+    return {
+        "seq": counter["seq"] if counter else 0,
+        "cash": user["cash"],
+        "fees": user.get("total_spend_fees", 0),
+        "positions": {
+            position["stock_name_short"]: {
+                "amount": position["stock_amount"],
+                "cost": position["stock_price"]}
+            for position in db.stocks_bought.find({"bought_by": username})},
+    }
+
+
+# function to start the ledger of a user from the data they have now,
+# for users that were made before there was a ledger. Run it when
+# nobody trades, the trades before it are part of this snapshot.
+def open_ledger(db, username):
+    if db.position_snapshots.find_one({"username": username}) is not None:
+        return None
+    return save_snapshot(db, username, state_from_db(db, username))
+
+
+# function to write the state of a user from the ledger to the users
+# and stocks_bought collections. A user with a gap in the ledger raises
+# a LedgerGapError before anything is written.
+def rebuild_user(db, username):
+    if db.position_snapshots.find_one({"username": username}) is None:
+        # without a snapshot the trades from before the ledger are lost
+        return None
+    return write_user(db, username, complete_state(db, username))
+
+
+# function to write a state of a user to the users and stocks_bought
+# collections
+def write_user(db, username, state):
+    db.users.update_one({"username": username}, {"$set": {
+        "cash": state["cash"], "total_spend_fees": state["fees"]}})
+    titles = {
+        stock["stock_name_short"]: stock["stock_name"]
+        for stock in db.stock_info.find(
+            {}, {"stock_name_short": True, "stock_name": True})}
+    updates = [
+        UpdateOne(
+            {"bought_by": username, "stock_name_short": stock_name},
+            {"$set": {
+                "stock_name": titles.get(stock_name, stock_name),
+                "stock_price": position["cost"],
+                "stock_amount": position["amount"],
+                "price_per_stock": position["cost"] / position["amount"]}},
+            upsert=True)
+        for stock_name, position in state["positions"].items()]
+    if updates:
+        db.stocks_bought.bulk_write(updates, ordered=False)
+    db.stocks_bought.delete_many({
+        "bought_by": username,
+        "stock_name_short": {"$nin": list(state["positions"])}})
+    return state
+
+
+# function to rebuild all users from the ledger, the income of the
+# business is the total of the fees of all users. The ledger of every
+# user is checked first, so a gap raises before any user is written.
+def rebuild_all(db, admin_user="admin"):
+    rebuilt = {
+        username: complete_state(db, username)
+        for username in db.position_snapshots.distinct("username")}
+    for username, state in rebuilt.items():
+        write_user(db, username, state)
+    # users without a ledger keep the fees they have in the db
+    income = sum(state["fees"] for state in rebuilt.values()) + sum(
+        user.get("total_spend_fees", 0) for user in db.users.find(
+            {"username": {"$nin": list(rebuilt)}},
+            {"total_spend_fees": True}))
+    db.users.update_one(
+        {"username": admin_user}, {"$set": {"total_income_business": income}})
+    return rebuilt
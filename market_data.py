@@ -0,0 +1,398 @@
+import argparse
+import asyncio
+import bisect
+import json
+import os
+import random
+import threading
+import time
+import zlib
+from abc import ABC, abstractmethod
+from datetime import datetime, timezone
+
+
+# function to make a value from Yahoo safe to store in MongoDB
+def clean_value(value):
+    if value is None or isinstance(value, (bool, str)):
+        return value
+    if isinstance(value, float):
+        # nan can't be compared, so store it as empty
+        return None if value != value else value
+    if isinstance(value, int):
+        return value
+    try:
+        # numpy numbers have an item() function
+        return value.item()
+    except AttributeError:
+        return str(value)
+
+
+# The interface of all data sources. A source only has to make a
+# snapshot, the other functions take their part of it, but a source can
+# also get every part on its own when that is quicker.
+class MarketSource(ABC):
+
+    # function to get all the data of one stock in one dict
+    @abstractmethod
+    def snapshot(self, stock_name):
+        pass
+
+    # function to get only the live price of one stock
+    def live_price(self, stock_name):
+        return self.snapshot(stock_name)["price"]
+
+    # function to get the close price of the last trading day
+    def prev_close(self, stock_name):
+        return self.snapshot(stock_name)["prev_close"]
+
+    # function to get the change of the price since the last close
+    def change(self, stock_name):
+        return self.snapshot(stock_name)["change"]
+
+    # function to get if the market is open, like "REGULAR" or "CLOSED"
+    def market_status(self, stock_name):
+        return self.snapshot(stock_name)["market_status"]
+
+    # function to get the quote table as a list of [name, value] pairs
+    def quote_table(self, stock_name):
+        return self.snapshot(stock_name)["quote_table"]
+
+    # function to get the price bars of one stock, start is a date like
+    # "2021-01-31" and interval is one of 1m, 1d, 1wk or 1mo
+    def history(self, stock_name, interval="1d", start=None):
+        raise NotImplementedError(
+            f"{type(self).__name__} has no price history")
+
+    # function to get a snapshot in the async app without blocking the
+    # event loop, a source without an async client uses a thread
+    async def snapshot_async(self, stock_name):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, self.snapshot, stock_name)
+
+    # function to get only the live price in the async app
+    async def live_price_async(self, stock_name):
+        return (await self.snapshot_async(stock_name))["price"]
+
+
+# the real data source, it scrapes the quotes from Yahoo Finance. The
+# Yahoo packages are slow to import, so they are only imported when a
+# quote is fetched.
+class YahooSource(MarketSource):
+
+    # the chart api of Yahoo that yahoo_fin also reads the live price from
+    CHART_URL = "https://query1.finance.yahoo.com/v8/finance/chart/{}"
+
+    def __init__(self):
+        # the http client of the async app, made on first use
+        self._client = None
+
+    # function to get only the live price of one stock
+    def live_price(self, stock_name):
+        from yahoo_fin import stock_info as si
+        return clean_value(si.get_live_price(stock_name))
+
+    # function to get the close price of the last trading day
+    def prev_close(self, stock_name):
+        from yahoofinancials import YahooFinancials as yf
+        return clean_value(yf(stock_name).get_prev_close_price())
+
+    # function to get the change of the price since the last close
+    def change(self, stock_name):
+        from yahoofinancials import YahooFinancials as yf
+        return clean_value(yf(stock_name).get_current_change())
+
+    # function to get if the market is open, it is the same for all stocks
+    def market_status(self, stock_name=None):
+        from yahoo_fin import stock_info as si
+        return si.get_market_status()
+
+    # function to get the quote table as a list of [name, value] pairs
+    def quote_table(self, stock_name):
+        from yahoo_fin import stock_info as si
+        return [
+            [k, clean_value(v)]
+            for k, v in si.get_quote_table(stock_name).items()]
+
+    # function to get all the data of one stock in one dict
+    def snapshot(self, stock_name):
+        from yahoo_fin import stock_info as si
+        from yahoofinancials import YahooFinancials as yf
+
+        yf2 = yf(stock_name)
+        close_price = yf2.get_prev_close_price()
+        change_price = yf2.get_current_change()
+        stock_table = si.get_quote_table(stock_name)
+        return {
+            "price": clean_value(si.get_live_price(stock_name)),
+            "prev_close": clean_value(close_price),
+            "change": clean_value(change_price),
+            "market_status": si.get_market_status(),
+            # a list of pairs keeps the order of the table and allows
+            # keys with a dot in them like "Avg. Volume"
+            "quote_table": [
+                [k, clean_value(v)] for k, v in stock_table.items()],
+        }
+
+    # function to get the live price with an async http client, so the
+    # async app can wait on many prices at the same time
+    async def live_price_async(self, stock_name):
+        import httpx
+
+        if self._client is None:
+            self._client = httpx.AsyncClient(
+                timeout=10, headers={"User-Agent": "Mozilla/5.0"})
+        response = await self._client.get(
+            self.CHART_URL.format(stock_name),
+            params={"range": "1d", "interval": "1m"})
+        response.raise_for_status()
+        meta = response.json()["chart"]["result"][0]["meta"]
+        return clean_value(meta["regularMarketPrice"])
+
+    # function to get the price bars of one stock
+    def history(self, stock_name, interval="1d", start=None):
+        from yahoo_fin import stock_info as si
+
+        data = si.get_data(stock_name, start_date=start, interval=interval)
+        data = data.dropna(subset=["close"])
+        return {
+            "time": data.index.values.astype("datetime64[s]").astype("int64"),
+            "open": data["open"].values,
+            "high": data["high"].values,
+            "low": data["low"].values,
+            "close": data["close"].values,
+            "volume": data["volume"].values,
+        }
+
+
+# a fake data source to run the app and the worker without internet.
+# The prices make a small random walk around a fixed start price.
+class FakeSource(MarketSource):
+
+    def __init__(self, delay=0, seed=None):
+        # seconds to wait on every call, to act like a slow upstream
+        self.delay = delay
+        self.random = random.Random(seed)
+        self.prices = {}
+        # the worker and the price cache ask for snapshots from many
+        # threads, the random walk is changed by one at a time
+        self._lock = threading.Lock()
+
+    # function to get a start price that is the same on every run
+    def start_price(self, stock_name):
+        return 10 + zlib.crc32(stock_name.encode()) % 500
+
+    # function to get all the data of one stock in one dict
+    def snapshot(self, stock_name):
+        if self.delay:
+            time.sleep(self.delay)
+        return self.make_snapshot(stock_name)
+
+    # function to get a snapshot in the async app, the wait doesn't
+    # block the event loop
+    async def snapshot_async(self, stock_name):
+        if self.delay:
+            await asyncio.sleep(self.delay)
+        return self.make_snapshot(stock_name)
+
+    # function to make the next snapshot of the random walk
+    def make_snapshot(self, stock_name):
+        prev_close = self.start_price(stock_name)
+        with self._lock:
+            price = self.prices.get(stock_name, prev_close)
+            price = round(
+                max(0.01, price * (1 + self.random.gauss(0, 0.01))), 2)
+            self.prices[stock_name] = price
+        return {
+            "price": price,
+            "prev_close": prev_close,
+            "change": round(price - prev_close, 2),
+            "market_status": "REGULAR",
+            "quote_table": [
+                ["Previous Close", prev_close],
+                ["Open", prev_close],
+                ["Day's Range", f"{prev_close} - {price}"],
+                ["Volume", 1000000],
+                ["Quote Price", price],
+            ],
+        }
+
+    # function to make a random walk of daily bars for one stock
+    def history(self, stock_name, interval="1d", start=None, days=750):
+        import numpy as np
+
+        step = {"1m": 60, "1d": 86400, "1wk": 604800, "1mo": 2592000}[interval]
+        end = int(time.time()) // step * step
+        times = np.arange(
+            end - (days - 1) * step, end + 1, step, dtype=np.int64)
+        if start is not None:
+            first = int(datetime.strptime(start, "%Y-%m-%d").replace(
+                tzinfo=timezone.utc).timestamp())
+            times = times[times >= first]
+        rng = np.random.default_rng(zlib.crc32(stock_name.encode()))
+        changes = rng.normal(0, 0.02, len(times))
+        close = self.start_price(stock_name) * np.exp(np.cumsum(changes))
+        if len(close):
+            open_ = np.concatenate([[close[0]], close[:-1]])
+        else:
+            open_ = close
+        return {
+            "time": times,
+            "open": open_,
+            "high": np.maximum(open_, close) * 1.01,
+            "low": np.minimum(open_, close) * 0.99,
+            "close": close,
+            "volume": rng.integers(100000, 1000000, len(times)).astype(float),
+        }
+
+
+# A data source that plays back quotes that were recorded before with
+# "python market_data.py record". Every stock has a file with a json
+# snapshot with a "time" on every line. The recording is played at
+# speed times the real speed and starts again at the end. With speed 0
+# every call gives the next snapshot, so a benchmark gets the same
+# prices on every run however fast it is.
+class ReplaySource(MarketSource):
+
+    def __init__(self, folder="data/quotes", speed=1.0, delay=0):
+        self.folder = folder
+        self.speed = speed
+        # seconds to wait on every call, to act like a slow upstream
+        self.delay = delay
+        self.started = time.monotonic()
+        self._recordings = {}
+        self._steps = {}
+        self._lock = threading.Lock()
+
+    # function to get the file of a stock
+    def path(self, stock_name):
+        return os.path.join(self.folder, f"{stock_name.upper()}.jsonl")
+
+    # function to get the times and snapshots of a stock, a file is read
+    # once and kept in memory
+    def recording(self, stock_name):
+        recording = self._recordings.get(stock_name)
+        if recording is None:
+            try:
+                with open(self.path(stock_name)) as file:
+                    snapshots = [
+                        json.loads(line) for line in file if line.strip()]
+            except FileNotFoundError:
+                raise LookupError(f"no recorded quotes for {stock_name}")
+            if not snapshots:
+                raise LookupError(f"no recorded quotes for {stock_name}")
+            snapshots.sort(key=lambda snapshot: snapshot["time"])
+            recording = ([snapshot.pop("time") for snapshot in snapshots],
+                         snapshots)
+            self._recordings[stock_name] = recording
+        return recording
+
+    # function to get the snapshot of a stock at this moment of the replay
+    def snapshot(self, stock_name):
+        if self.delay:
+            time.sleep(self.delay)
+        return self.make_snapshot(stock_name)
+
+    # function to get a snapshot in the async app, the wait doesn't
+    # block the event loop
+    async def snapshot_async(self, stock_name):
+        if self.delay:
+            await asyncio.sleep(self.delay)
+        return self.make_snapshot(stock_name)
+
+    # function to find the snapshot to play now
+    def make_snapshot(self, stock_name):
+        times, snapshots = self.recording(stock_name)
+        if self.speed <= 0:
+            with self._lock:
+                index = self._steps.get(stock_name, 0)
+                self._steps[stock_name] = index + 1
+            index %= len(snapshots)
+        else:
+            length = times[-1] - times[0] + 1
+            played = (time.monotonic() - self.started) * self.speed % length
+            index = bisect.bisect_right(times, times[0] + played) - 1
+        return dict(snapshots[index])
+
+
+# the data sources that can be picked by name
+SOURCES = {
+    "yahoo": YahooSource,
+    "fake": FakeSource,
+    "replay": ReplaySource,
+}
+
+
+# function to make a data source by its name
+def get_source(name="yahoo", **kwargs):
+    return SOURCES[name](**kwargs)
+
+
+# function to make the data source that the environment asks for:
+#   QUOTE_SOURCE        yahoo, fake or replay
+#   QUOTE_DELAY         seconds a fake or replay call waits
+#   QUOTE_REPLAY_DIR    the folder with the recorded quotes
+#   QUOTE_REPLAY_SPEED  how fast the recording is played, 0 is one
+#                       snapshot per call
+def source_from_env(name=None):
+    name = name or os.environ.get("QUOTE_SOURCE", "yahoo")
+    kwargs = {}
+    if name in ("fake", "replay"):
+        kwargs["delay"] = float(os.environ.get("QUOTE_DELAY", 0))
+    if name == "replay":
+        kwargs["folder"] = os.environ.get("QUOTE_REPLAY_DIR", "data/quotes")
+        kwargs["speed"] = float(os.environ.get("QUOTE_REPLAY_SPEED", 1))
+    return get_source(name, **kwargs)
+
+
+# function to record the quotes of stocks for the replay source, a
+# snapshot of every stock is added to its file every interval seconds
+def record_quotes(source, stock_names, folder, interval=15, count=10):
+    os.makedirs(folder, exist_ok=True)
+    for number in range(count):
+        started = time.monotonic()
+        for stock_name in stock_names:
+            try:
+                snapshot = source.snapshot(stock_name)
+            except Exception as error:
+                print(f"could not get {stock_name}: {error}")
+                continue
+            snapshot["time"] = time.time()
+            path = os.path.join(folder, f"{stock_name.upper()}.jsonl")
+            with open(path, "a") as file:
+                file.write(json.dumps(snapshot) + "\n")
+        print(f"recorded {number + 1}/{count}")
+        if number + 1 < count:
+            time.sleep(max(0, interval - (time.monotonic() - started)))
+
+
+# function to turn a snapshot into the document for the quotes collection
+def quote_document(stock_name, snapshot):
+    quote = dict(snapshot)
+    quote["stock_name_short"] = stock_name
+    # a value that was nan is saved as None, then there is no change
+    if quote.get("prev_close") and quote.get("change") is not None:
+        quote["change_percent"] = round(
+            quote["change"] * 100 / quote["prev_close"], 2)
+    else:
+        quote["change_percent"] = 0
+    quote["updated_at"] = datetime.utcnow()
+    return quote
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Record quotes to play back with QUOTE_SOURCE=replay.")
+    parser.add_argument("stocks", nargs="+", help="the stocks to record")
+    parser.add_argument(
+        "--source", default="yahoo", help="where to get the quotes from")
+    parser.add_argument(
+        "--folder", default=os.environ.get("QUOTE_REPLAY_DIR", "data/quotes"))
+    parser.add_argument(
+        "--interval", type=float, default=15,
+        help="seconds between two snapshots")
+    parser.add_argument(
+        "--count", type=int, default=10, help="the number of snapshots")
+    args = parser.parse_args()
+    record_quotes(
+        get_source(args.source), [stock.upper() for stock in args.stocks],
+        args.folder, interval=args.interval, count=args.count)
@@ -0,0 +1,210 @@
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+from pymongo import monitoring
+
+# the upper bounds in seconds of the buckets of every histogram
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0,
+           2.5, 5.0, 10.0)
+
+
+# A prometheus histogram: for every set of labels it counts how many
+# values fell in every bucket, with their sum and count.
+class Histogram:
+
+    def __init__(self, name, description, label_names, buckets=BUCKETS):
+        self.name = name
+        self.description = description
+        self.label_names = label_names
+        self.buckets = buckets
+        # labels -> [count per bucket..., sum, count]
+        self._series = {}
+        self._lock = threading.Lock()
+
+    # function to add one value
+    def observe(self, labels, value):
+        bucket = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [0] * (len(self.buckets) + 2)
+            if bucket < len(self.buckets):
+                series[bucket] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    # function to get the lines of the histogram in the prometheus format
+    def lines(self):
+        with self._lock:
+            series = {labels: list(values)
+                      for labels, values in self._series.items()}
+        yield f"# HELP {self.name} {self.description}"
+        yield f"# TYPE {self.name} histogram"
+        for labels, values in sorted(series.items()):
+            names = ",".join(
+                f'{name}="{value}"'
+                for name, value in zip(self.label_names, labels))
+            names = names + "," if names else ""
+            total = 0
+            for bound, count in zip(self.buckets, values):
+                total += count
+                yield f'{self.name}_bucket{{{names}le="{bound}"}} {total}'
+            yield f'{self.name}_bucket{{{names}le="+Inf"}} {values[-1]}'
+            yield f"{self.name}_sum{{{names[:-1]}}} {values[-2]}"
+            yield f"{self.name}_count{{{names[:-1]}}} {values[-1]}"
+
+
+# the spans of the request that the current thread works on, threads
+# without a request (cache refreshes, the price stream) have none
+_request = threading.local()
+
+
+# function to get the route of the current request for the labels
+def current_route():
+    return getattr(_request, "route", None) or "background"
+
+
+# function to add a span to the current request
+def add_span(kind, name, seconds):
+    spans = getattr(_request, "spans", None)
+    if spans is not None:
+        spans.append((kind, name, seconds))
+
+
+# A pymongo listener that times every command. pymongo already measures
+# the time of a command, so the listener only has to save it.
+class MongoListener(monitoring.CommandListener):
+
+    def __init__(self, histogram):
+        self.histogram = histogram
+
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        self.record(event)
+
+    def failed(self, event):
+        self.record(event)
+
+    # function to save the time of a command
+    def record(self, event):
+        seconds = event.duration_micros / 1e6
+        self.histogram.observe((event.command_name, current_route()), seconds)
+        add_span("mongo", event.command_name, seconds)
+
+
+# The timings of the app: the requests per route, every MongoDB command,
+# every quote call and every rendered template. The timings of one
+# request are kept as spans, so a slow request can be logged with where
+# its time went.
+class Metrics:
+
+    def __init__(self, slow_request_ms=None):
+        # requests that take longer than this are logged with their spans
+        self.slow_request_ms = slow_request_ms
+        self.requests = Histogram(
+            "http_request_duration_seconds", "Time to answer a request.",
+            ("route", "method", "status"))
+        self.mongo = Histogram(
+            "mongo_command_duration_seconds", "Time of a MongoDB command.",
+            ("command", "route"))
+        self.quotes = Histogram(
+            "quote_call_duration_seconds", "Time of a call to the quote "
+            "source.", ("call", "route"))
+        self.templates = Histogram(
+            "template_render_duration_seconds", "Time to render a template.",
+            ("template", "route"))
+        self.mongo_listener = MongoListener(self.mongo)
+
+    # function to time the requests and templates of a flask app
+    def init_app(self, app):
+        from flask import before_render_template, request, template_rendered
+
+        @app.before_request
+        def start_request():
+            _request.route = request.endpoint or "unknown"
+            _request.spans = []
+            _request.started = time.perf_counter()
+            _request.templates = []
+            _request.status = None
+
+        @app.teardown_request
+        def end_request(error=None):
+            started = getattr(_request, "started", None)
+            if started is None:
+                return
+            seconds = time.perf_counter() - started
+            status = _request.status or (500 if error else 200)
+            self.requests.observe(
+                (_request.route, request.method, str(status)), seconds)
+            if (self.slow_request_ms is not None
+                    and seconds * 1000 >= self.slow_request_ms):
+                print(slow_request_line(
+                    request.method, request.path, status, seconds,
+                    _request.spans))
+            _request.started = _request.spans = _request.route = None
+
+        @app.after_request
+        def save_status(response):
+            _request.status = response.status_code
+            return response
+
+        # the start of every template that renders right now, templates
+        # can include other templates
+        def template_started(sender, template, context, **extra):
+            starts = getattr(_request, "templates", None)
+            if starts is not None:
+                starts.append(time.perf_counter())
+
+        def template_done(sender, template, context, **extra):
+            starts = getattr(_request, "templates", None)
+            if not starts:
+                return
+            seconds = time.perf_counter() - starts.pop()
+            name = template.name or "string"
+            self.templates.observe((name, current_route()), seconds)
+            add_span("template", name, seconds)
+
+        before_render_template.connect(template_started, app, weak=False)
+        template_rendered.connect(template_done, app, weak=False)
+
+    # context manager to time a call to the quote source
+    @contextmanager
+    def quote_call(self, call):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - started
+            self.quotes.observe((call, current_route()), seconds)
+            add_span("quote", call, seconds)
+
+    # function to get all histograms in the prometheus text format
+    def render(self):
+        lines = []
+        for histogram in (self.requests, self.mongo, self.quotes,
+                          self.templates):
+            lines.extend(histogram.lines())
+        return "\n".join(lines) + "\n"
+
+
+# function to make the log line of a slow request, with the total time
+# per kind of span and the slowest spans
+def slow_request_line(method, path, status, seconds, spans):
+    totals = {}
+    for kind, name, took in spans:
+        count, total = totals.get(kind, (0, 0.0))
+        totals[kind] = (count + 1, total + took)
+    parts = [
+        f"{kind}={count}x/{total * 1000:.1f}ms"
+        for kind, (count, total) in sorted(totals.items())]
+    slowest = sorted(spans, key=lambda span: span[2], reverse=True)[:3]
+    if slowest:
+        parts.append("slowest: " + ", ".join(
+            f"{kind}:{name} {took * 1000:.1f}ms"
+            for kind, name, took in slowest))
+    return " ".join([
+        f"slow request {method} {path} {status} {seconds * 1000:.1f}ms"
+    ] + parts)
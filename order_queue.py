@@ -0,0 +1,509 @@
+import queue
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from bson.objectid import ObjectId
+from pymongo import UpdateOne
+from aggregates import record_executed_fills
+from trades import TradeError, buy_fee
+
+# the reason of orders of a batch that failed in a way that it can't be
+# told which of its writes were done
+UNKNOWN_REASON = (
+    "Your order could not be checked, please look at your cash and "
+    "portfolio.")
+
+
+# the error of a batch that failed after cash was taken, when it can't be
+# worked out anymore which writes were done. The ids of the batch are
+# saved on the users and positions as last_order_batch.
+class BatchError(Exception):
+    pass
+
+
+# An optional queue for buy and sell orders. The routes only save the
+# order and return, a background thread takes the orders in small
+# batches per stock, prices the whole batch with one quote and writes
+# all fills with one bulk write per collection. The orders are saved in
+# the db, so orders that a stopped process didn't do, or stopped in the
+# middle of, are picked up again by the thread of another (or the next)
+# process.
+class OrderQueue:
+
+    def __init__(self, db, get_price, batch_size=100, max_wait=0.05,
+                 recover_after=30):
+        self.db = db
+        # the function that gets the live price of a stock
+        self.get_price = get_price
+        # the max number of orders in one batch
+        self.batch_size = batch_size
+        # how many seconds to wait for more orders to fill a batch
+        self.max_wait = max_wait
+        # an order that is queued, or executing in a batch that started,
+        # longer than this many seconds ago is taken from the db, this is
+        # also how often the db is checked
+        self.recover_after = recover_after
+        self._queue = queue.Queue()
+        # the results of batches that could not be saved yet
+        self._unsaved = []
+        self._thread = None
+        self._lock = threading.Lock()
+        self._stats = {
+            "batches": 0, "filled": 0, "rejected": 0, "unknown": 0,
+            "recovered": 0}
+
+    # function to start the background thread, one time per process
+    def start(self):
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(
+                    target=self._run, name="order-queue", daemon=True)
+                self._thread.start()
+
+    # function to add a buy order, it returns the id of the order
+    def submit_buy(self, username, stock_name, stock_title, amount):
+        return self._submit({
+            "side": "buy", "username": username, "stock_name": stock_name,
+            "stock_title": stock_title, "amount": amount})
+
+    # function to add a sell order, it returns the id of the order
+    def submit_sell(self, username, stock_name, position_id, amount):
+        return self._submit({
+            "side": "sell", "username": username, "stock_name": stock_name,
+            "position_id": position_id, "amount": amount})
+
+    def _submit(self, order):
+        order["_id"] = ObjectId()
+        order["status"] = "queued"
+        order["created_at"] = datetime.utcnow()
+        self.db.orders.insert_one(order)
+        self.start()
+        self._queue.put(order)
+        return order["_id"]
+
+    # function to get an order with its status and fill
+    def status(self, order_id, username):
+        return self.db.orders.find_one(
+            {"_id": ObjectId(order_id), "username": username},
+            {"stock_title": False, "position_id": False, "batch_id": False,
+             "write_batch": False, "pending_fill": False})
+
+    # function to wait until all orders that were added are done
+    def join(self):
+        self._queue.join()
+
+    # function to get the number of orders waiting and done
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+        stats["waiting"] = self._queue.qsize()
+        return stats
+
+    # function to add the orders that are queued in the db for too long
+    # to the queue, like the orders of a process that was stopped, and to
+    # settle the orders such a process stopped in the middle of
+    def recover(self):
+        oldest = datetime.utcnow() - timedelta(seconds=self.recover_after)
+        orders = list(self.db.orders.find(
+            {"status": "queued", "created_at": {"$lt": oldest}}))
+        for order in orders:
+            self._queue.put(order)
+        recovered = len(orders) + self._settle_executing(oldest)
+        with self._lock:
+            self._stats["recovered"] += recovered
+        return recovered
+
+    # function to settle the orders of batches that started before oldest
+    # and never saved their results. An order without write_batch moved
+    # no cash or stocks, so it is queued again. For the other orders the
+    # last_order_batch of the position and the user tell what was done. A
+    # position is only written after its user paid, so a written position
+    # is filled, none written is rejected and anything else is unknown.
+    def _settle_executing(self, oldest):
+        orders = list(self.db.orders.find(
+            {"status": "executing",
+             "batch_id": {"$lt": ObjectId.from_datetime(oldest)}}))
+        if not orders:
+            return 0
+        again = [order for order in orders if "write_batch" not in order]
+        if again:
+            self.db.orders.update_many(
+                {"_id": {"$in": [order["_id"] for order in again]},
+                 "status": "executing", "write_batch": {"$exists": False}},
+                {"$set": {"status": "queued"}, "$unset": {"batch_id": ""}})
+            for order in again:
+                # an order a batch wrote to in the meantime isn't queued
+                # anymore, so _claim leaves it out
+                self._queue.put(order)
+
+        written = [order for order in orders if "write_batch" in order]
+        if not written:
+            return len(orders)
+        usernames = list({order["username"] for order in written})
+        paid = {
+            user["username"]: user.get("last_order_batch")
+            for user in self.db.users.find(
+                {"username": {"$in": usernames}},
+                {"username": True, "last_order_batch": True})}
+        moved = {
+            (position["bought_by"], position["stock_name_short"]):
+                position.get("last_order_batch")
+            for position in self.db.stocks_bought.find(
+                {"bought_by": {"$in": usernames}},
+                {"bought_by": True, "stock_name_short": True,
+                 "last_order_batch": True})}
+        # the orders whose fill is in the ledger already
+        recorded = set(self.db.trades.distinct(
+            "order_id",
+            {"order_id": {"$in": [order["_id"] for order in written]}}))
+        results = {}
+        fills = []
+        for order in written:
+            batch_id = order["write_batch"]
+            user_batch = paid.get(order["username"])
+            position_batch = moved.get(
+                (order["username"], order["stock_name"]))
+            if order["_id"] in recorded or position_batch == batch_id:
+                results[order["_id"]] = (order["pending_fill"], None)
+                if order["_id"] not in recorded:
+                    fills.append(
+                        dict(order["pending_fill"], order_id=order["_id"]))
+            elif ((user_batch is None or user_batch < batch_id)
+                    and (position_batch is None
+                         or position_batch < batch_id)):
+                results[order["_id"]] = (
+                    None, "Your order could not be done, please try again.")
+            else:
+                results[order["_id"]] = (None, UNKNOWN_REASON)
+        print(f"settled {len(written)} orders of stopped batches")
+        record_executed_fills(self.db, fills)
+        self._save_results(written, results)
+        return len(orders)
+
+    # function to take orders to execute. An order that another thread
+    # or process took already is left out, and so is an order that is in
+    # the queue twice (recover added it again), so no order is done twice.
+    def _claim(self, orders, batch_id):
+        orders = list({order["_id"]: order for order in orders}.values())
+        self.db.orders.update_many(
+            {"_id": {"$in": [order["_id"] for order in orders]},
+             "status": "queued"},
+            {"$set": {"status": "executing", "batch_id": batch_id}})
+        claimed = {
+            order["_id"] for order in self.db.orders.find(
+                {"batch_id": batch_id}, {"_id": True})}
+        return [
+            dict(order, status="executing", batch_id=batch_id)
+            for order in orders if order["_id"] in claimed]
+
+    # the loop of the background thread, an error only stops the batch
+    # it happened in
+    def _run(self):
+        next_recover = time.monotonic()
+        while True:
+            if self._unsaved:
+                self._save_unsaved()
+            if time.monotonic() >= next_recover:
+                next_recover = time.monotonic() + self.recover_after
+                try:
+                    self.recover()
+                except Exception as error:
+                    print(f"could not recover queued orders: {error}")
+            try:
+                orders = [self._queue.get(timeout=self.recover_after)]
+            except queue.Empty:
+                continue
+            deadline = time.monotonic() + self.max_wait
+            while len(orders) < self.batch_size:
+                try:
+                    orders.append(self._queue.get(
+                        timeout=max(0, deadline - time.monotonic())))
+                except queue.Empty:
+                    break
+            try:
+                self._execute(orders)
+            except Exception as error:
+                # the orders that were not taken stay queued in the db
+                # and are recovered later
+                print(f"could not execute {len(orders)} orders: {error}")
+            finally:
+                for _ in orders:
+                    self._queue.task_done()
+
+    # function to execute orders in one batch per stock
+    def _execute(self, orders):
+        batch_id = ObjectId()
+        orders = self._claim(orders, batch_id)
+        batches = OrderedDict()
+        for order in orders:
+            batches.setdefault(order["stock_name"], []).append(order)
+        for stock_name, stock_orders in batches.items():
+            try:
+                price = round(self.get_price(stock_name), 2)
+                results = execute_batch(self.db, stock_orders, price)
+            except BatchError as error:
+                print(f"orders of {stock_name} are unknown: {error}")
+                results = {
+                    order["_id"]: (None, UNKNOWN_REASON)
+                    for order in stock_orders}
+            except Exception as error:
+                results = {
+                    order["_id"]: (None, f"Could not trade: {error}")
+                    for order in stock_orders}
+            self._unsaved.append((stock_orders, results))
+        self._save_unsaved()
+
+    # function to save the results of the batches that are not saved yet,
+    # the results that fail are tried again by the next loop
+    def _save_unsaved(self):
+        unsaved, self._unsaved = self._unsaved, []
+        for orders, results in unsaved:
+            try:
+                self._save_results(orders, results)
+            except Exception as error:
+                print(f"could not save the results of {len(orders)} "
+                      f"orders: {error}")
+                self._unsaved.append((orders, results))
+
+    # function to save the status of all orders of a batch at once
+    def _save_results(self, orders, results):
+        now = datetime.utcnow()
+        updates = []
+        counts = {"filled": 0, "rejected": 0, "unknown": 0}
+        for order in orders:
+            fill, reason = results[order["_id"]]
+            if fill is not None:
+                change = {"status": "filled", "fill": fill}
+            elif reason == UNKNOWN_REASON:
+                change = {"status": "unknown", "reason": reason}
+            else:
+                change = {"status": "rejected", "reason": reason}
+            counts[change["status"]] += 1
+            change["done_at"] = now
+            # an order that recover queued again in the meantime has
+            # another batch (or none) and is left alone
+            updates.append(UpdateOne(
+                {"_id": order["_id"], "batch_id": order["batch_id"]},
+                {"$set": change}))
+        self.db.orders.bulk_write(updates, ordered=False)
+        with self._lock:
+            self._stats["batches"] += 1
+            for status, count in counts.items():
+                self._stats[status] += count
+
+
+# function to execute a batch of orders for one stock at one price, the
+# orders are the ones OrderQueue._claim took, with their batch_id. It
+# returns a dict of order id -> (fill, reason why it was rejected).
+def execute_batch(db, orders, price):
+    stock_name = orders[0]["stock_name"]
+    usernames = list({order["username"] for order in orders})
+    batch_id = ObjectId()
+
+    # load the cash and the positions of all users of the batch at once
+    cash = {
+        user["username"]: user["cash"] for user in db.users.find(
+            {"username": {"$in": usernames}},
+            {"username": True, "cash": True})}
+    positions = {
+        position["bought_by"]: position
+        for position in db.stocks_bought.find(
+            {"bought_by": {"$in": usernames},
+             "stock_name_short": stock_name})}
+
+    # go over the orders in the order they came in, like they would be
+    # done one by one, and keep the change for every user
+    changes = {}
+    results = {}
+    for order in orders:
+        username = order["username"]
+        if username not in cash:
+            results[order["_id"]] = (None, "Unknown user.")
+            continue
+        change = changes.setdefault(username, {
+            "cash": 0, "fees": 0, "amount": 0, "cost": 0, "sold": 0,
+            "orders": [], "title": None})
+        position = positions.get(username)
+        owned = change["amount"] + (
+            position["stock_amount"] if position else 0)
+        cost = change["cost"] + (position["stock_price"] if position else 0)
+        amount = order["amount"]
+        value = round(price * amount, 2)
+
+        if order["side"] == "buy":
+            fee = buy_fee(value)
+            total = round(value + fee, 2)
+            if cash[username] + change["cash"] < total:
+                results[order["_id"]] = (
+                    None, "You don't have enough cash for this purchase.")
+                continue
+            change["cash"] -= total
+            change["fees"] += fee
+            change["amount"] += amount
+            change["cost"] += value
+            change["title"] = order["stock_title"]
+            fill = {"side": "buy", "fee": fee, "total": total}
+        else:
+            if (position is None or position["_id"] != order["position_id"]
+                    or owned < amount):
+                results[order["_id"]] = (
+                    None, "You don't have that many stocks to sell.")
+                continue
+            # the price paid for the sold stocks is taken of the total
+            change["cost"] -= cost / owned * amount
+            change["cash"] += value
+            change["amount"] -= amount
+            change["sold"] += amount
+            fill = {"side": "sell", "fee": 0, "total": value}
+        fill.update({
+            "username": username, "stock_name": stock_name,
+            "amount": amount, "price": price, "value": value})
+        results[order["_id"]] = (fill, None)
+        change["orders"].append(order["_id"])
+
+    changes = {
+        username: change for username, change in changes.items()
+        if change["orders"]}
+    if not changes:
+        return results
+
+    # before any cash moves the fills and the id of this write are saved
+    # on the orders, so recover can settle an order when the process stops
+    # in the middle of the batch. An order recover queued again in the
+    # meantime doesn't match, then the batch stops before it took cash.
+    claims = {order["_id"]: order["batch_id"] for order in orders}
+    order_ids = [
+        order_id for change in changes.values()
+        for order_id in change["orders"]]
+    marked = db.orders.bulk_write([
+        UpdateOne(
+            {"_id": order_id, "batch_id": claims[order_id]},
+            {"$set": {
+                "write_batch": batch_id,
+                "pending_fill": results[order_id][0]}})
+        for order_id in order_ids], ordered=False)
+    if marked.matched_count != len(order_ids):
+        raise TradeError("The order was taken again, please try again.")
+
+    # one bulk write for the cash of the users, the filter makes sure no
+    # user spends more cash than they have now
+    user_updates = []
+    for username, change in changes.items():
+        user_filter = {"username": username}
+        if change["cash"] < 0:
+            user_filter["cash"] = {"$gte": -change["cash"]}
+        user_updates.append(UpdateOne(user_filter, {
+            "$inc": {
+                "cash": change["cash"], "total_spend_fees": change["fees"]},
+            "$set": {"last_order_batch": batch_id}}))
+    # when the write fails part of it may be done, so the users that
+    # paid are looked up like when a filter didn't match
+    try:
+        result = db.users.bulk_write(user_updates, ordered=False)
+        all_paid = result.matched_count == len(user_updates)
+    except Exception as error:
+        print(f"the cash write of batch {batch_id} failed: {error}")
+        all_paid = False
+
+    # from here on cash may be taken, so every error has to give it back
+    # or tell that it can't be known what the batch did
+    try:
+        failed = set()
+        if not all_paid:
+            # when the cash of a user changed since it was loaded, the
+            # filter didn't match and their orders of this batch are
+            # not done
+            paid = {user["username"] for user in db.users.find(
+                {"username": {"$in": list(changes)},
+                 "last_order_batch": batch_id}, {"username": True})}
+            failed = set(changes) - paid
+        undo = write_positions(db, stock_name, changes, failed, batch_id)
+
+        # give back the cash and fees of the orders that were not done
+        refunds = [
+            UpdateOne({"username": username}, {"$inc": {
+                "cash": -changes[username]["cash"],
+                "total_spend_fees": -changes[username]["fees"]}})
+            for username in undo]
+        if refunds:
+            db.users.bulk_write(refunds, ordered=False)
+    except Exception as error:
+        raise BatchError(
+            f"batch {batch_id} failed after cash was taken: {error}"
+        ) from error
+    failed.update(undo)
+    for username in failed:
+        for order_id in changes[username]["orders"]:
+            results[order_id] = (
+                None, "Your cash or stocks changed, please try again.")
+    # save all fills of the batch in the ledger with one write, the
+    # platform counters (like the fee income) only count these fills. The
+    # orders are done, so an error here is logged and repaired later. The
+    # order id on the trade tells recover the fill is in the ledger.
+    record_executed_fills(db, [
+        dict(fill, order_id=order_id)
+        for order_id, (fill, reason) in results.items() if fill is not None])
+    return results
+
+
+# function to write the stocks of the users of a batch that paid with one
+# bulk write. It returns the users whose position couldn't be changed,
+# they get their cash back.
+def write_positions(db, stock_name, changes, failed, batch_id):
+    position_updates = []
+    for username, change in changes.items():
+        if username in failed:
+            continue
+        position_filter = {
+            "bought_by": username, "stock_name_short": stock_name}
+        if change["amount"] < 0:
+            position_filter["stock_amount"] = {"$gte": -change["amount"]}
+        update = {
+            "stock_price": {"$add": [
+                {"$ifNull": ["$stock_price", 0]}, change["cost"]]},
+            "stock_amount": {"$add": [
+                {"$ifNull": ["$stock_amount", 0]}, change["amount"]]},
+            "last_order_batch": batch_id}
+        if change["title"]:
+            update["stock_name"] = change["title"]
+        position_updates.append(UpdateOne(position_filter, [
+            {"$set": update},
+            {"$set": {"price_per_stock": {"$cond": [
+                {"$gt": ["$stock_amount", 0]},
+                {"$divide": ["$stock_price", "$stock_amount"]}, 0]}}}],
+            upsert=not change["sold"]))
+    if not position_updates:
+        return []
+    # a position that was sold at the same time by another request
+    # didn't match the filter, and when the write fails part of it may be
+    # done. The positions that were changed have the id of the batch.
+    try:
+        result = db.stocks_bought.bulk_write(position_updates, ordered=False)
+        all_moved = result.matched_count + result.upserted_count == len(
+            position_updates)
+    except Exception as error:
+        print(f"the position write of batch {batch_id} failed: {error}")
+        all_moved = False
+    undo = []
+    if not all_moved:
+        moved = {
+            position["bought_by"] for position in db.stocks_bought.find(
+                {"bought_by": {"$in": list(changes)},
+                 "stock_name_short": stock_name,
+                 "last_order_batch": batch_id}, {"bought_by": True})}
+        undo = [
+            username for username in changes
+            if username not in failed and username not in moved]
+    # remove the positions that have no more stocks, a position that
+    # stays with 0 stocks is only removed by a later sell
+    if any(change["sold"] for change in changes.values()):
+        try:
+            db.stocks_bought.delete_many({
+                "bought_by": {"$in": list(changes)},
+                "stock_name_short": stock_name,
+                "stock_amount": {"$lte": 0}})
+        except Exception as error:
+            print(f"could not remove the empty positions of batch "
+                  f"{batch_id}: {error}")
+    return undo
@@ -0,0 +1,50 @@
+from datetime import datetime, timedelta
+
+
+# function to make the aggregation pipeline for the portfolio page.
+# MongoDB only takes the stocks of one user, joins the quotes that
+# worker.py saved and works out the value and profit/loss of every
+# stock, so the page only has to show the rows.
+def portfolio_pipeline(username, quote_max_age=300):
+    oldest = datetime.utcnow() - timedelta(seconds=quote_max_age)
+    return [
+        {"$match": {"bought_by": username}},
+        {"$lookup": {
+            "from": "quotes",
+            "localField": "stock_name_short",
+            "foreignField": "stock_name_short",
+            "as": "quote"}},
+        {"$addFields": {"quote": {"$arrayElemAt": ["$quote", 0]}}},
+        # a quote that is too old isn't used, the app gets a live one
+        {"$addFields": {"live_price": {"$cond": [
+            {"$gte": ["$quote.updated_at", oldest]},
+            {"$round": ["$quote.price", 2]},
+            None]}}},
+        {"$project": {"quote": False}},
+        {"$addFields": {"market_value": {"$round": [
+            {"$multiply": ["$live_price", "$stock_amount"]}, 2]}}},
+        {"$addFields": {
+            "profit": {"$round": [
+                {"$subtract": ["$market_value", "$stock_price"]}, 2]},
+            "profit_percent": {"$cond": [
+                {"$gt": ["$stock_price", 0]},
+                {"$round": [{"$multiply": [100, {"$subtract": [
+                    {"$divide": ["$market_value", "$stock_price"]}, 1]}]},
+                    2]},
+                0]}}},
+        {"$sort": {"stock_name": 1}},
+    ]
+
+
+# function to work out the same values as the pipeline in python, for
+# the rows that had no saved quote in the db
+def add_position_values(row, live_price):
+    row["live_price"] = round(live_price, 2)
+    row["market_value"] = round(row["live_price"] * row["stock_amount"], 2)
+    row["profit"] = round(row["market_value"] - row["stock_price"], 2)
+    if row["stock_price"] > 0:
+        row["profit_percent"] = round(
+            100 * (row["market_value"] / row["stock_price"] - 1), 2)
+    else:
+        row["profit_percent"] = 0
+    return row
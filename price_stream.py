@@ -0,0 +1,145 @@
+import json
+import queue
+import threading
+import time
+
+
+# one browser that listens to the prices of some stocks
+class Subscription:
+
+    def __init__(self, symbols, user=None):
+        self.symbols = set(symbols)
+        # the user that opened the page
+        self.user = user
+        # only the newest ticks matter, a slow browser drops old ones
+        self.queue = queue.Queue(maxsize=100)
+        self.last_sent = time.monotonic()
+
+    # function to give a tick to the browser without ever blocking
+    def push(self, message):
+        try:
+            self.queue.put_nowait(message)
+        except queue.Full:
+            try:
+                self.queue.get_nowait()
+            except queue.Empty:
+                pass
+            self.queue.put_nowait(message)
+
+
+# One poller per worker that gets the price of every stock that somebody
+# listens to and sends the ticks to all browsers. However many browsers
+# are connected, every stock is fetched once per interval.
+class PriceBroadcaster:
+
+    def __init__(self, get_prices, interval=5, max_per_user=None):
+        # the function that gets a dict of stock -> price for many stocks
+        self.get_prices = get_prices
+        # seconds between two polls
+        self.interval = interval
+        # the max number of open connections of one user, None is no max
+        self.max_per_user = max_per_user
+        self._subscriptions = set()
+        self._last_prices = {}
+        self._lock = threading.Lock()
+        self._thread = None
+        self._polls = 0
+
+    # function to start listening, it returns the subscription or None
+    # when the user already has the max number of connections open
+    def subscribe(self, symbols, user=None):
+        subscription = Subscription(symbols, user)
+        with self._lock:
+            if user is not None and self.max_per_user is not None:
+                open_connections = sum(
+                    1 for other in self._subscriptions if other.user == user)
+                if open_connections >= self.max_per_user:
+                    return None
+            self._subscriptions.add(subscription)
+            last_prices = dict(self._last_prices)
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(
+                    target=self._run, name="price-stream", daemon=True)
+                self._thread.start()
+        # send the last known prices right away
+        for symbol in subscription.symbols:
+            if symbol in last_prices:
+                subscription.push(tick_message(symbol, last_prices[symbol]))
+        return subscription
+
+    # function to stop listening
+    def unsubscribe(self, subscription):
+        with self._lock:
+            self._subscriptions.discard(subscription)
+
+    # the loop of the poller thread, it stops when nobody listens
+    def _run(self):
+        while True:
+            with self._lock:
+                subscriptions = list(self._subscriptions)
+                if not subscriptions:
+                    self._thread = None
+                    return
+            symbols = set()
+            for subscription in subscriptions:
+                symbols |= subscription.symbols
+            try:
+                prices = self.get_prices(symbols)
+            except Exception as error:
+                print(f"could not get prices for the stream: {error}")
+                prices = {}
+            changed = {}
+            with self._lock:
+                self._polls += 1
+                for symbol, price in prices.items():
+                    price = round(price, 2)
+                    if self._last_prices.get(symbol) != price:
+                        self._last_prices[symbol] = price
+                        changed[symbol] = price
+            for subscription in subscriptions:
+                for symbol in subscription.symbols & set(changed):
+                    subscription.push(tick_message(symbol, changed[symbol]))
+            time.sleep(self.interval)
+
+    # function to get the number of connections, idle connections are
+    # the ones that got no tick during the last two polls
+    def stats(self):
+        now = time.monotonic()
+        with self._lock:
+            subscriptions = list(self._subscriptions)
+            polls = self._polls
+        per_symbol = {}
+        for subscription in subscriptions:
+            for symbol in subscription.symbols:
+                per_symbol[symbol] = per_symbol.get(symbol, 0) + 1
+        return {
+            "connections": len(subscriptions),
+            "idle_connections": sum(
+                1 for subscription in subscriptions
+                if now - subscription.last_sent > 2 * self.interval),
+            "subscribers_per_symbol": per_symbol,
+            "polls": polls,
+        }
+
+    # function that yields the server-sent events for one browser
+    def events(self, subscription, heartbeat=15):
+        try:
+            # tell the browser to wait a bit before it reconnects
+            yield f"retry: {int(self.interval * 1000)}\n\n"
+            while True:
+                try:
+                    message = subscription.queue.get(timeout=heartbeat)
+                except queue.Empty:
+                    # a comment keeps proxies from closing the connection
+                    # and shows if the browser is gone
+                    yield ": keep-alive\n\n"
+                    continue
+                subscription.last_sent = time.monotonic()
+                yield message
+        finally:
+            self.unsubscribe(subscription)
+
+
+# function to make the server-sent event of one price tick
+def tick_message(symbol, price):
+    return f"data: {json.dumps({'symbol': symbol, 'price': price})}\n\n"
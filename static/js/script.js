@@ -2,12 +2,42 @@ $(document).ready(function(){
     $('.sidenav').sidenav({edge: "right"});
     $('.collapsible').collapsible();
     $(".dropdown-trigger").dropdown();
+    listenToLivePrices();
   });
 
 /* code to multiply the quantity with the stock price */
-$('#stock_total, #stock_price_changing').keyup(function(){
+function updateTotalPrice() {
     var stock_total = parseFloat($('#stock_total').val()) || 0;
     var stock_price_changing = parseFloat($('#stock_price_changing').val()) || 0;
     var result = Math.round(stock_total * stock_price_changing * 100)/100;
     $('#total_price').val(result);
-});
\ No newline at end of file
+}
+
+$('#stock_total, #stock_price_changing').keyup(updateTotalPrice);
+
+/* code to update the prices on the page when the server sends a new price */
+function listenToLivePrices() {
+    var symbols = [];
+    $('[data-live-price]').each(function() {
+        var symbol = $(this).data('live-price');
+        if (symbols.indexOf(symbol) === -1) {
+            symbols.push(symbol);
+        }
+    });
+    if (symbols.length === 0 || !window.EventSource) {
+        return;
+    }
+    var url = $('body').data('price-stream-url') + '?symbols=' + encodeURIComponent(symbols.join(','));
+    var source = new EventSource(url);
+    source.onmessage = function(event) {
+        var tick = JSON.parse(event.data);
+        var price = tick.price.toFixed(2);
+        $('[data-live-price="' + tick.symbol + '"]').text(price);
+        /* the price that is used to calculate the total price */
+        var priceInput = $('#stock_price_changing');
+        if (priceInput.data('symbol') === tick.symbol) {
+            priceInput.val(price);
+            updateTotalPrice();
+        }
+    };
+}
@@ -0,0 +1,144 @@
+import os
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+from aggregates import record_executed_fills
+
+# the fee of every purchase is $0.50 + 0.3% of the purchase value
+FEE_BASE = 0.5
+FEE_RATE = 0.003
+# the user that collects the fees of all trades
+ADMIN_USER = "admin"
+# run every trade in a multi-document transaction (needs a replica set)
+USE_TRANSACTIONS = os.environ.get("TRADE_TRANSACTIONS", "") == "1"
+
+
+# the error a trade gives when it can't be done, the message can be
+# shown to the user
+class TradeError(Exception):
+    pass
+
+
+# function to get the fee of a purchase
+def buy_fee(value):
+    return round(FEE_BASE + FEE_RATE * value, 2)
+
+
+# function to run a trade, in a transaction when that is turned on.
+# Without a transaction every write is still atomic on its own and has
+# the checks in its filter, so cash and shares can't go below zero.
+def run_trade(db, trade, use_transaction=None):
+    if use_transaction is None:
+        use_transaction = USE_TRANSACTIONS
+    if not use_transaction:
+        return trade(None)
+    with db.client.start_session() as session:
+        return session.with_transaction(trade)
+
+
+# function to add stocks to the position of a user, the price per
+# stock is worked out by MongoDB in the same write
+def add_to_position(db, username, stock_name, stock_title, amount, value,
+                    session=None):
+    position_filter = {"bought_by": username, "stock_name_short": stock_name}
+    update = [
+        {"$set": {
+            "stock_name": stock_title,
+            "stock_price": {"$add": [
+                {"$ifNull": ["$stock_price", 0]}, value]},
+            "stock_amount": {"$add": [
+                {"$ifNull": ["$stock_amount", 0]}, amount]}}},
+        {"$set": {"price_per_stock": {
+            "$divide": ["$stock_price", "$stock_amount"]}}},
+    ]
+    try:
+        db.stocks_bought.update_one(
+            position_filter, update, upsert=True, session=session)
+    except DuplicateKeyError:
+        # two first buys of the same stock at the same time, the other
+        # one made the position so now it can be updated
+        db.stocks_bought.update_one(
+            position_filter, update, upsert=True, session=session)
+
+
+# function to buy stocks for a user and get the executed fill back
+def buy(db, username, stock_name, stock_title, amount, price,
+        use_transaction=None):
+    # get to purchase value of the stocks excl fee
+    value = round(price * amount, 2)
+    # get amount spend on fee by purchasing a stock
+    fee = buy_fee(value)
+    total = round(value + fee, 2)
+
+    def trade(session):
+        # take the cash of the user, but only when there is enough
+        paid = db.users.update_one(
+            {"username": username, "cash": {"$gte": total}},
+            {"$inc": {"cash": -total, "total_spend_fees": fee}},
+            session=session)
+        if paid.modified_count == 0:
+            raise TradeError("You don't have enough cash for this purchase.")
+        try:
+            add_to_position(
+                db, username, stock_name, stock_title, amount, value,
+                session=session)
+        except Exception:
+            # give the cash back when the stocks couldn't be added, in
+            # a transaction the abort already does this
+            if session is None:
+                db.users.update_one(
+                    {"username": username},
+                    {"$inc": {"cash": total, "total_spend_fees": -fee}})
+            raise
+        fill = {
+            "side": "buy", "username": username, "stock_name": stock_name,
+            "amount": amount, "price": price, "value": value, "fee": fee,
+            "total": total}
+        # save the trade in the ledger and add it to the platform counters
+        # (like the fee income of the business) and the leaderboard, the
+        # trade is done so an error here is logged and repaired later
+        record_executed_fills(db, [fill], session=session)
+        return fill
+
+    return run_trade(db, trade, use_transaction)
+
+
+# function to sell stocks of a position and get the executed fill back
+def sell(db, username, position_id, amount, price, use_transaction=None):
+    # get the sell price of all stocks
+    value = round(price * amount, 2)
+
+    def trade(session):
+        # take the stocks of the position, but only when it is from this
+        # user and has enough stocks. The price paid for the sold stocks
+        # is taken of the total so the price per stock stays the same.
+        position = db.stocks_bought.find_one_and_update(
+            {"_id": position_id, "bought_by": username,
+             "stock_amount": {"$gte": amount}},
+            [{"$set": {
+                "stock_price": {"$subtract": [
+                    "$stock_price",
+                    {"$multiply": ["$price_per_stock", amount]}]},
+                "stock_amount": {"$subtract": ["$stock_amount", amount]}}}],
+            return_document=ReturnDocument.AFTER, session=session)
+        if position is None:
+            raise TradeError("You don't have that many stocks to sell.")
+        # add the money of the sold stocks to the cash of the user
+        db.users.update_one(
+            {"username": username}, {"$inc": {"cash": value}},
+            session=session)
+        # remove the position when it has no more stocks, the filter
+        # makes sure a buy that just came in isn't removed
+        db.stocks_bought.delete_one(
+            {"_id": position_id, "stock_amount": {"$lte": 0}},
+            session=session)
+        fill = {
+            "side": "sell", "username": username,
+            "stock_name": position["stock_name_short"], "amount": amount,
+            "price": price, "value": value, "fee": 0, "total": value}
+        # save the trade in the ledger and add it to the platform counters
+        # (like the fee income of the business) and the leaderboard, the
+        # trade is done so an error here is logged and repaired later
+        record_executed_fills(db, [fill], session=session)
+        return fill
+
+    return run_trade(db, trade, use_transaction)
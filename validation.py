@@ -0,0 +1,101 @@
+import re
+
+
+# One field of a form. The pattern is compiled once and has to match the
+# whole value, the message is shown when it doesn't.
+class Field:
+
+    def __init__(self, name, pattern, message, max_length=100, lower=False,
+                 convert=None):
+        self.name = name
+        self.pattern = re.compile(pattern)
+        self.message = message
+        # longer values are refused before the pattern is tried
+        self.max_length = max_length
+        self.lower = lower
+        # function to turn the checked text into the value the route uses
+        self.convert = convert
+
+    # function to check one value, it returns (value, error message)
+    def check(self, value):
+        if value is None:
+            value = ""
+        if self.lower:
+            value = value.lower()
+        if (not value or len(value) > self.max_length
+                or self.pattern.fullmatch(value) is None):
+            return None, self.message
+        if self.convert is not None:
+            value = self.convert(value)
+        return value, None
+
+
+# A form is a list of fields. All fields are checked in one go, so the
+# user sees every mistake at once.
+class FormSchema:
+
+    def __init__(self, *fields):
+        self.fields = fields
+
+    # function to check a form (a dict or request.form), it returns a
+    # dict of the checked values and a list of the error messages
+    def validate(self, form):
+        values = {}
+        errors = []
+        for field in self.fields:
+            value, error = field.check(form.get(field.name))
+            if error is None:
+                values[field.name] = value
+            else:
+                errors.append(error)
+        return values, errors
+
+
+# letters and numbers only, between 5 and 20 characters
+USERNAME = r"[a-z0-9]{5,20}"
+# a name of letters and numbers with one "." or "_" in it, an @ and a
+# domain. Every part can only match in one way, so a long value that
+# doesn't match fails fast instead of trying every split.
+EMAIL = r"[a-z0-9]+(?:[._][a-z0-9]+|[a-z0-9])@\w+\.\w{2,3}"
+# all characters, between 5 and 20 characters
+PASSWORD = r".{5,20}"
+# numbers between 1 en 10000 (not 0)
+STOCK_AMOUNT = r"[1-9][0-9]{0,3}|10000"
+
+USERNAME_MESSAGE = (
+    "Username is not valide. Use between 5-15 character and only letters " +
+    "and numbers.")
+EMAIL_MESSAGE = "Please fill in a valid email address."
+PASSWORD_MESSAGE = "Password is not valid. Use between the 5-15 characters."
+STOCK_AMOUNT_MESSAGE = "Enter a valide number."
+
+
+# function to make the field of a username
+def username_field():
+    return Field(
+        "username", USERNAME, USERNAME_MESSAGE, max_length=20, lower=True)
+
+
+# function to make the field of an email address, 254 is the longest
+# address there can be
+def email_field():
+    return Field("email", EMAIL, EMAIL_MESSAGE, max_length=254, lower=True)
+
+
+# function to make the field of a password
+def password_field():
+    return Field("password", PASSWORD, PASSWORD_MESSAGE, max_length=20)
+
+
+# function to make the field of a number of stocks
+def stock_amount_field(name):
+    return Field(
+        name, STOCK_AMOUNT, STOCK_AMOUNT_MESSAGE, max_length=5, convert=int)
+
+
+# the forms of the site
+REGISTER_FORM = FormSchema(username_field(), email_field(), password_field())
+LOGIN_FORM = FormSchema(email_field(), password_field())
+PROFILE_FORM = FormSchema(username_field(), email_field())
+BUY_FORM = FormSchema(stock_amount_field("stock_total"))
+SELL_FORM = FormSchema(stock_amount_field("stocks_sell"))
@@ -0,0 +1,119 @@
+import argparse
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pymongo import MongoClient, UpdateOne
+from pymongo.errors import ConfigurationError
+from aggregates import mark_leaderboard, rebuild_leaderboard, repair_ledger
+from db_setup import ensure_indexes
+from market_data import quote_document, source_from_env
+if os.path.exists("env.py"):
+    import env
+
+
+# after failed polls the worker waits up to this many intervals
+MAX_BACKOFF = 8
+
+
+# function to connect to the same database as the web app
+def get_db():
+    client = MongoClient(os.environ.get("MONGO_URI"))
+    try:
+        return client.get_default_database()
+    except ConfigurationError:
+        # the uri has no database name in it
+        return client[os.environ.get("MONGO_DBNAME")]
+
+
+# function to get the data of all stocks once and save it in the db
+def poll_once(db, source, max_workers=8):
+    stock_names = db.stock_info.distinct("stock_name_short")
+
+    # function to get one snapshot, a failing stock only skips itself
+    def fetch(stock_name):
+        try:
+            return stock_name, source.snapshot(stock_name)
+        except Exception as error:
+            print(f"could not get {stock_name}: {error}")
+            return stock_name, None
+
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        snapshots = list(pool.map(fetch, stock_names))
+
+    # save all snapshots with one bulk write, a snapshot that can't be
+    # made into a quote only skips its stock
+    updates = []
+    for stock_name, snapshot in snapshots:
+        if snapshot is None:
+            continue
+        try:
+            quote = quote_document(stock_name, snapshot)
+        except Exception as error:
+            print(f"could not save {stock_name}: {error}")
+            continue
+        updates.append(UpdateOne(
+            {"stock_name_short": stock_name}, {"$set": quote}, upsert=True))
+    if updates:
+        db.quotes.bulk_write(updates, ordered=False)
+    return len(updates)
+
+
+# function to keep polling the stocks until the worker is stopped. Every
+# mark_every polls the failed trade saves are repaired, the stuck
+# leaderboard rows are tried again and the leaderboard is valued again
+# at the new quotes.
+def run(db, source, interval=15, max_workers=8, mark_every=4):
+    ensure_indexes(db)
+    polls = 0
+    failures = 0
+    while True:
+        started = time.monotonic()
+        polls += 1
+        # an error of MongoDB or the source only skips this poll, the
+        # worker waits a bit longer after every failed poll in a row
+        try:
+            saved = poll_once(db, source, max_workers=max_workers)
+            took = time.monotonic() - started
+            print(f"saved {saved} quotes in {took:.2f}s")
+            if mark_every and polls % mark_every == 0:
+                repaired = repair_ledger(db)
+                if repaired:
+                    print(f"saved {repaired} failed trades in the ledger")
+                rebuilt = rebuild_leaderboard(db)
+                if rebuilt:
+                    print(f"tried {rebuilt} stuck leaderboard rows again")
+                marked = mark_leaderboard(db)
+                print(f"valued {marked} leaderboard rows again")
+            failures = 0
+        except Exception as error:
+            failures += 1
+            print(f"poll failed ({failures} in a row): {error}")
+        took = time.monotonic() - started
+        wait = interval * min(2 ** failures, MAX_BACKOFF)
+        time.sleep(max(0, wait - took))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Save the quotes of all stocks in the db.")
+    parser.add_argument(
+        "--interval", type=float,
+        default=float(os.environ.get("QUOTE_POLL_INTERVAL", 15)),
+        help="seconds between two polls")
+    parser.add_argument(
+        "--source", default=os.environ.get("QUOTE_SOURCE", "yahoo"),
+        help="where to get the quotes from: yahoo, fake or replay")
+    parser.add_argument(
+        "--mark-every", type=int,
+        default=int(os.environ.get("LEADERBOARD_MARK_EVERY", 4)),
+        help="value the leaderboard again every this many polls, 0 is off")
+    parser.add_argument(
+        "--once", action="store_true", help="poll one time and stop")
+    args = parser.parse_args()
+
+    db = get_db()
+    source = source_from_env(args.source)
+    if args.once:
+        print(f"saved {poll_once(db, source)} quotes")
+    else:
+        run(db, source, interval=args.interval, mark_every=args.mark_every)